@@ -66,20 +66,75 @@ def send_html_mail(
     subject = force_str(subject)
     message = force_str(message)
 
-    msg = make_message(subject=subject, body=message, from_email=from_email, to=recipient_list, priority=priority)
-    email = msg.email
-    email = EmailMultiAlternatives(email.subject, email.body, email.from_email, email.to, headers=headers)
-    email.attach_alternative(message_html, "text/html")
-    msg.email = email
+    msg = make_message(
+        subject=subject,
+        body=message,
+        from_email=from_email,
+        to=recipient_list,
+        headers=headers,
+        priority=priority,
+        email_class=EmailMultiAlternatives,
+        alternatives=[(message_html, "text/html")],
+    )
     msg.save()
     return 1
 
 
+def send_html_mail_many(
+    subject,
+    message,
+    message_html,
+    from_email,
+    recipients,
+    priority=None,
+    headers={},
+    batch_size=None,
+):
+    """
+    Function to queue the same HTML e-mail separately to each address from the
+    iterable `recipients`
+    """
+    from django.core.mail import EmailMultiAlternatives
+    from django.utils.encoding import force_str
+
+    subject = force_str(subject)
+    message = force_str(message)
+    message_html = force_str(message_html)
+
+    emails = (
+        EmailMultiAlternatives(
+            subject,
+            message,
+            from_email,
+            [recipient],
+            headers=dict(headers),
+            alternatives=[(message_html, "text/html")],
+        )
+        for recipient in recipients
+    )
+    return enqueue_many(emails, priority=priority, batch_size=batch_size)
+
+
 def send_mass_mail(datatuple, fail_silently=False, auth_user=None, auth_password=None, connection=None):
-    num_sent = 0
-    for subject, message, sender, recipient in datatuple:
-        num_sent += send_mail(subject, message, sender, recipient)
-    return num_sent
+    from django.core.mail import EmailMessage
+    from django.utils.encoding import force_str
+
+    emails = (
+        EmailMessage(force_str(subject), force_str(message), sender, recipient)
+        for subject, message, sender, recipient in datatuple
+    )
+    return enqueue_many(emails)
+
+
+def enqueue_many(emails, priority=None, batch_size=None):
+    """
+    Function to queue EmailMessage objects from an iterable, in chunks of
+    batch_size (default: MAILER_ENQUEUE_BATCH_SIZE)
+    """
+    from mailer.models import Message
+
+    priority = get_priority(priority)
+    return Message.objects.enqueue_many(emails, priority=priority, batch_size=batch_size)
 
 
 def mail_admins(subject, message, fail_silently=False, connection=None, priority=None):
@@ -0,0 +1,311 @@
+"""
+Email backends for the asyncio delivery engine in mailer.async_engine.
+
+These mirror Django's email backends, except that ``open``, ``close`` and
+``send_messages`` are coroutines.
+"""
+
+import asyncio
+import base64
+import re
+import smtplib
+import ssl
+
+from django.conf import settings
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+
+CRLF = b"\r\n"
+
+# StreamWriter.start_tls(), needed for STARTTLS, was added in Python 3.11
+HAS_START_TLS = hasattr(asyncio.StreamWriter, "start_tls")
+
+
+class BaseAsyncEmailBackend:
+    """
+    Base class for async email backend implementations.
+
+    Subclasses must at least overwrite send_messages().
+    """
+
+    def __init__(self, fail_silently=False, **kwargs):
+        self.fail_silently = fail_silently
+
+    async def open(self):
+        """
+        Open a network connection. Returns True if a new connection was
+        opened, False if one was already open.
+        """
+        pass
+
+    async def close(self):
+        """Close a network connection."""
+        pass
+
+    async def __aenter__(self):
+        try:
+            await self.open()
+        except Exception:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def send_messages(self, email_messages):
+        """
+        Send one or more EmailMessage objects and return the number of email
+        messages sent.
+        """
+        raise NotImplementedError("subclasses of BaseAsyncEmailBackend must override send_messages() method")
+
+
+class LocmemBackend(BaseAsyncEmailBackend):
+    """
+    Stores messages in django.core.mail.outbox, like Django's locmem backend.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not hasattr(mail, "outbox"):
+            mail.outbox = []
+
+    async def send_messages(self, email_messages):
+        msg_count = 0
+        for message in email_messages:
+            message.message()
+            mail.outbox.append(message)
+            msg_count += 1
+        return msg_count
+
+
+class SMTPBackend(BaseAsyncEmailBackend):
+    """
+    An SMTP client built on asyncio streams, configured through the same
+    EMAIL_* settings as Django's SMTP backend.
+
+    Errors are raised as the corresponding smtplib exceptions, so that the
+    usual delivery error handling applies.
+    """
+
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        username=None,
+        password=None,
+        use_tls=None,
+        use_ssl=None,
+        timeout=None,
+        fail_silently=False,
+        **kwargs,
+    ):
+        super().__init__(fail_silently=fail_silently)
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = settings.EMAIL_USE_SSL if use_ssl is None else use_ssl
+        self.timeout = settings.EMAIL_TIMEOUT if timeout is None else timeout
+        if self.use_ssl and self.use_tls:
+            raise ValueError(
+                "EMAIL_USE_TLS/EMAIL_USE_SSL are mutually exclusive, so only set one of those settings to True."
+            )
+        if self.use_tls and not HAS_START_TLS:
+            raise ImproperlyConfigured(
+                "EMAIL_USE_TLS requires Python 3.11 or later with mailer.async_backends.SMTPBackend, "
+                "use EMAIL_USE_SSL instead."
+            )
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+
+    async def open(self):
+        if self.writer is not None:
+            # Nothing to do if the connection is already open.
+            return False
+        try:
+            connect = asyncio.open_connection(
+                self.host, self.port, ssl=ssl.create_default_context() if self.use_ssl else None
+            )
+            self.reader, self.writer = await self._wait(connect)
+            code, resp = await self._read_reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, resp)
+            await self._ehlo()
+            if self.use_tls:
+                await self._starttls()
+            if self.username and self.password:
+                await self._login()
+            return True
+        except OSError:
+            await self._drop()
+            if not self.fail_silently:
+                raise
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            try:
+                await self._command("QUIT")
+            except OSError:
+                # The connection is being closed anyway.
+                pass
+        finally:
+            await self._drop()
+
+    async def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        new_conn_created = await self.open()
+        if self.writer is None:
+            # We failed silently on open().
+            return 0
+        num_sent = 0
+        try:
+            for message in email_messages:
+                sent = await self._send(message)
+                if sent:
+                    num_sent += 1
+        finally:
+            if new_conn_created:
+                await self.close()
+        return num_sent
+
+    async def _send(self, email_message):
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        data = email_message.message().as_bytes(linesep="\r\n")
+        try:
+            await self._transaction(from_email, recipients, data)
+        except OSError:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
+
+    async def _transaction(self, from_email, recipients, data):
+        code, resp = await self._command(f"MAIL FROM:<{from_email}>")
+        if code != 250:
+            await self._reset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_email)
+        refused = {}
+        for recipient in recipients:
+            code, resp = await self._command(f"RCPT TO:<{recipient}>")
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            await self._reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = await self._command("DATA")
+        if code != 354:
+            await self._reset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.writer.write(quote_data(data))
+        code, resp = await self._read_reply()
+        if code != 250:
+            await self._reset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def _ehlo(self):
+        code, resp = await self._command(f"EHLO {DNS_NAME}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, resp)
+        self.esmtp_features = parse_esmtp_features(resp)
+
+    async def _starttls(self):
+        code, resp = await self._command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        await self._wait(self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host))
+        await self._ehlo()
+
+    async def _login(self):
+        methods = self.esmtp_features.get("auth", "").upper().split()
+        if "PLAIN" in methods:
+            token = base64.b64encode(f"\0{self.username}\0{self.password}".encode()).decode("ascii")
+            code, resp = await self._command(f"AUTH PLAIN {token}")
+        elif "LOGIN" in methods:
+            code, resp = await self._command("AUTH LOGIN")
+            if code == 334:
+                code, resp = await self._command(base64.b64encode(self.username.encode()).decode("ascii"))
+            if code == 334:
+                code, resp = await self._command(base64.b64encode(self.password.encode()).decode("ascii"))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def _reset(self):
+        try:
+            await self._command("RSET")
+        except OSError:
+            await self._drop()
+
+    async def _command(self, line):
+        self.writer.write(line.encode("ascii") + CRLF)
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await self._wait(self.reader.readline())
+            if not line:
+                await self._drop()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b"\n".join(lines)
+
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            await self._drop()
+            raise smtplib.SMTPServerDisconnected("Connection timed out")
+
+    async def _drop(self):
+        writer, self.reader, self.writer = self.writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+
+def parse_esmtp_features(ehlo_response):
+    """
+    Returns the ESMTP features advertised in an EHLO response as a dict of
+    lowercase keywords to parameters, like smtplib.SMTP.esmtp_features.
+    """
+    features = {}
+    for line in ehlo_response.decode("latin-1").split("\n")[1:]:
+        keyword, _, params = line.strip().partition(" ")
+        if keyword:
+            features[keyword.lower()] = params
+    return features
+
+
+def quote_data(data):
+    """
+    Returns the message data dot-stuffed and terminated for the DATA command.
+    """
+    data = re.sub(rb"(?m)^\.", b"..", data)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b"." + CRLF
@@ -0,0 +1,282 @@
+"""
+An asyncio based alternative to mailer.engine.send_all, which keeps many SMTP
+transactions in flight from a single thread.
+
+Messages are always claimed in batches (see mailer.engine.claim_messages), and
+all database access goes through sync_to_async.
+"""
+
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from mailer import metrics
+from mailer.circuitbreaker import get_circuit_breaker
+from mailer.engine import (
+    DEFAULT_CLAIM_BATCH_SIZE,
+    _circuit_breaker_allows,
+    _get_quota_max_wait,
+    _hold_back,
+    _limits_allow_another,
+    _limits_reached,
+    _rate_limit_delay,
+    _record_outcome,
+    _record_sent,
+    _release_probe,
+    acquire_lock,
+    claim_batches,
+    empty_queue_sleep_time,
+    ensure_message_id,
+    make_finalizer,
+    make_lease_owner,
+    prioritize,
+    record_run_metrics,
+    release_lock,
+    renew_lease,
+    wait_for_rate_limits,
+)
+from mailer.logsinks import get_log_sink
+from mailer.models import RESULT_SUCCESS, Message, MessageLog
+from mailer.ratelimit import get_send_quota
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    raise ImportError("asgiref must be installed to use mailer.async_engine, it comes with Django 3.0 and later.")
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_for_quota():
+    """
+    Like mailer.engine._wait_for_quota, without blocking the event loop.
+    """
+    send_quota = get_send_quota()
+    if send_quota is None:
+        return True
+    while True:
+        wait = await sync_to_async(send_quota.acquire)()
+        if not wait:
+            return True
+        if wait > _get_quota_max_wait():
+            logger.info(f"send quota reached, stopping for {wait:.1f} seconds")
+            return False
+        await asyncio.sleep(wait)
+
+
+async def close_connection(connection):
+    try:
+        await connection.close()
+    except Exception:
+        logger.debug("error closing connection", exc_info=True)
+
+
+def _finish_message(finalizer, message, sent):
+    if finalizer is not None:
+        finalizer.add(message, MessageLog.objects.build(message, RESULT_SUCCESS) if sent else None)
+        return
+    if sent:
+        MessageLog.objects.log(message, RESULT_SUCCESS)
+    message.delete()
+
+
+async def send_message(connection, message, finalizer=None):
+    """
+    Sends the message over an open async backend connection, and removes it
+    from the queue, through `finalizer` if given. Returns "sent", or None if
+    the message was discarded because it couldn't be loaded from the DB.
+    """
+    email = message.email
+    if email is None:
+        logger.warning(
+            f"message discarded due to failure in converting from DB. Added on "
+            f"'{message.when_added}' with priority '{message.priority}'"
+        )  # noqa
+        await sync_to_async(_finish_message)(finalizer, message, False)
+        return None
+
+    logger.info(f"sending message '{email.subject}' to {', '.join(map(str, email.to))}")
+    ensure_message_id(email)
+    with metrics.timer("smtp_transaction_seconds"):
+        await connection.send_messages([email])
+    message.email = email  # For the sake of MessageLog
+    await sync_to_async(_finish_message)(finalizer, message, True)
+    _record_sent(message)
+    return "sent"
+
+
+async def _worker(backend, error_handler, work_queue, results_queue, breaker=None):
+    connection = None
+    finalizer = make_finalizer(leased=True)
+    try:
+        while True:
+            try:
+                # Wake up to write buffered outcomes when they are due
+                message = await asyncio.wait_for(
+                    work_queue.get(), finalizer.wait_time() if finalizer is not None else None
+                )
+            except asyncio.TimeoutError:
+                await sync_to_async(finalizer.flush_due)()
+                continue
+            if message is None:
+                break
+            try:
+                if connection is None:
+                    connection = import_string(backend)()
+                    await connection.open()
+                    metrics.increment("connections", source="new")
+                action_taken = await send_message(connection, message, finalizer)
+                _record_outcome(breaker, action_taken, None)
+            except Exception as err:
+                if breaker is not None:
+                    breaker.record(err)
+                metrics.increment("send_failures", error=type(err).__name__)
+                failed_connection = connection
+                try:
+                    connection, action_taken = await sync_to_async(error_handler)(connection, message, err)
+                except Exception as handler_err:
+                    results_queue.put_nowait((None, handler_err))
+                    continue
+                finally:
+                    if failed_connection is not None and connection is not failed_connection:
+                        await close_connection(failed_connection)
+                if action_taken is not None:
+                    metrics.increment("messages", result=action_taken)
+            results_queue.put_nowait((action_taken, None))
+    finally:
+        if finalizer is not None:
+            await sync_to_async(finalizer.flush)()
+        if connection is not None:
+            await close_connection(connection)
+
+
+async def async_send_all(queryset=None):
+    """
+    Send all eligible messages in the queue, with up to
+    MAILER_ASYNC_CONCURRENCY messages in flight at once. Returns the counts
+    like mailer.engine.send_all.
+    """
+    backend = getattr(settings, "MAILER_ASYNC_EMAIL_BACKEND", "mailer.async_backends.SMTPBackend")
+    use_file_lock = getattr(settings, "MAILER_USE_FILE_LOCK", True)
+    error_handler = import_string(getattr(settings, "MAILER_ERROR_HANDLER", "mailer.engine.handle_delivery_exception"))
+    concurrency = getattr(settings, "MAILER_ASYNC_CONCURRENCY", 10)
+    claim_batch_size = getattr(settings, "MAILER_CLAIM_BATCH_SIZE", None) or DEFAULT_CLAIM_BATCH_SIZE
+    throttle = getattr(settings, "MAILER_EMAIL_THROTTLE", 0)
+
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.is_open():
+        logger.info(f"circuit breaker open, not sending for {breaker.wait_time():.1f} seconds")
+        return {"deferred": 0, "sent": 0, "skipped": 0}
+
+    if use_file_lock:
+        acquired, lock = acquire_lock()
+        if not acquired:
+            return
+
+    start_time = time.time()
+
+    counts = {"deferred": 0, "sent": 0, "skipped": 0}
+
+    owner = make_lease_owner()
+    work_queue = asyncio.Queue()
+    results_queue = asyncio.Queue()
+    workers = [
+        asyncio.ensure_future(_worker(backend, error_handler, work_queue, results_queue, breaker))
+        for i in range(concurrency)
+    ]
+
+    async def collect_result():
+        action_taken, err = await results_queue.get()
+        if err is not None:
+            raise err
+        if action_taken is not None:
+            counts[action_taken] += 1
+
+    in_flight = 0
+    batches = claim_batches(owner, claim_batch_size, queryset)
+    # Like mailer.engine._send_concurrently, the limits of the run and the
+    # circuit breaker are checked before taking quota or rate limit tokens,
+    # and quota taken for a message that isn't sent carries over.
+    has_quota = False
+    try:
+        limits_reached = False
+        while not limits_reached:
+            batch = await sync_to_async(next)(batches, None)
+            if not batch:
+                break
+            for message in batch:
+                while in_flight and (
+                    in_flight >= concurrency or not _limits_allow_another(counts["sent"], counts["deferred"], in_flight)
+                ):
+                    in_flight -= 1
+                    await collect_result()
+                if _limits_reached(counts["sent"], counts["deferred"]):
+                    limits_reached = True
+                    break
+                if not _circuit_breaker_allows(breaker):
+                    limits_reached = True
+                    break
+                if not has_quota:
+                    if not await wait_for_quota():
+                        _release_probe(breaker)
+                        limits_reached = True
+                        break
+                    has_quota = True
+                delay = _rate_limit_delay(message)
+                if delay is not None:
+                    await sync_to_async(_hold_back)(message, delay)
+                    _release_probe(breaker)
+                    counts["skipped"] += 1
+                    continue
+                if not await sync_to_async(renew_lease)(message, owner):
+                    _release_probe(breaker)
+                    continue
+                has_quota = False
+                work_queue.put_nowait(message)
+                in_flight += 1
+                if throttle:
+                    await asyncio.sleep(throttle)
+
+        while in_flight:
+            in_flight -= 1
+            await collect_result()
+    finally:
+        for worker in workers:
+            work_queue.put_nowait(None)
+        await asyncio.gather(*workers, return_exceptions=True)
+        await sync_to_async(Message.objects.release_leases)(owner)
+        await sync_to_async(get_log_sink().flush)()
+        if use_file_lock:
+            release_lock(lock)
+
+    logger.info(
+        "Sent",
+        extra={
+            "sent": counts["sent"],
+            "deferred": counts["deferred"],
+            "skipped": counts["skipped"],
+            "duration": time.time() - start_time,
+        },
+    )
+    await sync_to_async(record_run_metrics)(time.time() - start_time)
+    return counts
+
+
+async def async_send_loop():
+    """
+    Loop indefinitely, checking queue at intervals of EMPTY_QUEUE_SLEEP and
+    sending messages if any are on queue.
+    """
+
+    while True:
+        while not await sync_to_async(prioritize().exists)():
+            sleep_time = await sync_to_async(empty_queue_sleep_time)()
+            logger.debug(f"sleeping for {sleep_time} seconds before checking queue again")
+            await asyncio.sleep(sleep_time)
+        wait = wait_for_rate_limits(await async_send_all())
+        if wait:
+            logger.debug(f"sleeping for {wait} seconds for rate limits")
+            await asyncio.sleep(wait)
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 
-from mailer.models import Message
+from mailer.models import Message, prerender_email
 
 
 class DbBackend(BaseEmailBackend):
@@ -9,6 +9,8 @@ class DbBackend(BaseEmailBackend):
         # allow for a custom batch size
         MESSAGES_BATCH_SIZE = getattr(settings, "MAILER_MESSAGES_BATCH_SIZE", None)
 
-        messages = Message.objects.bulk_create([Message(email=email) for email in email_messages], MESSAGES_BATCH_SIZE)
+        messages = Message.objects.bulk_create(
+            [Message(email=prerender_email(email)) for email in email_messages], MESSAGES_BATCH_SIZE
+        )
 
         return len(messages)
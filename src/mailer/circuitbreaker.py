@@ -0,0 +1,135 @@
+"""
+A circuit breaker for sending, configured with MAILER_CIRCUIT_BREAKER_THRESHOLD
+and MAILER_CIRCUIT_BREAKER_RESET_TIMEOUT.
+
+After `threshold` connection-level failures in a row, the breaker opens: the
+current run stops, leaving the remaining messages in the queue as they are,
+and later runs don't send anything for `reset_timeout` seconds. After that,
+the breaker is half open, and lets a single message through as a probe. If it
+is sent, the breaker closes again, otherwise it stays open for another
+`reset_timeout` seconds.
+"""
+
+import logging
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def is_connection_failure(exc):
+    """
+    Returns True if `exc` shows that the mail server couldn't be reached or
+    talked to, rather than that it turned down a message.
+    """
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+class CircuitBreaker:
+    """
+    Instances are safe to use from several threads.
+    """
+
+    def __init__(self, threshold, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # When the probe currently allowed through started, if any
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        """
+        Returns True if nothing may be sent until the reset timeout is over.
+        """
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the breaker lets a probe through,
+        or 0 if it isn't open.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        """
+        Returns True if a message may be sent. Once the breaker is half open,
+        only one message is allowed until its outcome is recorded.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            # A probe whose outcome never came, e.g. because the run was
+            # ended by an error, doesn't hold up the next one for ever.
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                return False
+            self.probe_started = now
+            return True
+
+    def record(self, exc=None):
+        """
+        Records the outcome of sending a message, given the error it failed
+        with, if any.
+        """
+        with self.lock:
+            if exc is not None and is_connection_failure(exc):
+                self.failures += 1
+                if self.opened_at is None and self.failures >= self.threshold:
+                    logger.warning(
+                        f"{self.failures} connection failures in a row, not sending for {self.reset_timeout} seconds"
+                    )
+                if self.opened_at is not None or self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+                    self.probe_started = None
+            else:
+                # The mail server answered, even if to turn the message down
+                if self.opened_at is not None:
+                    logger.info("connection to the mail server is back, sending again")
+                self.failures = 0
+                self.opened_at = None
+                self.probe_started = None
+
+    def release(self):
+        """
+        Lets another message through while half open, when the one allowed
+        wasn't sent after all, so there is no outcome to record.
+        """
+        with self.lock:
+            self.probe_started = None
+
+
+_circuit_breaker = None
+_circuit_breaker_config = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    Returns the CircuitBreaker for MAILER_CIRCUIT_BREAKER_THRESHOLD, shared by
+    the whole process so that it stays open between runs, or None if no
+    threshold is set.
+    """
+    global _circuit_breaker, _circuit_breaker_config
+
+    threshold = getattr(settings, "MAILER_CIRCUIT_BREAKER_THRESHOLD", None)
+    if not threshold:
+        return None
+    config = (threshold, getattr(settings, "MAILER_CIRCUIT_BREAKER_RESET_TIMEOUT", 60))
+    with _circuit_breaker_lock:
+        if _circuit_breaker is None or config != _circuit_breaker_config:
+            _circuit_breaker = CircuitBreaker(*config)
+            _circuit_breaker_config = config
+        return _circuit_breaker
@@ -1,7 +1,15 @@
+import collections
 import contextlib
+import datetime
+import itertools
 import logging
+import os
+import queue
 import smtplib
+import socket
+import threading
 import time
+import uuid
 from socket import error as socket_error
 
 import lockfile
@@ -9,12 +17,28 @@ from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import get_connection
-from django.core.mail.message import make_msgid
-from django.core.mail.utils import DNS_NAME
-from django.db import DatabaseError, NotSupportedError, OperationalError, transaction
+from django.db import DatabaseError, NotSupportedError, OperationalError, connections, transaction
+from django.db.models import Count, Min, Q
 from django.utils.module_loading import import_string
+from django.utils.timezone import now as datetime_now
 
-from mailer.models import RESULT_FAILURE, RESULT_SUCCESS, Message, MessageLog, get_message_id
+from mailer import metrics
+from mailer.circuitbreaker import get_circuit_breaker, is_connection_failure
+from mailer.logsinks import get_log_sink
+from mailer.models import (
+    PRIORITIES,
+    PRIORITY_DEFERRED,
+    RESULT_FAILURE,
+    RESULT_SUCCESS,
+    Message,
+    MessageLog,
+    attempt_due,
+    ensure_message_id,
+    lease_available,
+)
+from mailer.pool import close_connection, get_connection_pool
+from mailer.ratelimit import get_domain, get_rate_limiter, get_send_quota
+from mailer.routing import BackendRouter, get_router
 
 if DJANGO_VERSION[0] >= 2:
     NotSupportedFeatureException = NotSupportedError
@@ -33,16 +57,57 @@ LOCK_WAIT_TIMEOUT = getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", -1)
 # in the current working directory.
 LOCK_PATH = getattr(settings, "MAILER_LOCK_PATH", None)
 
+# how long (in seconds) a message claimed in batch claiming mode stays
+# reserved for its sender before others may claim it again.
+CLAIM_LEASE_SECONDS = getattr(settings, "MAILER_CLAIM_LEASE_SECONDS", 300)
+
+# batch size used for claiming messages when MAILER_CONCURRENCY is set, but
+# MAILER_CLAIM_BATCH_SIZE isn't.
+DEFAULT_CLAIM_BATCH_SIZE = 100
+
 logger = logging.getLogger(__name__)
 
 
 def prioritize(queryset=None):
     """
-    Returns the messages in the queue in the order they should be sent.
+    Returns the messages in the queue that are due, in the order they should
+    be sent.
     """
-    if queryset:
-        return queryset.order_by("priority", "when_added")
-    return Message.objects.non_deferred().order_by("priority", "when_added")
+    if queryset is None:
+        queryset = Message.objects.non_deferred()
+    return queryset.filter(attempt_due(datetime_now())).order_by("priority", "when_added", "id")
+
+
+# The columns needed to find and order a message in the queue, without its
+# (potentially large) message_data.
+QueueEntry = collections.namedtuple("QueueEntry", ["id", "priority", "when_added"])
+
+
+def iter_queue(queryset=None):
+    """
+    Yields a QueueEntry for each message in the queue, in the order they
+    should be sent.
+
+    The queue is read in chunks of MAILER_QUEUE_CHUNK_SIZE rows, each starting
+    after the last entry of the previous chunk, so memory use doesn't grow
+    with the size of the queue.
+    """
+    chunk_size = getattr(settings, "MAILER_QUEUE_CHUNK_SIZE", 500)
+    entries = prioritize(queryset).values_list(*QueueEntry._fields)
+    last = None
+    while True:
+        chunk = entries
+        if last is not None:
+            chunk = chunk.filter(
+                Q(priority__gt=last.priority)
+                | Q(priority=last.priority, when_added__gt=last.when_added)
+                | Q(priority=last.priority, when_added=last.when_added, id__gt=last.id)
+            )
+        rows = [QueueEntry(*row) for row in chunk[:chunk_size]]
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
 
 
 @contextlib.contextmanager
@@ -51,6 +116,9 @@ def sender_context(message):
     Makes a context manager appropriate for sending a message.
     Entering the context using `with` may return a `None` object if the message
     has been sent/deleted already.
+
+    Only the `id` of the given message is used, the message itself is loaded
+    again while locking it.
     """
     # We wrap each message sending inside a transaction (otherwise
     # select_for_update doesn't work).
@@ -66,10 +134,10 @@ def sender_context(message):
     with transaction.atomic():
         try:
             try:
-                yield Message.objects.filter(id=message.id).select_for_update(nowait=True).get()
+                yield _lock_message(Message.objects.filter(id=message.id).select_for_update(nowait=True))
             except NotSupportedFeatureException:
                 # MySQL
-                yield Message.objects.filter(id=message.id).select_for_update().get()
+                yield _lock_message(Message.objects.filter(id=message.id).select_for_update())
         except Message.DoesNotExist:
             # Deleted by someone else
             yield None
@@ -78,45 +146,326 @@ def sender_context(message):
             yield None
 
 
+def _lock_message(queryset):
+    with metrics.timer("claim_seconds"):
+        return queryset.get()
+
+
+def _get_concurrency():
+    # How many messages are sent in parallel, each by its own worker thread.
+    # Defaults to 1, i.e. send serially.
+    return getattr(settings, "MAILER_CONCURRENCY", None) or 1
+
+
+def _get_claim_batch_size():
+    # When set, messages are claimed in batches of this size with a single
+    # query, instead of being locked one by one.
+    claim_batch_size = getattr(settings, "MAILER_CLAIM_BATCH_SIZE", None)
+    if claim_batch_size is None and _get_concurrency() > 1:
+        # Worker threads use their own DB connections, so they can't take
+        # part in the per message transaction used by sender_context.
+        claim_batch_size = DEFAULT_CLAIM_BATCH_SIZE
+    return claim_batch_size
+
+
+def make_lease_owner():
+    """
+    Returns a string identifying this sender in the lease columns.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_messages(owner, batch_size, queryset=None):
+    """
+    Claims the next `batch_size` messages in the queue for `owner` and returns
+    them in the order they should be sent.
+
+    Claimed messages are stamped with a lease that expires after
+    MAILER_CLAIM_LEASE_SECONDS, so that messages held by a sender that crashed
+    become available again.
+    """
+    with metrics.timer("claim_seconds"):
+        now = datetime_now()
+        lease_expires = now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS)
+        candidates = prioritize(queryset).filter(lease_available(now))
+        db_features = connections[candidates.db].features
+        candidate_ids = candidates.values_list("id", flat=True)
+
+        if db_features.has_select_for_update_skip_locked:
+            # PostgreSQL, MySQL 8+, Oracle: rows locked by a competing sender
+            # are simply skipped, rather than waited for.
+            with transaction.atomic(using=candidates.db):
+                ids = list(candidate_ids.select_for_update(skip_locked=True)[:batch_size])
+                Message.objects.filter(id__in=ids).update(lease_owner=owner, lease_expires=lease_expires)
+        else:
+            # Two senders may pick the same rows here, but the lease condition is
+            # repeated in the UPDATE, so only one of them can win each row.
+            ids = list(candidate_ids[:batch_size])
+            Message.objects.filter(lease_available(now), id__in=ids).update(
+                lease_owner=owner, lease_expires=lease_expires
+            )
+
+        if not ids:
+            return []
+        return list(Message.objects.filter(id__in=ids, lease_owner=owner).order_by("priority", "when_added", "id"))
+
+
+def recipient_domains(message):
+    """
+    Returns the recipient domains of `message`, the key used by
+    MAILER_GROUP_BY = "domain".
+    """
+    email = message.email
+    if email is None:
+        return ""
+    return ",".join(sorted({get_domain(recipient) for recipient in email.recipients()}))
+
+
+def _get_group_key():
+    group_by = getattr(settings, "MAILER_GROUP_BY", None)
+    if group_by is None:
+        return None
+    if group_by == "domain":
+        return recipient_domains
+    return import_string(group_by)
+
+
+def group_messages(messages, key, window):
+    """
+    Reorders messages, given in the order they should be sent, so that those
+    with the same `key` are sent one after the other. Messages are only moved
+    within runs of up to `window` messages of the same priority. Groups are
+    sent in the order of their first message, and keep their own order.
+    """
+    grouped = []
+    for priority, band in itertools.groupby(messages, key=lambda message: message.priority):
+        band = list(band)
+        for i in range(0, len(band), window):
+            groups = {}
+            for message in band[i : i + window]:
+                groups.setdefault(key(message), []).append(message)
+            for group in groups.values():
+                grouped.extend(group)
+    return grouped
+
+
+def claim_grouped_messages(owner, batch_size, queryset=None):
+    """
+    Like claim_messages, grouping the batch by MAILER_GROUP_BY if it is set.
+    """
+    batch = claim_messages(owner, batch_size, queryset)
+    key = _get_group_key()
+    if key is None:
+        return batch
+    return group_messages(batch, key, getattr(settings, "MAILER_GROUP_WINDOW", 100))
+
+
+def renew_lease(message, owner):
+    """
+    Extends the lease `owner` holds on a claimed message by another
+    MAILER_CLAIM_LEASE_SECONDS. Returns False if the lease has expired, in
+    which case another sender may have claimed the message, and it must not
+    be sent.
+    """
+    now = datetime_now()
+    lease_expires = now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS)
+    renewed = Message.objects.filter(id=message.id, lease_owner=owner, lease_expires__gt=now).update(
+        lease_expires=lease_expires
+    )
+    if not renewed:
+        logger.info(f"lease on message {message.id} expired, leaving it to other senders")
+        return False
+    message.lease_expires = lease_expires
+    return True
+
+
+@contextlib.contextmanager
+def leased_context(message, owner):
+    """
+    Makes a context manager for sending a message claimed by `claim_messages`.
+    The message is already reserved for us, so no locking is needed, but the
+    lease is renewed first, since the end of a batch may be reached after it
+    expired. Entering the context returns None if the lease was lost.
+    """
+    yield message if renew_lease(message, owner) else None
+
+
+def _queue_parts(queryset):
+    """
+    Returns the parts of the queue to go through one after another, as
+    (queryset, once) tuples.
+
+    Deferred messages in a given queryset (e.g. from the admin) are sent too,
+    but only once. Since they come last, they are set aside before the run,
+    so that messages deferred during it aren't picked up again by a later
+    chunk or batch.
+    """
+    if queryset is None:
+        return [(None, False)]
+    deferred_ids = list(queryset.filter(priority=PRIORITY_DEFERRED).values_list("id", flat=True))
+    parts = [(queryset.exclude(priority=PRIORITY_DEFERRED), False)]
+    if deferred_ids:
+        parts.append((Message.objects.filter(id__in=deferred_ids), True))
+    return parts
+
+
+def claim_batches(owner, batch_size, queryset=None):
+    """
+    Yields batches of messages claimed for `owner` by claim_grouped_messages,
+    until there are none left to send.
+    """
+    for part, once in _queue_parts(queryset):
+        while True:
+            batch = claim_grouped_messages(owner, batch_size, part)
+            if not batch:
+                break
+            if once:
+                # Messages deferred again would be claimed again otherwise
+                part = part.exclude(id__in=[message.id for message in batch])
+            yield batch
+
+
 def get_messages_for_sending(queryset=None):
     """
     Returns a series of context managers that are used for sending mails in the queue.
     Entering the context manager returns the actual message
     """
-    for message in prioritize(queryset):
-        yield sender_context(message)
+    claim_batch_size = _get_claim_batch_size()
 
+    if claim_batch_size is None:
+        for part, once in _queue_parts(queryset):
+            for entry in iter_queue(part):
+                yield sender_context(entry)
+        return
 
-def ensure_message_id(msg):
-    if get_message_id(msg) is None:
-        # Use cached DNS_NAME for performance
-        msg.extra_headers["Message-ID"] = make_msgid(domain=DNS_NAME)
+    owner = make_lease_owner()
+    try:
+        for batch in claim_batches(owner, claim_batch_size, queryset):
+            for message in batch:
+                yield leased_context(message, owner)
+    finally:
+        # Anything we claimed but didn't get to (e.g. because a limit was
+        # reached) goes back to the queue straight away.
+        Message.objects.release_leases(owner)
 
 
-def _limits_reached(sent, deferred):
+def _get_limits():
     # Allow sending a fixed/limited amount of emails in each delivery run
     # defaults to None which means send everything in the queue
     EMAIL_MAX_BATCH = getattr(settings, "MAILER_EMAIL_MAX_BATCH", None)
 
-    if EMAIL_MAX_BATCH is not None and sent >= EMAIL_MAX_BATCH:
-        logger.info("EMAIL_MAX_BATCH (%s) reached, stopping for this round", EMAIL_MAX_BATCH)
-        return True
-
     # Stop sending emails in the current round if more than X emails get
     # deferred - defaults to None which means keep going regardless
     EMAIL_MAX_DEFERRED = getattr(settings, "MAILER_EMAIL_MAX_DEFERRED", None)
 
+    return EMAIL_MAX_BATCH, EMAIL_MAX_DEFERRED
+
+
+def _limits_reached(sent, deferred):
+    EMAIL_MAX_BATCH, EMAIL_MAX_DEFERRED = _get_limits()
+
+    if EMAIL_MAX_BATCH is not None and sent >= EMAIL_MAX_BATCH:
+        logger.info("EMAIL_MAX_BATCH (%s) reached, stopping for this round", EMAIL_MAX_BATCH)
+        return True
+
     if EMAIL_MAX_DEFERRED is not None and deferred >= EMAIL_MAX_DEFERRED:
         logger.warning("EMAIL_MAX_DEFERRED (%s) reached, stopping for this round", EMAIL_MAX_DEFERRED)
         return True
 
 
-def _throttle_emails():
+def _limits_allow_another(sent, deferred, in_flight):
+    # Each message in flight may still end up sent or deferred, so only start
+    # another one if neither limit could be overshot by doing so.
+    EMAIL_MAX_BATCH, EMAIL_MAX_DEFERRED = _get_limits()
+
+    if EMAIL_MAX_BATCH is not None and sent + in_flight >= EMAIL_MAX_BATCH:
+        return False
+    if EMAIL_MAX_DEFERRED is not None and deferred + in_flight >= EMAIL_MAX_DEFERRED:
+        return False
+    return True
+
+
+def _rate_limit_delay(message):
+    """
+    Returns None if the message can be sent, taking its tokens, or the number
+    of seconds it has to wait, because a recipient domain has reached its
+    MAILER_DOMAIN_RATE_LIMITS rate.
+    """
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is None:
+        return None
+    email = message.email
+    if email is None or rate_limiter.acquire(email.recipients()):
+        return None
+    return rate_limiter.hold(email.recipients())
+
+
+def _hold_back(message, delay):
+    """
+    Leaves a rate limited message in the queue, but out of the due set until
+    `delay` has passed, so that runs in the meantime don't load it again just
+    to skip it.
+    """
+    message.next_attempt_at = datetime_now() + datetime.timedelta(seconds=delay)
+    Message.objects.filter(id=message.id).update(next_attempt_at=message.next_attempt_at)
+    metrics.increment("messages", result="skipped")
+
+
+def _record_sent(message):
+    metrics.increment("messages", result="sent")
+    if metrics.enabled():
+        metrics.observe("enqueue_to_send_seconds", (datetime_now() - message.when_added).total_seconds())
+
+
+def record_run_metrics(duration):
+    """
+    Records how long a run of send_all() took and the number of messages left
+    in the queue for each priority, then flushes the metrics exporters.
+    """
+    if not metrics.enabled():
+        return
+    metrics.observe("run_seconds", duration)
+    depths = dict(Message.objects.order_by().values_list("priority").annotate(Count("id")))
+    for priority, name in PRIORITIES:
+        metrics.gauge("queue_depth", depths.get(priority, 0), priority=name)
+    metrics.flush()
+
+
+def _get_quota_max_wait():
+    # How long to wait for MAILER_SEND_QUOTAS to allow another message before
+    # ending the run instead.
+    return getattr(settings, "MAILER_SEND_QUOTA_MAX_WAIT", 5)
+
+
+def _wait_for_quota(sender=None):
+    """
+    Waits until MAILER_SEND_QUOTAS allow another message to be sent. Returns
+    False, without waiting, if that would take too long. Outcomes buffered by
+    `sender` that are due in the meantime are written before waiting.
+    """
+    send_quota = get_send_quota()
+    if send_quota is None:
+        return True
+    while True:
+        wait = send_quota.acquire()
+        if not wait:
+            return True
+        if wait > _get_quota_max_wait():
+            logger.info(f"send quota reached, stopping for {wait:.1f} seconds")
+            return False
+        if sender is not None:
+            sender.flush_due(wait)
+        time.sleep(wait)
+
+
+def _throttle_emails(sender=None):
     # When delivering, wait some time between emails to avoid server overload
     # defaults to 0 for no waiting
     EMAIL_THROTTLE = getattr(settings, "MAILER_EMAIL_THROTTLE", 0)
 
     if EMAIL_THROTTLE:
+        if sender is not None:
+            sender.flush_due(EMAIL_THROTTLE)
         logger.debug("Throttling email delivery. Sleeping %s seconds", EMAIL_THROTTLE)
         time.sleep(EMAIL_THROTTLE)
 
@@ -146,6 +495,290 @@ def handle_delivery_exception(connection, message, exc):
     raise exc
 
 
+class Finalizer:
+    """
+    Buffers the outcome of sent messages, so that their MessageLog entries
+    are handed to the log sink together (one bulk INSERT by default), and the
+    messages removed from the queue with one DELETE.
+
+    The buffer is flushed when it holds `batch_size` messages, or when the
+    oldest message in it has waited for `interval` seconds. Since the latter
+    is only checked when a message is added, callers about to wait must call
+    flush_due() themselves.
+    """
+
+    def __init__(self, batch_size, interval=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log_entries = []
+        self.message_ids = []
+        self.oldest = None
+
+    def add(self, message, log_entry=None):
+        if log_entry is not None:
+            self.log_entries.append(log_entry)
+        self.message_ids.append(message.id)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(self.message_ids) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_due()
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the buffer is due to be flushed,
+        or None if it is empty.
+        """
+        if self.oldest is None or self.interval is None:
+            return None
+        return max(0.0, self.oldest + self.interval - time.monotonic())
+
+    def flush_due(self, wait=0):
+        """
+        Flushes the buffer if it is due to be, or will be after waiting for
+        another `wait` seconds.
+        """
+        wait_time = self.wait_time()
+        if wait_time is not None and wait_time <= wait:
+            self.flush()
+
+    def flush(self):
+        if not self.message_ids:
+            return
+        with transaction.atomic(using=Message.objects.db):
+            if self.log_entries:
+                MessageLog.objects.log_many(self.log_entries)
+            Message.objects.filter(id__in=self.message_ids).delete()
+        self.log_entries = []
+        self.message_ids = []
+        self.oldest = None
+
+
+def make_finalizer(leased):
+    """
+    Returns a Finalizer as configured by MAILER_FINALIZE_BATCH_SIZE and
+    MAILER_FINALIZE_INTERVAL, or None if outcomes are to be written
+    immediately.
+
+    Buffering outcomes means sent messages stay in the queue for a while,
+    which is only safe if they are `leased` to us, not just locked while
+    being sent.
+    """
+    batch_size = getattr(settings, "MAILER_FINALIZE_BATCH_SIZE", None)
+    if batch_size is None or not leased:
+        return None
+    return Finalizer(batch_size, getattr(settings, "MAILER_FINALIZE_INTERVAL", 1))
+
+
+class MessageSender:
+    """
+    Sends messages one at a time through the given backend, keeping a
+    single backend connection open for as long as it can be reused, and
+    taking it from, and returning it to, the connection pool if there is one.
+    """
+
+    def __init__(self, backend, error_handler, options=None):
+        self.backend = backend
+        self.options = options or {}
+        self.error_handler = error_handler
+        self.finalizer = make_finalizer(leased=_get_claim_batch_size() is not None)
+        self.connection = None
+        self.connection_opened_at = None
+        self.connection_pooled = False
+        self.connection_uses = 0
+        self.pool = get_connection_pool()
+        self.pool_key = (backend, repr(sorted(self.options.items())))
+        # Reconnect after this many messages, defaults to None which means
+        # keep using the connection until it fails.
+        self.max_connection_uses = getattr(settings, "MAILER_CONNECTION_MAX_MESSAGES", None)
+        # The error the last message failed with, if any
+        self.last_error = None
+
+    def get_connection(self):
+        if self.connection is None:
+            connection = None
+            if self.pool is not None:
+                connection, self.connection_opened_at = self.pool.checkout(self.pool_key)
+            self.connection_pooled = connection is not None
+            if connection is None:
+                connection = get_connection(backend=self.backend, **self.options)
+                connection.open()
+                self.connection_opened_at = time.monotonic()
+            metrics.increment("connections", source="pool" if self.connection_pooled else "new")
+            self.connection = connection
+            self.connection_uses = 0
+        return self.connection
+
+    def flush_wait_time(self):
+        """
+        Returns the number of seconds until buffered outcomes are due to be
+        written, or None if there are none.
+        """
+        if self.finalizer is None:
+            return None
+        return self.finalizer.wait_time()
+
+    def flush_due(self, wait=0):
+        if self.finalizer is not None:
+            self.finalizer.flush_due(wait)
+
+    def close(self):
+        if self.finalizer is not None:
+            self.finalizer.flush()
+        if self.connection is not None:
+            if self.pool is None or not self.pool.checkin(self.pool_key, self.connection, self.connection_opened_at):
+                close_connection(self.connection)
+            self.connection = None
+
+    def finish(self, message, result_code=None):
+        """
+        Removes a processed message from the queue, logging the given result
+        """
+        if self.finalizer is not None:
+            log_entry = MessageLog.objects.build(message, result_code) if result_code else None
+            self.finalizer.add(message, log_entry)
+            return
+        if result_code:
+            MessageLog.objects.log(message, result_code)
+        message.delete()
+
+    def send(self, message):
+        """
+        Sends the message and removes it from the queue, or passes it to the
+        error handler if sending fails.
+
+        Returns the action taken ("sent" or "deferred"), or None if the message
+        was discarded because it couldn't be loaded from the DB.
+        """
+        self.last_error = None
+        try:
+            connection = self.get_connection()
+            logger.info(f"sending message '{message.subject}' to {', '.join(map(str, message.to_addresses))}")
+            email = message.email
+            if email is not None:
+                email.connection = connection
+                ensure_message_id(email)
+                with metrics.timer("smtp_transaction_seconds"):
+                    email.send()
+
+                # connection can't be stored in the MessageLog
+                email.connection = None
+                message.email = email  # For the sake of MessageLog
+                self.finish(message, RESULT_SUCCESS)
+                action_taken = "sent"
+                _record_sent(message)
+                self.connection_uses += 1
+                if self.max_connection_uses is not None and self.connection_uses >= self.max_connection_uses:
+                    close_connection(self.connection)
+                    self.connection = None
+            else:
+                logger.warning(
+                    f"message discarded due to failure in converting from DB. Added on "
+                    f"'{message.when_added}' with priority '{message.priority}'"
+                )  # noqa
+                self.finish(message)
+                action_taken = None
+
+        except Exception as err:
+            if self.connection_pooled and self.connection_uses == 0 and is_connection_failure(err):
+                # The server dropped the connection while it was in the pool,
+                # try again with another one.
+                logger.debug(f"pooled connection failed, reconnecting: {err}")
+                close_connection(self.connection)
+                self.connection = None
+                return self.send(message)
+            action_taken = self.handle_error(message, err)
+
+        return action_taken
+
+    def handle_error(self, message, err):
+        """
+        Passes a message that failed to send to the error handler, and
+        returns the action it took.
+        """
+        self.last_error = err
+        metrics.increment("send_failures", error=type(err).__name__)
+        failed_connection = self.connection
+        self.connection, action_taken = self.error_handler(self.connection, message, err)
+        if failed_connection is not None and self.connection is not failed_connection:
+            close_connection(failed_connection)
+        if self.connection is not None and self.connection is not failed_connection:
+            self.connection_uses = 0
+        if action_taken is not None:
+            metrics.increment("messages", result=action_taken)
+        return action_taken
+
+
+class RoutedMessageSender:
+    """
+    Sends messages through the backends picked by a BackendRouter, with a
+    MessageSender, and so a connection, for each backend.
+
+    If a backend can't be connected to, the message fails over to another
+    one it may be sent through. Failures after connecting aren't retried
+    elsewhere, since the message may have been delivered in part.
+    """
+
+    def __init__(self, router, error_handler):
+        self.router = router
+        self.error_handler = error_handler
+        self.senders = {}
+        # The error the last message failed with, if any
+        self.last_error = None
+
+    def get_sender(self, route):
+        if route.name not in self.senders:
+            self.senders[route.name] = MessageSender(route.backend, self.error_handler, route.options)
+        return self.senders[route.name]
+
+    def flush_wait_time(self):
+        wait_times = [sender.flush_wait_time() for sender in self.senders.values()]
+        return min((wait_time for wait_time in wait_times if wait_time is not None), default=None)
+
+    def flush_due(self, wait=0):
+        for sender in self.senders.values():
+            sender.flush_due(wait)
+
+    def close(self):
+        for sender in self.senders.values():
+            sender.close()
+
+    def send(self, message):
+        self.last_error = None
+        tried = []
+        while True:
+            route = self.router.acquire(message, exclude=tried)
+            sender = self.get_sender(route)
+            try:
+                try:
+                    sender.get_connection()
+                except Exception as err:
+                    self.router.record(route, err)
+                    tried.append(route)
+                    if self.router.candidates(message, exclude=tried):
+                        logger.warning(f"could not connect to email backend '{route.name}', failing over: {err}")
+                        continue
+                    self.last_error = err
+                    return sender.handle_error(message, err)
+                action_taken = sender.send(message)
+                self.last_error = sender.last_error
+                self.router.record(route, sender.last_error)
+                return action_taken
+            finally:
+                self.router.release(route)
+
+
+def make_sender(backend, error_handler):
+    """
+    Returns a sender for `backend`, the dotted path of an email backend, or a
+    BackendRouter.
+    """
+    if isinstance(backend, BackendRouter):
+        return RoutedMessageSender(backend, error_handler)
+    return MessageSender(backend, error_handler)
+
+
 def acquire_lock():
     logger.debug("acquiring lock...")
     if LOCK_PATH is not None:
@@ -182,9 +815,176 @@ def _require_no_backend_loop(mailer_email_backend):
         )
 
 
+def _circuit_breaker_allows(breaker):
+    if breaker is None or breaker.allow():
+        return True
+    logger.warning("circuit breaker open, stopping for this round")
+    return False
+
+
+def _release_probe(breaker):
+    # The message the circuit breaker allowed isn't sent after all
+    if breaker is not None:
+        breaker.release()
+
+
+def _record_outcome(breaker, action_taken, err):
+    """
+    Records the outcome of a send attempt with the circuit breaker. Messages
+    discarded without one say nothing about the mail server.
+    """
+    if breaker is None:
+        return
+    if action_taken is None and err is None:
+        _release_probe(breaker)
+    else:
+        breaker.record(err)
+
+
+def _send_serially(messages, backend, error_handler, counts):
+    sender = make_sender(backend, error_handler)
+    breaker = get_circuit_breaker()
+    # The circuit breaker is asked first, so that no quota or rate limit token
+    # is used up when it stops the run. Quota is taken before entering the
+    # context of a message, so that no lock or transaction is held while
+    # waiting for it. If the message isn't sent after all, it carries over to
+    # the next one.
+    has_quota = False
+    try:
+        for context in messages:
+            if not _circuit_breaker_allows(breaker):
+                break
+            if not has_quota:
+                if not _wait_for_quota(sender):
+                    _release_probe(breaker)
+                    break
+                has_quota = True
+            with context as message:
+                if message is None:
+                    # We didn't acquire the lock
+                    _release_probe(breaker)
+                    continue
+                delay = _rate_limit_delay(message)
+                if delay is not None:
+                    # Left in the queue, for a later run
+                    _hold_back(message, delay)
+                    _release_probe(breaker)
+                    counts["skipped"] += 1
+                    continue
+                has_quota = False
+                action_taken = sender.send(message)
+                _record_outcome(breaker, action_taken, sender.last_error)
+                if action_taken is not None:
+                    counts[action_taken] += 1
+
+            # Check if we reached the limits for the current run
+            if _limits_reached(counts["sent"], counts["deferred"]):
+                _throttle_emails()
+                break
+
+            _throttle_emails(sender)
+    finally:
+        sender.close()
+
+
+def _send_concurrently(messages, backend, error_handler, counts, concurrency):
+    """
+    Hands messages out to `concurrency` worker threads, each with its own
+    backend connection and DB connection. Results are counted, and limits
+    checked, in the calling thread only.
+    """
+    work_queue = queue.Queue()
+    results_queue = queue.Queue()
+    breaker = get_circuit_breaker()
+
+    def worker():
+        sender = make_sender(backend, error_handler)
+        try:
+            while True:
+                try:
+                    # Wake up to write buffered outcomes when they are due
+                    message = work_queue.get(timeout=sender.flush_wait_time())
+                except queue.Empty:
+                    sender.flush_due()
+                    continue
+                if message is None:
+                    break
+                try:
+                    action_taken = sender.send(message)
+                    _record_outcome(breaker, action_taken, sender.last_error)
+                    results_queue.put((action_taken, None))
+                except Exception as err:
+                    # Raised by the error handler, passed on to the caller
+                    # of send_all as when sending serially.
+                    results_queue.put((None, err))
+        finally:
+            sender.close()
+            connections.close_all()
+
+    def collect_result():
+        action_taken, err = results_queue.get()
+        if err is not None:
+            raise err
+        if action_taken is not None:
+            counts[action_taken] += 1
+
+    workers = [threading.Thread(target=worker, daemon=True) for i in range(concurrency)]
+    for thread in workers:
+        thread.start()
+
+    in_flight = 0
+    # As in _send_serially, the limits of the run and the circuit breaker are
+    # checked before taking quota, outside the context of a message.
+    has_quota = False
+    try:
+        for context in messages:
+            while in_flight and (
+                in_flight >= concurrency or not _limits_allow_another(counts["sent"], counts["deferred"], in_flight)
+            ):
+                in_flight -= 1
+                collect_result()
+            if _limits_reached(counts["sent"], counts["deferred"]):
+                break
+            if not _circuit_breaker_allows(breaker):
+                break
+            if not has_quota:
+                if not _wait_for_quota():
+                    _release_probe(breaker)
+                    break
+                has_quota = True
+            with context as message:
+                if message is None:
+                    _release_probe(breaker)
+                    continue
+                delay = _rate_limit_delay(message)
+                if delay is not None:
+                    _hold_back(message, delay)
+                    _release_probe(breaker)
+                    counts["skipped"] += 1
+                    continue
+                has_quota = False
+                work_queue.put(message)
+                in_flight += 1
+
+            _throttle_emails()
+
+        while in_flight:
+            in_flight -= 1
+            collect_result()
+    finally:
+        for thread in workers:
+            work_queue.put(None)
+        for thread in workers:
+            thread.join()
+
+
 def send_all(queryset=None):
     """
     Send all eligible messages in the queue.
+
+    Returns a dict of the number of messages "sent", "deferred", and
+    "skipped" because of rate limits, or None if the lock couldn't be
+    acquired.
     """
     # The actual backend to use for sending, defaulting to the Django default.
     # To make testing easier this is not stored at module level.
@@ -197,6 +997,20 @@ def send_all(queryset=None):
 
     _require_no_backend_loop(mailer_email_backend)
 
+    # Leave the queue alone while the mail server is known to be unreachable
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.is_open():
+        logger.info(f"circuit breaker open, not sending for {breaker.wait_time():.1f} seconds")
+        return {"deferred": 0, "sent": 0, "skipped": 0}
+
+    # Several backends to route messages between, replacing
+    # MAILER_EMAIL_BACKEND if set.
+    router = get_router()
+    if router is not None:
+        for route in router.routes:
+            _require_no_backend_loop(route.backend)
+        mailer_email_backend = router
+
     if use_file_lock:
         acquired, lock = acquire_lock()
         if not acquired:
@@ -204,49 +1018,18 @@ def send_all(queryset=None):
 
     start_time = time.time()
 
-    counts = {"deferred": 0, "sent": 0}
+    counts = {"deferred": 0, "sent": 0, "skipped": 0}
 
+    concurrency = _get_concurrency()
+    messages = get_messages_for_sending(queryset)
     try:
-        connection = None
-        for context in get_messages_for_sending(queryset):
-            with context as message:
-                if message is None:
-                    # We didn't acquire the lock
-                    continue
-                try:
-                    if connection is None:
-                        connection = get_connection(backend=mailer_email_backend)
-                    logger.info(f"sending message '{message.subject}' to {', '.join(map(str, message.to_addresses))}")
-                    email = message.email
-                    if email is not None:
-                        email.connection = connection
-                        ensure_message_id(email)
-                        email.send()
-
-                        # connection can't be stored in the MessageLog
-                        email.connection = None
-                        message.email = email  # For the sake of MessageLog
-                        MessageLog.objects.log(message, RESULT_SUCCESS)
-                        counts["sent"] += 1
-                    else:
-                        logger.warning(
-                            f"message discarded due to failure in converting from DB. Added on "
-                            f"'{message.when_added}' with priority '{message.priority}'"
-                        )  # noqa
-                    message.delete()
-
-                except Exception as err:
-                    connection, action_taken = error_handler(connection, message, err)
-                    counts[action_taken] += 1
-
-            # Check if we reached the limits for the current run
-            if _limits_reached(counts["sent"], counts["deferred"]):
-                _throttle_emails()
-                break
-
-            _throttle_emails()
-
+        if concurrency > 1:
+            _send_concurrently(messages, mailer_email_backend, error_handler, counts, concurrency)
+        else:
+            _send_serially(messages, mailer_email_backend, error_handler, counts)
     finally:
+        messages.close()
+        get_log_sink().flush()
         if use_file_lock:
             release_lock(lock)
 
@@ -255,9 +1038,46 @@ def send_all(queryset=None):
         extra={
             "sent": counts["sent"],
             "deferred": counts["deferred"],
+            "skipped": counts["skipped"],
             "duration": time.time() - start_time,
         },
     )
+    record_run_metrics(time.time() - start_time)
+    return counts
+
+
+def wait_for_rate_limits(counts):
+    """
+    Returns how long to wait before the next run, if the last one was ended
+    by MAILER_SEND_QUOTAS or the circuit breaker, or only skipped messages
+    because of rate limits.
+    """
+    wait = 0
+    breaker = get_circuit_breaker()
+    if breaker is not None:
+        wait = breaker.wait_time()
+    send_quota = get_send_quota()
+    if send_quota is not None:
+        wait = max(wait, send_quota.wait_time())
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is not None and counts and counts["skipped"] and not counts["sent"] and not counts["deferred"]:
+        wait = max(wait, rate_limiter.wait_time())
+    return min(wait, EMPTY_QUEUE_SLEEP)
+
+
+def empty_queue_sleep_time():
+    """
+    Returns how long to sleep before checking an empty queue again, which is
+    EMPTY_QUEUE_SLEEP, unless a message held back by rate limits or retry
+    backoff becomes due before that.
+    """
+    now = datetime_now()
+    next_attempt_at = (
+        Message.objects.non_deferred().filter(next_attempt_at__gt=now).aggregate(Min("next_attempt_at"))
+    )["next_attempt_at__min"]
+    if next_attempt_at is None:
+        return EMPTY_QUEUE_SLEEP
+    return min((next_attempt_at - now).total_seconds(), EMPTY_QUEUE_SLEEP)
 
 
 def send_loop():
@@ -267,7 +1087,11 @@ def send_loop():
     """
 
     while True:
-        while not Message.objects.non_deferred().exists():
-            logger.debug(f"sleeping for {EMPTY_QUEUE_SLEEP} seconds before checking queue again")
-            time.sleep(EMPTY_QUEUE_SLEEP)
-        send_all()
+        while not prioritize().exists():
+            sleep_time = empty_queue_sleep_time()
+            logger.debug(f"sleeping for {sleep_time} seconds before checking queue again")
+            time.sleep(sleep_time)
+        wait = wait_for_rate_limits(send_all())
+        if wait:
+            logger.debug(f"sleeping for {wait} seconds for rate limits")
+            time.sleep(wait)
@@ -0,0 +1,221 @@
+"""
+Destinations for MessageLog entries, selected with MAILER_LOG_SINK.
+
+Entries are handed to the sink as unsaved MessageLog instances. Sinks buffer
+them, and write them out when `batch_size` entries are waiting, or, if
+`flush_interval` is set, from a background thread every `flush_interval`
+seconds, so that writing logs doesn't hold up sending.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class BaseLogSink:
+    """
+    Base class for log sinks.
+
+    Subclasses must overwrite write_entries().
+    """
+
+    def __init__(self, batch_size=1, flush_interval=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        # Serializes write_entries() calls from the sending and flusher threads
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.flusher = None
+
+    def write(self, log_entry):
+        self.write_many([log_entry])
+
+    def write_many(self, log_entries):
+        with self.lock:
+            self.buffer.extend(log_entries)
+            full = len(self.buffer) >= self.batch_size
+        if self.flush_interval is None:
+            if full:
+                self.flush()
+        else:
+            self._start_flusher()
+            if full:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                log_entries, self.buffer = self.buffer, []
+            if log_entries:
+                self.write_entries(log_entries)
+
+    def close(self):
+        """
+        Stops the background flusher, if any, and writes out what is left.
+        """
+        flusher = self.flusher
+        if flusher is not None:
+            self.stopped = True
+            self.wakeup.set()
+            flusher.join()
+            self.flusher = None
+        self.flush()
+
+    def write_entries(self, log_entries):
+        """
+        Write out a list of MessageLog instances.
+        """
+        raise NotImplementedError("subclasses of BaseLogSink must override write_entries() method")
+
+    def _start_flusher(self):
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.stopped = False
+            self.flusher = threading.Thread(target=self._run_flusher, name="mailer-log-flusher", daemon=True)
+            self.flusher.start()
+
+    def _run_flusher(self):
+        try:
+            while not self.stopped:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("error writing message log entries")
+        finally:
+            connections.close_all()
+
+
+class DatabaseLogSink(BaseLogSink):
+    """
+    Saves entries to the MessageLog table, with one bulk INSERT per batch.
+    """
+
+    def write_entries(self, log_entries):
+        from mailer.models import MessageLog
+
+        MessageLog.objects.bulk_create(log_entries)
+
+
+class JSONLinesLogSink(BaseLogSink):
+    """
+    Appends entries to the file at `path`, one JSON object per line, without
+    the message data.
+
+    When the file would grow beyond `max_bytes`, it is renamed to `path`.1
+    (and so on, up to `backup_count`) and a new one is started, like
+    logging.handlers.RotatingFileHandler does. A `max_bytes` of 0 means the
+    file is never rotated.
+    """
+
+    def __init__(self, path, max_bytes=0, backup_count=5, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.stream = None
+
+    def write_entries(self, log_entries):
+        data = "".join(json.dumps(entry_to_dict(log_entry)) + "\n" for log_entry in log_entries).encode("utf-8")
+        if self.stream is None:
+            self.stream = open(self.path, "ab")
+        if self.max_bytes and self.stream.tell() and self.stream.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def rotate(self):
+        self.stream.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.stream = open(self.path, "ab")
+
+    def close(self):
+        super().close()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class NullLogSink(BaseLogSink):
+    """
+    Discards all entries.
+    """
+
+    def write_many(self, log_entries):
+        pass
+
+    def write_entries(self, log_entries):
+        pass
+
+
+def entry_to_dict(log_entry):
+    return {
+        "message_id": log_entry.message_id,
+        "when_added": log_entry.when_added.isoformat(),
+        "when_attempted": log_entry.when_attempted.isoformat(),
+        "priority": log_entry.priority,
+        "result": log_entry.result,
+        "log_message": log_entry.log_message,
+    }
+
+
+_log_sink = None
+_log_sink_config = None
+_log_sink_lock = threading.Lock()
+
+
+def get_log_sink():
+    """
+    Returns the sink configured by MAILER_LOG_SINK and MAILER_LOG_SINK_OPTIONS,
+    shared by the whole process.
+    """
+    global _log_sink, _log_sink_config
+
+    config = (
+        getattr(settings, "MAILER_LOG_SINK", "mailer.logsinks.DatabaseLogSink"),
+        getattr(settings, "MAILER_LOG_SINK_OPTIONS", {}),
+    )
+    with _log_sink_lock:
+        if _log_sink is None or config != _log_sink_config:
+            if _log_sink is not None:
+                _log_sink.close()
+            path, options = config
+            _log_sink = import_string(path)(**options)
+            _log_sink_config = config
+        return _log_sink
+
+
+def close_log_sink():
+    """
+    Writes out any buffered entries, and stops the background flusher.
+    """
+    global _log_sink, _log_sink_config
+
+    with _log_sink_lock:
+        if _log_sink is not None:
+            _log_sink.close()
+        _log_sink = None
+        _log_sink_config = None
+
+
+atexit.register(close_log_sink)
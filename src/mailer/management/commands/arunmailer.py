@@ -0,0 +1,31 @@
+import asyncio
+import logging
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+
+from django.core.management import BaseCommand
+
+
+class Command(BaseCommand):
+    """Start the django-mailer asyncio send loop"""
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument("--debug", action="store_true", help="Increase logging level for django_mailer to DEBUG")
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        from mailer.async_engine import async_send_loop
+
+        if options["debug"]:
+            for name in ["mailer.engine", "mailer.async_engine"]:
+                logger = logging.getLogger(name)
+                logger.setLevel(logging.DEBUG)
+                for handler in logger.handlers:
+                    handler.level = logging.DEBUG
+
+        self.stdout.write(datetime.now().strftime("%B %d, %Y - %X"))
+        self.stdout.write("Starting django-mailer asyncio send loop.")
+        quit_command = "CTRL-BREAK" if sys.platform == "win32" else "CONTROL-C"
+        self.stdout.write(f"Quit the loop with {quit_command}.")
+        asyncio.run(async_send_loop())
@@ -0,0 +1,48 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from mailer.models import Message, MessageLog, db_to_email, email_to_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Convert stored messages and message logs to the binary message data format"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rows to convert per query (default: 500)",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        for model in [Message, MessageLog]:
+            count = convert_to_binary(model, batch_size)
+            logger.info(f"{count} {model._meta.verbose_name_plural} converted")
+
+
+def convert_to_binary(model, batch_size):
+    """
+    Moves the base64 encoded data of `model` rows to the binary column, one
+    chunk of `batch_size` rows at a time. Returns the number of rows converted.
+    """
+    legacy = model.objects.filter(message_blob__isnull=True, message_data__isnull=False).exclude(message_data="")
+    converted = 0
+    last_id = 0
+    while True:
+        rows = list(legacy.filter(id__gt=last_id).order_by("id").only("id", "message_data")[:batch_size])
+        if not rows:
+            return converted
+        for row in rows:
+            email = db_to_email(row.message_data)
+            if email is not None:
+                row.message_blob = email_to_bytes(email)
+                row.message_data = ""
+        changed = [row for row in rows if row.message_blob is not None]
+        model.objects.bulk_update(changed, ["message_data", "message_blob"])
+        converted += len(changed)
+        last_id = rows[-1].id
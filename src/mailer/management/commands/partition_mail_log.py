@@ -0,0 +1,60 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.timezone import now as datetime_now
+
+from mailer import partitioning
+from mailer.models import MessageLog
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Create upcoming partitions of the mailer log (PostgreSQL only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--setup",
+            action="store_true",
+            help="Convert the mailer log to a partitioned table first",
+        )
+        parser.add_argument(
+            "--period",
+            choices=partitioning.PERIODS,
+            default="month",
+            help="Time range covered by each partition (default: month)",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=2,
+            help="Number of periods after the current one to create partitions for (default: 2)",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help="Database to use (default: default)",
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        table = MessageLog._meta.db_table
+        period = options["period"]
+        now = datetime_now()
+
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning the mailer log is only supported on PostgreSQL")
+        if options["setup"]:
+            if partitioning.is_partitioned(connection, table):
+                raise CommandError(f"{table} is partitioned already")
+            partitioning.convert_to_partitioned(connection, table, period, now)
+            logger.info(f"{table} converted to a partitioned table")
+        elif not partitioning.is_partitioned(connection, table):
+            raise CommandError(f"{table} isn't partitioned, use --setup to convert it")
+
+        until = partitioning.period_start(now, period)
+        for i in range(options["ahead"] + 1):
+            until = partitioning.next_period(until, period)
+        created = partitioning.create_partitions(connection, table, period, until)
+        logger.info(f"{len(created)} partitions created")
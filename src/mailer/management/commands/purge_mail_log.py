@@ -1,13 +1,9 @@
-import logging
-
 from django.core.management.base import BaseCommand
 
 from mailer.models import RESULT_FAILURE, RESULT_SUCCESS, MessageLog
 
 RESULT_CODES = {"success": [RESULT_SUCCESS], "failure": [RESULT_FAILURE], "all": [RESULT_SUCCESS, RESULT_FAILURE]}
 
-logger = logging.getLogger(__name__)
-
 
 class Command(BaseCommand):
     help = "Delete mailer log"
@@ -20,10 +16,34 @@ class Command(BaseCommand):
             choices=RESULT_CODES.keys(),
             help="Delete logs of messages with the given result code(s) (default: success)",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Number of log entries to delete per query (default: 10000)",
+        )
+        parser.add_argument(
+            "--max-seconds",
+            type=float,
+            help="Stop deleting after this many seconds, leaving the rest for the next run",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to pause between queries (default: 0)",
+        )
 
     def handle(self, *args, **options):
         days = options["days"]
         result_codes = RESULT_CODES.get(options["result"])
 
-        count = MessageLog.objects.purge_old_entries(days, result_codes)
-        logger.info(f"{count} log entries deleted ")
+        count = MessageLog.objects.purge_old_entries(
+            days,
+            result_codes,
+            batch_size=options["batch_size"],
+            max_seconds=options["max_seconds"],
+            sleep=options["sleep"],
+            progress=lambda count: self.stdout.write(f"{count} log entries deleted so far"),
+        )
+        self.stdout.write(f"{count} log entries deleted")
@@ -0,0 +1,320 @@
+"""
+Metrics about sending, handed to the exporters configured with
+MAILER_METRICS_EXPORTERS, a list of dicts like those of MAILER_EMAIL_BACKENDS:
+
+- ``BACKEND``: the dotted path of the exporter class.
+- ``OPTIONS``: keyword arguments for it.
+
+Metrics are counters, gauges, and observed durations in seconds, each with a
+name and optional labels:
+
+- ``messages`` (counter), labelled with the ``result`` of each message sent or
+  deferred, or ``skipped`` because of rate limits.
+- ``send_failures`` (counter), labelled with the ``error`` class name.
+- ``connections`` (counter), labelled with their ``source``, ``new`` or
+  ``pool``.
+- ``enqueue_to_send_seconds``: how long each sent message waited in the queue.
+- ``smtp_transaction_seconds``: how long the backend took to send each message.
+- ``claim_seconds``: how long it took to claim or lock messages for sending.
+- ``run_seconds``: how long each run of send_all() took.
+- ``queue_depth`` (gauge), labelled with the message ``priority``, after each
+  run.
+
+With no exporters configured, recording a metric does next to nothing.
+"""
+
+import atexit
+import contextlib
+import http.server
+import logging
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+OBSERVATION = "observation"
+
+
+class BaseExporter:
+    """
+    Base class for metrics exporters.
+
+    Subclasses must overwrite record().
+    """
+
+    def record(self, kind, name, value, labels):
+        """
+        Record a metric: increment a COUNTER, set a GAUGE, or add an
+        OBSERVATION, of the given name and labels (a dict).
+        """
+        raise NotImplementedError("subclasses of BaseExporter must override record() method")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class CallbackExporter(BaseExporter):
+    """
+    Calls `callback`, a callable or the dotted path of one, with the kind,
+    name, value and labels of every metric.
+    """
+
+    def __init__(self, callback):
+        self.callback = import_string(callback) if isinstance(callback, str) else callback
+
+    def record(self, kind, name, value, labels):
+        self.callback(kind, name, value, labels)
+
+
+class StatsdExporter(BaseExporter):
+    """
+    Sends metrics to a statsd server over UDP, as counters, gauges and timers
+    (in milliseconds, without the "_seconds" at the end of the name).
+
+    Label values are appended to the name, e.g. ``mailer.messages.sent``, or
+    with `dogstatsd`, sent as tags, e.g. ``mailer.messages:1|c|#result:sent``.
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="mailer", dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, kind, name, value, labels):
+        if kind == OBSERVATION:
+            name = name[: -len("_seconds")] if name.endswith("_seconds") else name
+            value = f"{value * 1000:g}|ms"
+        elif kind == GAUGE:
+            value = f"{value:g}|g"
+        else:
+            value = f"{value:g}|c"
+        name = f"{self.prefix}.{name}" if self.prefix else name
+        if self.dogstatsd:
+            tags = ",".join(f"{key}:{labels[key]}" for key in sorted(labels))
+            return f"{name}:{value}|#{tags}" if tags else f"{name}:{value}"
+        return ".".join([name, *(str(labels[key]) for key in sorted(labels))]) + f":{value}"
+
+    def record(self, kind, name, value, labels):
+        try:
+            self.socket.sendto(self.format(kind, name, value, labels).encode("utf-8"), self.address)
+        except OSError:
+            logger.debug("error sending metric to statsd", exc_info=True)
+
+    def close(self):
+        self.socket.close()
+
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class PrometheusExporter(BaseExporter):
+    """
+    Keeps metrics in memory, in the Prometheus text format: counters, gauges,
+    and histograms with the given `buckets` for observations.
+
+    They can be served over HTTP on `port` (and `addr`), for Prometheus to
+    scrape, and/or written to the file at `path` after every run, e.g. for
+    the textfile collector of the node exporter.
+    """
+
+    def __init__(self, path=None, port=None, addr="", prefix="mailer", buckets=DEFAULT_BUCKETS):
+        self.path = path
+        self.prefix = prefix
+        self.buckets = sorted(buckets)
+        # name -> (kind, {labels: value}); histograms have a list of bucket
+        # counts, the sum and the count as value
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.server = None
+        if port is not None:
+            self.start_server(addr, port)
+
+    def record(self, kind, name, value, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics.setdefault(name, (kind, {}))[1]
+            if kind == COUNTER:
+                values[key] = values.get(key, 0) + value
+            elif kind == GAUGE:
+                values[key] = value
+            else:
+                histogram = values.setdefault(key, [[0] * len(self.buckets), 0, 0])
+                for i, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        histogram[0][i] += 1
+                histogram[1] += value
+                histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, values) in sorted(self.metrics.items()):
+                name = f"{self.prefix}_{name}" if self.prefix else name
+                if kind == COUNTER:
+                    name += "_total"
+                lines.append(f"# TYPE {name} {'histogram' if kind == OBSERVATION else kind}")
+                for key, value in sorted(values.items()):
+                    if kind != OBSERVATION:
+                        lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                        continue
+                    buckets, total, count = value
+                    for bound, bucket_count in zip([*self.buckets, math.inf], [*buckets, count]):
+                        labels = format_labels(key + (("le", format_value(bound)),))
+                        lines.append(f"{name}_bucket{labels} {bucket_count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {format_value(total)}")
+                    lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "".join(f"{line}\n" for line in lines)
+
+    def flush(self):
+        if self.path is None:
+            return
+        # Written to a temporary file first, so that readers never see half
+        # of it
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".mailer-metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def start_server(self, addr, port):
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((addr, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="mailer-metrics-server", daemon=True).start()
+
+    def close(self):
+        super().close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def format_labels(key):
+    if not key:
+        return ""
+    labels = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in key
+    )
+    return f"{{{labels}}}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_exporters = []
+_exporters_config = None
+_exporters_lock = threading.Lock()
+
+
+def get_exporters():
+    """
+    Returns the exporters configured by MAILER_METRICS_EXPORTERS, shared by
+    the whole process.
+    """
+    global _exporters, _exporters_config
+
+    config = getattr(settings, "MAILER_METRICS_EXPORTERS", None) or []
+    if config == _exporters_config:
+        return _exporters
+    with _exporters_lock:
+        if config != _exporters_config:
+            for exporter in _exporters:
+                exporter.close()
+            _exporters = [import_string(exporter["BACKEND"])(**exporter.get("OPTIONS", {})) for exporter in config]
+            _exporters_config = config
+        return _exporters
+
+
+def close_exporters():
+    global _exporters, _exporters_config
+
+    with _exporters_lock:
+        for exporter in _exporters:
+            exporter.close()
+        _exporters = []
+        _exporters_config = None
+
+
+atexit.register(close_exporters)
+
+
+def record(kind, name, value, labels):
+    for exporter in get_exporters():
+        try:
+            exporter.record(kind, name, value, labels)
+        except Exception:
+            logger.exception(f"error recording metric {name}")
+
+
+def increment(name, value=1, **labels):
+    record(COUNTER, name, value, labels)
+
+
+def gauge(name, value, **labels):
+    record(GAUGE, name, value, labels)
+
+
+def observe(name, seconds, **labels):
+    record(OBSERVATION, name, seconds, labels)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Observes how long the body of the `with` statement takes.
+    """
+    if not get_exporters():
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def flush():
+    for exporter in get_exporters():
+        try:
+            exporter.flush()
+        except Exception:
+            logger.exception("error flushing metrics")
+
+
+def enabled():
+    return bool(get_exporters())
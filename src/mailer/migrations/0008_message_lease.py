@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0007_alter_messagelog_message_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="lease_expires",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="lease_owner",
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0008_message_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="message_blob",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name="messagelog",
+            name="message_blob",
+            field=models.BinaryField(null=True),
+        ),
+    ]
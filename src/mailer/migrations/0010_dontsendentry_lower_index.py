@@ -0,0 +1,24 @@
+import django
+from django.db import migrations, models
+
+operations = []
+
+# Expression indexes are supported from Django 3.2
+if django.VERSION >= (3, 2):
+    from django.db.models.functions import Lower
+
+    operations.append(
+        migrations.AddIndex(
+            model_name="dontsendentry",
+            index=models.Index(Lower("to_address"), name="mailer_dse_to_address_lower"),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0009_message_blob"),
+    ]
+
+    operations = operations
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0010_dontsendentry_lower_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["priority", "when_added", "id"], name="mailer_msg_queue_order"),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("priority", 4), _negated=True),
+                fields=["priority", "when_added", "id"],
+                name="mailer_msg_non_deferred",
+            ),
+        ),
+    ]
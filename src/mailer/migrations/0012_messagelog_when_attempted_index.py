@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:50
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0011_message_queue_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="messagelog",
+            name="when_attempted",
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0012_messagelog_when_attempted_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0013_message_next_attempt_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SendQuotaWindow",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=100)),
+                ("window", models.BigIntegerField()),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name": "send quota window",
+                "verbose_name_plural": "send quota windows",
+                "unique_together": {("name", "window")},
+            },
+        ),
+    ]
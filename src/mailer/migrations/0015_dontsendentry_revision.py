@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0014_sendquotawindow"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dontsendentry",
+            name="revision",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
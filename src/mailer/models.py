@@ -1,14 +1,26 @@
 import base64
 import datetime
+import itertools
 import logging
+import lzma
 import pickle
+import random
+import threading
+import time
+import zlib
 
+from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.core.mail import EmailMessage
-from django.db import models
+from django.core.mail.message import make_msgid
+from django.core.mail.utils import DNS_NAME
+from django.db import connections, models, transaction
+from django.db.models.functions import Lower
 from django.utils.timezone import now as datetime_now
 from django.utils.translation import gettext_lazy as _
 
+from mailer import logsinks, partitioning, serializers
+
 PRIORITY_HIGH = 1
 PRIORITY_MEDIUM = 2
 PRIORITY_LOW = 3
@@ -44,6 +56,113 @@ def get_message_id(msg):
             return value
 
 
+def lease_available(now):
+    """
+    Returns a filter for messages that are not leased, or whose lease expired.
+    """
+    return models.Q(lease_expires__isnull=True) | models.Q(lease_expires__lt=now)
+
+
+def attempt_due(now):
+    """
+    Returns a filter for messages that are not waiting to be retried later.
+    """
+    return models.Q(next_attempt_at__isnull=True) | models.Q(next_attempt_at__lte=now)
+
+
+def retry_backoff(retry_count):
+    """
+    Returns how long to wait before retrying a message that failed after
+    `retry_count` retries, or None if it should be deferred instead, because
+    MAILER_RETRY_BACKOFF_BASE isn't set or MAILER_EMAIL_MAX_RETRIES has been
+    reached.
+
+    The delay doubles with every retry, from MAILER_RETRY_BACKOFF_BASE up to
+    MAILER_RETRY_BACKOFF_MAX seconds, and is varied randomly by up to the
+    fraction MAILER_RETRY_BACKOFF_JITTER either way.
+    """
+    base = getattr(settings, "MAILER_RETRY_BACKOFF_BASE", None)
+    max_retries = getattr(settings, "MAILER_EMAIL_MAX_RETRIES", None)
+    if base is None or (max_retries is not None and retry_count >= max_retries):
+        return None
+    maximum = getattr(settings, "MAILER_RETRY_BACKOFF_MAX", 86400)
+    jitter = getattr(settings, "MAILER_RETRY_BACKOFF_JITTER", 0.1)
+    delay = min(base * 2**retry_count, maximum)
+    delay *= 1 + random.uniform(-jitter, jitter)
+    return datetime.timedelta(seconds=delay)
+
+
+def ensure_message_id(msg):
+    if get_message_id(msg) is None:
+        # Use cached DNS_NAME for performance
+        msg.extra_headers["Message-ID"] = make_msgid(domain=DNS_NAME)
+
+
+class RenderedMIMEMessage:
+    """
+    Stands in for the MIME message returned by EmailMessage.message(), for
+    data that has been rendered already. `data` uses CRLF line endings.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_bytes(self, unixfrom=False, linesep="\n"):
+        if linesep == "\r\n":
+            return self.data
+        return self.data.replace(b"\r\n", linesep.encode("ascii"))
+
+    def as_string(self, unixfrom=False, linesep="\n"):
+        return self.as_bytes(linesep=linesep).decode("utf-8", "surrogateescape")
+
+    def get_charset(self):
+        return None
+
+
+class PrerenderedEmailMessage(EmailMessage):
+    """
+    An email whose MIME message was rendered when it was put on the queue.
+    Backends are handed the rendered data as it is, along with the envelope
+    sender (`from_email`) and recipients (`recipients()`).
+
+    The body and attachments are only kept in the rendered data.
+    """
+
+    @classmethod
+    def from_email_message(cls, email):
+        # The Message-ID is part of the rendered headers, so it has to be
+        # decided now.
+        ensure_message_id(email)
+        prerendered = cls(
+            subject=email.subject,
+            from_email=email.from_email,
+            to=email.to,
+            cc=email.cc,
+            bcc=email.bcc,
+            reply_to=email.reply_to,
+            headers=email.extra_headers,
+        )
+        prerendered.encoding = email.encoding
+        prerendered.rendered_message = email.message().as_bytes(linesep="\r\n")
+        return prerendered
+
+    def message(self):
+        return RenderedMIMEMessage(self.rendered_message)
+
+
+def prerender_email(email, prerender=None):
+    """
+    Returns the email as a PrerenderedEmailMessage if `prerender` is True, or
+    if it is None and MAILER_PRERENDER_MESSAGES is set. Otherwise returns the
+    email unchanged.
+    """
+    if prerender is None:
+        prerender = getattr(settings, "MAILER_PRERENDER_MESSAGES", False)
+    if prerender and not isinstance(email, PrerenderedEmailMessage):
+        return PrerenderedEmailMessage.from_email_message(email)
+    return email
+
+
 class MessageManager(models.Manager):
     def high_priority(self):
         """
@@ -75,11 +194,62 @@ class MessageManager(models.Manager):
         """
         return self.filter(priority=PRIORITY_DEFERRED)
 
+    def due(self, now=None):
+        """
+        the messages in the queue not waiting for a later retry
+        """
+        if now is None:
+            now = datetime_now()
+        return self.filter(attempt_due(now))
+
+    def unleased(self, now=None):
+        """
+        the messages in the queue not currently leased by a sender
+        """
+        if now is None:
+            now = datetime_now()
+        return self.filter(lease_available(now))
+
+    def release_leases(self, owner):
+        """
+        give back all messages leased by the given owner to the queue
+        """
+        return self.filter(lease_owner=owner).update(lease_owner=None, lease_expires=None)
+
+    def enqueue_many(self, emails, priority=PRIORITY_MEDIUM, batch_size=None):
+        """
+        Queues the EmailMessage objects from the iterable `emails`, which may
+        be a generator, leaving out recipients on the don't send list.
+
+        Emails are read and inserted in chunks of `batch_size` (default
+        MAILER_ENQUEUE_BATCH_SIZE), each in its own transaction, so that only
+        one chunk is held in memory. Returns the number of messages queued.
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, "MAILER_ENQUEUE_BATCH_SIZE", 500)
+        emails = iter(emails)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(emails, batch_size))
+            if not chunk:
+                return count
+            blocked = DontSendEntry.objects.blocked_addresses(
+                address for email in chunk for address in itertools.chain(email.to, email.bcc)
+            )
+            messages = []
+            for email in chunk:
+                email.to = filter_recipient_list(email.to, blocked)
+                email.bcc = filter_recipient_list(email.bcc, blocked)
+                messages.append(self.model(email=prerender_email(email), priority=priority))
+            with transaction.atomic(using=self.db):
+                self.bulk_create(messages, batch_size=batch_size)
+            count += len(messages)
+
     def retry_deferred(self, new_priority=PRIORITY_MEDIUM):
         qs = self.deferred()
         if getattr(settings, "MAILER_EMAIL_MAX_RETRIES", None) is not None:
             qs = qs.filter(retry_count__lt=settings.MAILER_EMAIL_MAX_RETRIES)
-        return qs.update(priority=new_priority, retry_count=models.F("retry_count") + 1)
+        return qs.update(priority=new_priority, retry_count=models.F("retry_count") + 1, next_attempt_at=None)
 
 
 base64_encode = base64.encodebytes if hasattr(base64, "encodebytes") else base64.encodestring
@@ -94,9 +264,24 @@ def email_to_db(email):
     return base64_encode(pickle.dumps(email)).decode("ascii")
 
 
+def email_to_bytes(email):
+    # The binary format used when MAILER_MESSAGE_DATA_FORMAT is "binary",
+    # see mailer.serializers.
+    return serializers.dumps(email)
+
+
+def use_binary_format():
+    return getattr(settings, "MAILER_MESSAGE_DATA_FORMAT", "text") == "binary"
+
+
 def db_to_email(data):
-    if data == "":
+    if data == "" or data is None:
         return None
+    elif serializers.is_binary_format(data):
+        try:
+            return serializers.loads(data)
+        except (ValueError, TypeError, EOFError, zlib.error, lzma.LZMAError, pickle.UnpicklingError, AttributeError):
+            return None
     else:
         try:
             data = data.encode("ascii")
@@ -113,22 +298,79 @@ def db_to_email(data):
                 return None
 
 
-class Message(BigAutoModel):
+class CachedEmailMixin:
+    """
+    Keeps the EmailMessage decoded from the stored data, so that it is only
+    decoded again when the stored data is replaced.
+
+    The data is stored either in `message_blob`, in the binary format, or
+    otherwise in `message_data`.
+    """
+
+    def _get_stored_data(self):
+        if self.message_blob is not None:
+            return self.message_blob
+        return self.message_data
+
+    def _get_cached_email(self):
+        data = self._get_stored_data()
+        cached = self.__dict__.get("_email_cache")
+        if cached is None or cached[0] is not data:
+            cached = self._email_cache = (data, db_to_email(data))
+        return cached[1]
+
+    def _set_stored_email(self, email):
+        if use_binary_format():
+            self.message_data = ""
+            self.message_blob = email_to_bytes(email)
+        else:
+            self.message_data = email_to_db(email)
+            self.message_blob = None
+        self._email_cache = (self._get_stored_data(), email)
+
+    def __getstate__(self):
+        state = dict(super().__getstate__())
+        state.pop("_email_cache", None)
+        return state
+
+
+class Message(CachedEmailMixin, BigAutoModel):
     """
     The email stored for later sending.
     """
 
-    # The actual data - a pickled EmailMessage
+    # The actual data - a pickled EmailMessage, base64 encoded
     message_data = models.TextField()
+    # or, with MAILER_MESSAGE_DATA_FORMAT = "binary", see mailer.serializers
+    message_blob = models.BinaryField(null=True, editable=False)
     when_added = models.DateTimeField(default=datetime_now)
     priority = models.PositiveSmallIntegerField(choices=PRIORITIES, default=PRIORITY_MEDIUM)
     retry_count = models.IntegerField(default=0)
 
+    # Set when a sender claims the message in batch claiming mode, see
+    # mailer.engine.claim_messages. A lease that has expired belongs to
+    # a sender that went away, and the message can be claimed again.
+    lease_owner = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False)
+    # When a message that failed is to be retried, see Message.defer()
+    next_attempt_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
     objects = MessageManager()
 
     class Meta:
         verbose_name = _("message")
         verbose_name_plural = _("messages")
+        indexes = [
+            # The order in which the queue is sent, see mailer.engine.prioritize
+            models.Index(fields=["priority", "when_added", "id"], name="mailer_msg_queue_order"),
+            # The same, without the deferred backlog, on databases that support
+            # partial indexes.
+            models.Index(
+                fields=["priority", "when_added", "id"],
+                name="mailer_msg_non_deferred",
+                condition=~models.Q(priority=PRIORITY_DEFERRED),
+            ),
+        ]
 
     def __str__(self):
         try:
@@ -138,20 +380,34 @@ class Message(BigAutoModel):
             return "<Message repr unavailable>"
 
     def defer(self):
-        self.priority = PRIORITY_DEFERRED
+        """
+        Takes the message out of the queue after a failed attempt: until a
+        later retry if MAILER_RETRY_BACKOFF_BASE is set, see retry_backoff(),
+        and otherwise until retry_deferred() is called.
+        """
+        backoff = retry_backoff(self.retry_count)
+        if backoff is None:
+            self.priority = PRIORITY_DEFERRED
+        else:
+            self.retry_count += 1
+            self.next_attempt_at = datetime_now() + backoff
+        self.lease_owner = None
+        self.lease_expires = None
         self.save()
 
     def _get_email(self):
-        return db_to_email(self.message_data)
+        return self._get_cached_email()
 
     def _set_email(self, val):
-        self.message_data = email_to_db(val)
+        self._set_stored_email(val)
 
     email = property(
         _get_email,
         _set_email,
         doc="""EmailMessage object. If this is mutated, you will need to
-set the attribute again to cause the underlying serialised data to be updated.""",
+set the attribute again to cause the underlying serialised data to be updated.
+The object is decoded once, and the same object returned until the attribute
+or `message_data` is set again.""",
     )
 
     @property
@@ -171,12 +427,21 @@ set the attribute again to cause the underlying serialised data to be updated.""
             return ""
 
 
-def filter_recipient_list(lst):
+def filter_recipient_list(lst, blocked=None):
+    """
+    Returns the list without the addresses on the don't send list.
+
+    `blocked` may be passed in as returned by
+    DontSendEntry.objects.blocked_addresses(), to filter several lists with
+    a single lookup.
+    """
     if lst is None:
         return None
+    if blocked is None:
+        blocked = DontSendEntry.objects.blocked_addresses(lst)
     retval = []
     for e in lst:
-        if DontSendEntry.objects.has_address(e):
+        if e is not None and e.lower() in blocked:
             logger.info(f"skipping email to {e.encode('utf-8')} as on don't send list ")
         else:
             retval.append(e)
@@ -184,46 +449,148 @@ def filter_recipient_list(lst):
 
 
 def make_message(
-    subject="", body="", from_email=None, to=None, bcc=None, attachments=None, headers=None, priority=None
+    subject="",
+    body="",
+    from_email=None,
+    to=None,
+    bcc=None,
+    attachments=None,
+    headers=None,
+    priority=None,
+    prerender=None,
+    email_class=EmailMessage,
+    alternatives=None,
 ):
     """
     Creates a simple message for the email parameters supplied.
     The 'to' and 'bcc' lists are filtered using DontSendEntry.
 
-    If needed, the 'email' attribute can be set to any instance of EmailMessage
-    if e-mails with attachments etc. need to be supported.
+    The email is built as an instance of 'email_class', which can be any
+    subclass of EmailMessage. 'alternatives' is passed on to it if given, for
+    EmailMultiAlternatives. If needed, the 'email' attribute can also be set
+    to any instance of EmailMessage afterwards.
+
+    The MIME message is rendered straight away if 'prerender' is True, or if
+    it is None and MAILER_PRERENDER_MESSAGES is set.
 
     Call 'save()' on the result when it is ready to be sent, and not before.
     """
-    to = filter_recipient_list(to)
-    bcc = filter_recipient_list(bcc)
-    core_msg = EmailMessage(
-        subject=subject, body=body, from_email=from_email, to=to, bcc=bcc, attachments=attachments, headers=headers
+    blocked = DontSendEntry.objects.blocked_addresses([*(to or []), *(bcc or [])])
+    to = filter_recipient_list(to, blocked)
+    bcc = filter_recipient_list(bcc, blocked)
+    kwargs = {}
+    if alternatives is not None:
+        kwargs["alternatives"] = alternatives
+    core_msg = email_class(
+        subject=subject,
+        body=body,
+        from_email=from_email,
+        to=to,
+        bcc=bcc,
+        attachments=attachments,
+        # Copied, as the Message-ID may be added to it
+        headers=dict(headers) if headers else None,
+        **kwargs,
     )
     db_msg = Message(priority=priority)
-    db_msg.email = core_msg
+    db_msg.email = prerender_email(core_msg, prerender)
     return db_msg
 
 
+class DontSendCache:
+    """
+    A process local copy of the (lowercased) addresses on the don't send list.
+
+    The copy is checked against a version stamp of the table at most every
+    MAILER_DONT_SEND_CACHE_TIMEOUT seconds, and reloaded if it changed. The
+    stamp changes when entries are added, deleted, or edited with save(), but
+    not with QuerySet.update().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.version = None
+        self.addresses = frozenset()
+        self.checked = None
+
+    def get(self, manager, timeout):
+        with self.lock:
+            now = time.monotonic()
+            if self.checked is None or now - self.checked >= timeout:
+                version = manager.aggregate(
+                    count=models.Count("id"), last_id=models.Max("id"), revisions=models.Sum("revision")
+                )
+                version = (version["count"], version["last_id"], version["revisions"])
+                if version != self.version:
+                    self.addresses = frozenset(
+                        address.lower() for address in manager.values_list("to_address", flat=True).iterator()
+                    )
+                    self.version = version
+                self.checked = now
+            return self.addresses
+
+
+dont_send_cache = DontSendCache()
+
+# Chunk size for looking up addresses, to stay clear of limits on the
+# number of query parameters.
+DONT_SEND_LOOKUP_CHUNK_SIZE = 500
+
+
 class DontSendEntryManager(models.Manager):
     def has_address(self, address):
         """
         is the given address on the don't send list?
         """
-        queryset = self.filter(to_address__iexact=address)
-        return queryset.exists()
+        return address is not None and address.lower() in self.blocked_addresses([address])
+
+    def blocked_addresses(self, addresses):
+        """
+        which of the given addresses are on the don't send list? Returns a
+        set of lowercased addresses.
+        """
+        lowered = {address.lower() for address in addresses if address}
+        if not lowered:
+            return set()
+
+        cache_timeout = getattr(settings, "MAILER_DONT_SEND_CACHE_TIMEOUT", None)
+        if cache_timeout is not None:
+            return lowered & dont_send_cache.get(self, cache_timeout)
+
+        lowered = sorted(lowered)
+        blocked = set()
+        for i in range(0, len(lowered), DONT_SEND_LOOKUP_CHUNK_SIZE):
+            blocked.update(
+                self.annotate(address_lower=Lower("to_address"))
+                .filter(address_lower__in=lowered[i : i + DONT_SEND_LOOKUP_CHUNK_SIZE])
+                .values_list("address_lower", flat=True)
+            )
+        return blocked
 
 
 class DontSendEntry(BigAutoModel):
 
     to_address = models.EmailField(max_length=254)
     when_added = models.DateTimeField()
+    # Bumped every time the entry is saved, see DontSendCache
+    revision = models.PositiveIntegerField(default=0, editable=False)
 
     objects = DontSendEntryManager()
 
     class Meta:
         verbose_name = _("don't send entry")
         verbose_name_plural = _("don't send entries")
+        if DJANGO_VERSION >= (3, 2):
+            # Expression indexes are supported from Django 3.2
+            indexes = [models.Index(Lower("to_address"), name="mailer_dse_to_address_lower")]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.revision += 1
+        super().save(*args, **kwargs)
 
 
 RESULT_SUCCESS = "1"
@@ -239,16 +606,18 @@ RESULT_CODES = (
 
 
 class MessageLogManager(models.Manager):
-    def log(self, message, result_code, log_message=""):
+    def build(self, message, result_code, log_message=""):
         """
-        create a log entry for an attempt to send the given message and
-        record the given result and (optionally) a log message
+        make an unsaved log entry for an attempt to send the given message,
+        e.g. for use with bulk_create()
         """
         log_message_data = getattr(settings, "MAILER_EMAIL_LOG_MESSAGE_DATA", True)
         message_data = message.message_data if log_message_data else None
+        message_blob = message.message_blob if log_message_data else None
 
-        return self.create(
+        return self.model(
             message_data=message_data,
+            message_blob=message_blob,
             message_id=get_message_id(message.email),
             when_added=message.when_added,
             priority=message.priority,
@@ -256,18 +625,77 @@ class MessageLogManager(models.Manager):
             log_message=log_message,
         )
 
-    def purge_old_entries(self, days, result_codes=None):
+    def log(self, message, result_code, log_message=""):
+        """
+        create a log entry for an attempt to send the given message and
+        record the given result and (optionally) a log message
+
+        The entry is written by the MAILER_LOG_SINK, which by default saves
+        it to the database straight away.
+        """
+        log_entry = self.build(message, result_code, log_message)
+        logsinks.get_log_sink().write(log_entry)
+        return log_entry
+
+    def log_many(self, log_entries):
+        """
+        write entries made with build() to the MAILER_LOG_SINK
+        """
+        logsinks.get_log_sink().write_many(log_entries)
+
+    def purge_old_entries(self, days, result_codes=None, batch_size=10000, max_seconds=None, sleep=0, progress=None):
+        """
+        delete log entries older than `days` days with the given result codes,
+        and return how many were deleted
+
+        Entries are deleted in chunks of up to `batch_size` consecutive ids,
+        with one delete() each, pausing `sleep` seconds in between.
+        No more chunks are started after `max_seconds`. `progress` is called
+        with the number deleted so far after each chunk.
+
+        If the table is partitioned (see mailer.partitioning) and entries with
+        any result are to be deleted, partitions older than `days` are
+        dropped as a whole first.
+        """
         if result_codes is None:
             # retro-compatibility with previous versions
             result_codes = [RESULT_SUCCESS]
         limit = datetime_now() - datetime.timedelta(days=days)
         query = self.filter(when_attempted__lt=limit, result__in=result_codes)
-        count = query.count()
-        query.delete()
+        start = time.monotonic()
+        count = 0
+        connection = connections[self.db]
+        # RESULT_DONT_SEND isn't recorded by django-mailer itself
+        if {RESULT_SUCCESS, RESULT_FAILURE} <= set(result_codes) and partitioning.is_partitioned(
+            connection, self.model._meta.db_table
+        ):
+            count += partitioning.drop_partitions_before(connection, self.model._meta.db_table, limit)
+            if progress is not None:
+                progress(count)
+        last_id = None
+        while True:
+            chunk = query if last_id is None else query.filter(id__gt=last_id)
+            upper = list(chunk.order_by("id").values_list("id", flat=True)[batch_size - 1 : batch_size])
+            upper_id = upper[0] if upper else None
+            if upper_id is not None:
+                chunk = chunk.filter(id__lte=upper_id)
+            # Nothing refers to MessageLog, so unless there are pre_delete or
+            # post_delete receivers for it, this is a single DELETE.
+            deleted, _ = chunk.delete()
+            count += deleted
+            if progress is not None:
+                progress(count)
+            if upper_id is None:
+                break
+            last_id = upper_id
+            if max_seconds is not None and time.monotonic() - start >= max_seconds:
+                break
+            if sleep:
+                time.sleep(sleep)
         return count
 
 
-class MessageLog(BigAutoModel):
+class MessageLog(CachedEmailMixin, BigAutoModel):
     """
     A log entry which stores the result (and optionally a log message) for an
     attempt to send a Message.
@@ -275,12 +703,13 @@ class MessageLog(BigAutoModel):
 
     # fields from Message
     message_data = models.TextField(null=True)
+    message_blob = models.BinaryField(null=True, editable=False)
     message_id = models.TextField(editable=False, null=True)
     when_added = models.DateTimeField(db_index=True)
     priority = models.PositiveSmallIntegerField(choices=PRIORITIES, db_index=True)
 
     # additional logging fields
-    when_attempted = models.DateTimeField(default=datetime_now)
+    when_attempted = models.DateTimeField(default=datetime_now, db_index=True)
     result = models.CharField(max_length=1, choices=RESULT_CODES)
     log_message = models.TextField()
 
@@ -302,7 +731,7 @@ class MessageLog(BigAutoModel):
 
     @property
     def email(self):
-        return db_to_email(self.message_data)
+        return self._get_cached_email()
 
     @property
     def to_addresses(self):
@@ -319,3 +748,22 @@ class MessageLog(BigAutoModel):
             return email.subject
         else:
             return None
+
+
+class SendQuotaWindow(BigAutoModel):
+    """
+    The number of messages sent, or about to be sent, by all senders within
+    one time window of a MAILER_SEND_QUOTAS quota, see mailer.ratelimit.
+    """
+
+    name = models.CharField(max_length=100)
+    window = models.BigIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("send quota window")
+        verbose_name_plural = _("send quota windows")
+        unique_together = [("name", "window")]
+
+    def __str__(self):
+        return f"{self.name} #{self.window}: {self.count}"
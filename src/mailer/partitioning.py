@@ -0,0 +1,186 @@
+"""
+Range partitioning of the MessageLog table by `when_attempted`, on PostgreSQL
+11 and later. See the `partition_mail_log` management command.
+
+Partitions cover a day or a month each, and are named after the table and the
+start of their range, e.g. ``mailer_messagelog_p202610``. When the table is
+converted, the existing rows are kept in a ``<table>_legacy`` partition
+covering everything before the first new partition, and a
+``<table>_default`` partition catches rows outside all other partitions.
+"""
+
+import datetime
+import re
+
+from django.db import transaction
+
+PERIODS = ["day", "month"]
+
+BOUND_RE = re.compile(r"FROM \((?:'([^']*)'|MINVALUE)\) TO \((?:'([^']*)'|MAXVALUE)\)")
+
+
+def period_start(when, period):
+    """
+    Returns the start of the day or month `when` falls in, in UTC.
+    """
+    when = when.astimezone(datetime.timezone.utc)
+    if period == "day":
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start, period):
+    if period == "day":
+        return start + datetime.timedelta(days=1)
+    return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def partition_name(table, start, period):
+    if period == "day":
+        return f"{table}_p{start:%Y%m%d}"
+    return f"{table}_p{start:%Y%m}"
+
+
+def parse_bound(value):
+    if value is None:
+        return None
+    # PostgreSQL abbreviates whole hour UTC offsets, e.g. "+00"
+    if re.search(r"[+-]\d\d$", value):
+        value += ":00"
+    return datetime.datetime.fromisoformat(value)
+
+
+def is_partitioned(connection, table):
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def get_partitions(connection, table):
+    """
+    Returns the (name, lower, upper) bounds of the range partitions of
+    `table`, ordered by range. Open ends of the range are None. The default
+    partition is left out.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            """,
+            [table],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_RE.search(bound)
+        if match is not None:
+            partitions.append((name, parse_bound(match.group(1)), parse_bound(match.group(2))))
+    partitions.sort(key=lambda p: (p[2] is None, p[2]))
+    return partitions
+
+
+def literal(when):
+    # Partition bounds must be literals in PostgreSQL 11
+    return f"'{when.isoformat()}'"
+
+
+def convert_to_partitioned(connection, table, period, now):
+    """
+    Turns `table` into a partitioned table, keeping the existing rows in a
+    legacy partition that ends with the current period.
+    """
+    q = connection.ops.quote_name
+    legacy = f"{table}_legacy"
+    default = f"{table}_default"
+    sequence = f"{table}_partitioned_id_seq"
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"SELECT max(id), max(when_attempted) FROM {q(table)}")
+        max_id, max_attempted = cursor.fetchone()
+        boundary = next_period(period_start(max(now, max_attempted or now), period), period)
+
+        cursor.execute(f"ALTER TABLE {q(table)} RENAME TO {q(legacy)}")
+        # Ids now come from a sequence owned by the partitioned table
+        cursor.execute(f"ALTER TABLE {q(legacy)} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER TABLE {q(legacy)} ALTER COLUMN id DROP DEFAULT")
+        cursor.execute(
+            f"CREATE TABLE {q(table)} (LIKE {q(legacy)} INCLUDING DEFAULTS) PARTITION BY RANGE (when_attempted)"
+        )
+        cursor.execute(f"CREATE SEQUENCE {q(sequence)} OWNED BY {q(table)}.id")
+        cursor.execute("SELECT setval(%s, %s, false)", [sequence, (max_id or 0) + 1])
+        cursor.execute(f"ALTER TABLE {q(table)} ALTER COLUMN id SET DEFAULT nextval('{q(sequence)}')")
+        # The partition key has to be part of the primary key
+        cursor.execute(f"ALTER TABLE {q(table)} ADD PRIMARY KEY (id, when_attempted)")
+        for column in ["when_added", "priority", "when_attempted"]:
+            cursor.execute(f"CREATE INDEX ON {q(table)} ({q(column)})")
+        cursor.execute(
+            f"ALTER TABLE {q(table)} ATTACH PARTITION {q(legacy)} FOR VALUES FROM (MINVALUE) TO ({literal(boundary)})"
+        )
+        cursor.execute(f"CREATE TABLE {q(default)} PARTITION OF {q(table)} DEFAULT")
+
+
+def create_partitions(connection, table, period, until):
+    """
+    Creates partitions of `table` for the periods after the last existing one,
+    up to `until`. Rows that were put in the default partition for lack of a
+    partition are moved to the new ones. Returns the names of the created
+    partitions.
+    """
+    q = connection.ops.quote_name
+    default = f"{table}_default"
+    partitions = get_partitions(connection, table)
+    start = partitions[-1][2] if partitions else period_start(until, period)
+    created = []
+    while start is not None and start < until:
+        stop = next_period(period_start(start, period), period)
+        name = partition_name(table, start, period)
+        bounds = f"FOR VALUES FROM ({literal(start)}) TO ({literal(stop)})"
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [default])
+            has_default = cursor.fetchone()[0]
+            misplaced = False
+            if has_default:
+                cursor.execute(
+                    f"SELECT 1 FROM {q(default)} WHERE when_attempted >= %s AND when_attempted < %s LIMIT 1",
+                    [start, stop],
+                )
+                misplaced = cursor.fetchone() is not None
+            if misplaced:
+                cursor.execute(f"ALTER TABLE {q(table)} DETACH PARTITION {q(default)}")
+                cursor.execute(f"CREATE TABLE {q(name)} PARTITION OF {q(table)} {bounds}")
+                cursor.execute(
+                    f"INSERT INTO {q(table)} SELECT * FROM {q(default)} "
+                    "WHERE when_attempted >= %s AND when_attempted < %s",
+                    [start, stop],
+                )
+                cursor.execute(
+                    f"DELETE FROM {q(default)} WHERE when_attempted >= %s AND when_attempted < %s", [start, stop]
+                )
+                cursor.execute(f"ALTER TABLE {q(table)} ATTACH PARTITION {q(default)} DEFAULT")
+            else:
+                cursor.execute(f"CREATE TABLE {q(name)} PARTITION OF {q(table)} {bounds}")
+        created.append(name)
+        start = stop
+    return created
+
+
+def drop_partitions_before(connection, table, limit):
+    """
+    Detaches and drops the partitions of `table` whose whole range is before
+    `limit`. Returns the number of rows they held.
+    """
+    q = connection.ops.quote_name
+    count = 0
+    for name, lower, upper in get_partitions(connection, table):
+        if upper is None or upper > limit:
+            break
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {q(name)}")
+            count += cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {q(table)} DETACH PARTITION {q(name)}")
+            cursor.execute(f"DROP TABLE {q(name)}")
+    return count
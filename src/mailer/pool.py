@@ -0,0 +1,227 @@
+"""
+A pool of open backend connections, kept between runs of send_all() by
+long-running senders such as runmailer, configured with
+MAILER_CONNECTION_POOL_SIZE.
+
+Connections are put back in the pool at the end of a run instead of being
+closed, and taken out again by the next run, saving the connection set-up
+(and for SMTP the TLS handshake and authentication). Idle connections are
+kept alive with NOOP commands from a background thread, and closed once
+they have been idle for `max_idle` seconds, or open for `max_lifetime`
+seconds.
+"""
+
+import atexit
+import logging
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def close_connection(connection):
+    """
+    Closes a backend connection, logging rather than raising any errors,
+    since the connection may well be broken already.
+    """
+    try:
+        connection.close()
+    except Exception:
+        logger.debug("error closing connection", exc_info=True)
+
+
+def noop(connection):
+    """
+    Sends an SMTP NOOP over the connection of a Django SMTP backend, raising
+    an error if the server doesn't answer. Other backends are left alone.
+    """
+    smtp = getattr(connection, "connection", None)
+    if not isinstance(smtp, smtplib.SMTP):
+        return
+    code, message = smtp.noop()
+    if code != 250:
+        raise smtplib.SMTPResponseException(code, message)
+
+
+class PoolEntry:
+    def __init__(self, connection, opened_at, now):
+        self.connection = connection
+        self.opened_at = opened_at
+        self.idle_since = now
+        # When the server last heard from us
+        self.last_activity = now
+
+
+class ConnectionPool:
+    """
+    Holds up to `size` idle connections for each backend configuration.
+    Instances are safe to use from several threads.
+    """
+
+    def __init__(self, size, max_idle=120, max_lifetime=600, keepalive=30):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.keepalive = keepalive
+        # key -> list of PoolEntry, the most recently used last
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.keeper = None
+
+    def usable(self, entry, now):
+        return now - entry.opened_at < self.max_lifetime and now - entry.idle_since < self.max_idle
+
+    def checkout(self, key):
+        """
+        Takes an idle connection for `key` out of the pool. Returns it and
+        the time it was opened, or (None, None) if there is none.
+        """
+        now = time.monotonic()
+        expired = []
+        found = None
+        with self.lock:
+            entries = self.idle.get(key, [])
+            while entries:
+                entry = entries.pop()
+                if self.usable(entry, now):
+                    found = entry
+                    break
+                expired.append(entry)
+        for entry in expired:
+            close_connection(entry.connection)
+        if found is None:
+            return None, None
+        return found.connection, found.opened_at
+
+    def checkin(self, key, connection, opened_at):
+        """
+        Puts a connection opened at `opened_at` back in the pool. Returns
+        False, if it wasn't taken, in which case the caller should close it.
+        """
+        now = time.monotonic()
+        if now - opened_at >= self.max_lifetime:
+            return False
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            if len(entries) >= self.size:
+                return False
+            entries.append(PoolEntry(connection, opened_at, now))
+        self._start_keeper()
+        return True
+
+    def keep_alive(self):
+        """
+        Closes the idle connections that are too old, and sends a NOOP over
+        those the server hasn't heard from for `keepalive` seconds.
+        """
+        now = time.monotonic()
+        expired, due = [], []
+        with self.lock:
+            for key, entries in self.idle.items():
+                for entry in list(entries):
+                    if not self.usable(entry, now):
+                        entries.remove(entry)
+                        expired.append(entry)
+                    elif now - entry.last_activity >= self.keepalive:
+                        # Out of the pool while we talk to the server
+                        entries.remove(entry)
+                        due.append((key, entry))
+        for entry in expired:
+            close_connection(entry.connection)
+        for key, entry in due:
+            try:
+                noop(entry.connection)
+            except Exception:
+                logger.debug("idle connection failed keepalive", exc_info=True)
+                close_connection(entry.connection)
+                continue
+            entry.last_activity = time.monotonic()
+            with self.lock:
+                entries = self.idle.setdefault(key, [])
+                if len(entries) < self.size:
+                    entries.insert(0, entry)
+                    entry = None
+            if entry is not None:
+                close_connection(entry.connection)
+
+    def close(self):
+        """
+        Stops the keepalive thread, and closes all idle connections.
+        """
+        keeper = self.keeper
+        if keeper is not None:
+            self.stopped.set()
+            keeper.join()
+            self.keeper = None
+        with self.lock:
+            entries = [entry for entries in self.idle.values() for entry in entries]
+            self.idle = {}
+        for entry in entries:
+            close_connection(entry.connection)
+
+    def _start_keeper(self):
+        with self.lock:
+            if self.keeper is not None:
+                return
+            self.stopped.clear()
+            self.keeper = threading.Thread(target=self._run_keeper, name="mailer-connection-keepalive", daemon=True)
+            self.keeper.start()
+
+    def _run_keeper(self):
+        while not self.stopped.wait(self.keepalive):
+            try:
+                self.keep_alive()
+            except Exception:
+                logger.exception("error keeping idle connections alive")
+
+
+_connection_pool = None
+_connection_pool_config = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Returns the ConnectionPool for MAILER_CONNECTION_POOL_SIZE,
+    MAILER_CONNECTION_MAX_IDLE, MAILER_CONNECTION_MAX_LIFETIME and
+    MAILER_CONNECTION_KEEPALIVE, shared by the whole process, or None if no
+    pool size is set.
+    """
+    global _connection_pool, _connection_pool_config
+
+    size = getattr(settings, "MAILER_CONNECTION_POOL_SIZE", 0)
+    if not size:
+        return None
+    config = (
+        size,
+        getattr(settings, "MAILER_CONNECTION_MAX_IDLE", 120),
+        getattr(settings, "MAILER_CONNECTION_MAX_LIFETIME", 600),
+        getattr(settings, "MAILER_CONNECTION_KEEPALIVE", 30),
+    )
+    with _connection_pool_lock:
+        if _connection_pool is None or config != _connection_pool_config:
+            if _connection_pool is not None:
+                _connection_pool.close()
+            _connection_pool = ConnectionPool(*config)
+            _connection_pool_config = config
+        return _connection_pool
+
+
+def close_connection_pool():
+    """
+    Closes all pooled connections.
+    """
+    global _connection_pool, _connection_pool_config
+
+    with _connection_pool_lock:
+        if _connection_pool is not None:
+            _connection_pool.close()
+        _connection_pool = None
+        _connection_pool_config = None
+
+
+atexit.register(close_connection_pool)
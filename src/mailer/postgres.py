@@ -60,9 +60,10 @@ def postgres_send_loop():
     logger.debug(f"Waiting for notifications on channel '{CHANNEL}'")
 
     # We have a single worker thread that runs send_all(). This means we are not
-    # sending messages in parallel, which is deliberate - in many cases email
-    # sending may be throttled and we are less likely to exceed quotas if we
-    # send in serial rather than parallel.
+    # sending messages in parallel by default, which is deliberate - in many
+    # cases email sending may be throttled and we are less likely to exceed
+    # quotas if we send in serial rather than parallel. Parallel sending can be
+    # enabled with MAILER_CONCURRENCY, which send_all() handles itself.
     worker_thread = threading.Thread(target=worker, daemon=True)
     worker_thread.start()
 
@@ -0,0 +1,262 @@
+"""
+Rate limits for sending.
+
+Per recipient domain, configured with MAILER_DOMAIN_RATE_LIMITS: each domain
+matching one of the configured patterns gets its own token bucket, holding up
+to `burst` tokens and refilled at `rate` tokens per second. Sending a message
+takes a token from the bucket of every recipient domain; messages for which a
+bucket is empty are skipped, and held back in the queue until it has a token
+again.
+
+Overall, configured with MAILER_SEND_QUOTAS: quotas are shared by all senders
+through the database, see SendQuota.
+"""
+
+import fnmatch
+import math
+import threading
+import time
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.db.models import F
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # When the next message held back for this bucket can be tried again
+        self.held_until = self.updated
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until a token is available.
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class DomainRateLimiter:
+    """
+    Holds a token bucket for each recipient domain with a rate limit.
+
+    `limits` maps domain patterns, as understood by fnmatch, to a rate in
+    messages per second, or a (rate, burst) tuple. The first matching
+    pattern applies. Instances are safe to use from several threads.
+    """
+
+    def __init__(self, limits):
+        self.limits = []
+        for pattern, limit in limits.items():
+            rate, burst = limit if isinstance(limit, (tuple, list)) else (limit, max(1, limit))
+            self.limits.append((pattern.lower(), rate, burst))
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, domain):
+        if domain not in self.buckets:
+            for pattern, rate, burst in self.limits:
+                if fnmatch.fnmatchcase(domain, pattern):
+                    self.buckets[domain] = TokenBucket(rate, burst)
+                    break
+            else:
+                self.buckets[domain] = None
+        return self.buckets[domain]
+
+    def acquire(self, recipients):
+        """
+        Takes a token for each domain among `recipients`, and returns True, if
+        they are all available. Otherwise takes none, and returns False.
+        """
+        domains = {get_domain(recipient) for recipient in recipients}
+        now = time.monotonic()
+        with self.lock:
+            buckets = [bucket for bucket in map(self.get_bucket, domains) if bucket is not None]
+            for bucket in buckets:
+                bucket.refill(now)
+            if any(bucket.tokens < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return True
+
+    def hold(self, recipients):
+        """
+        Returns the number of seconds to hold back a message to `recipients`
+        that couldn't be sent, until its buckets have a token again. Messages
+        held back for the same bucket are spread out at its rate, so that they
+        don't all become due at once.
+        """
+        domains = {get_domain(recipient) for recipient in recipients}
+        now = time.monotonic()
+        with self.lock:
+            buckets = [bucket for bucket in map(self.get_bucket, domains) if bucket is not None]
+            delay = 0.0
+            for bucket in buckets:
+                bucket.refill(now)
+                delay = max(delay, bucket.wait_time(), bucket.held_until - now)
+            for bucket in buckets:
+                bucket.held_until = now + delay + 1 / bucket.rate
+            return delay
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the first empty bucket has a
+        token again, or 0 if none is empty.
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = [bucket for bucket in self.buckets.values() if bucket is not None]
+            for bucket in buckets:
+                bucket.refill(now)
+            return min((bucket.wait_time() for bucket in buckets if bucket.tokens < 1), default=0.0)
+
+
+def get_domain(address):
+    return parseaddr(address)[1].rpartition("@")[2].lower()
+
+
+_rate_limiter = None
+_rate_limiter_config = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Returns the DomainRateLimiter for MAILER_DOMAIN_RATE_LIMITS, shared by the
+    whole process, or None if no limits are set.
+    """
+    global _rate_limiter, _rate_limiter_config
+
+    limits = getattr(settings, "MAILER_DOMAIN_RATE_LIMITS", None)
+    if not limits:
+        return None
+    with _rate_limiter_lock:
+        if _rate_limiter is None or limits != _rate_limiter_config:
+            _rate_limiter = DomainRateLimiter(limits)
+            _rate_limiter_config = limits
+        return _rate_limiter
+
+
+class SendQuota:
+    """
+    Enforces limits on the number of messages sent by all senders together,
+    given as (messages, seconds) pairs, e.g. [(50, 1), (200000, 86400)].
+
+    Each limit is checked with a sliding window: the count of the current
+    fixed window of `seconds`, plus the count of the previous one weighted
+    by how much of it still overlaps the sliding window. Counts are kept in
+    the SendQuotaWindow table. To save queries, each process takes tokens
+    from the table `lease_size` at a time, and uses them up locally until the
+    window ends; tokens that aren't used are lost.
+    """
+
+    def __init__(self, quotas, lease_size=10):
+        self.quotas = [(int(limit), seconds) for limit, seconds in quotas]
+        self.lease_size = lease_size
+        # (limit, seconds) -> (window, tokens)
+        self.leases = {}
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token for one message from every quota, and returns 0, if
+        they all have one. Otherwise takes none, and returns the number of
+        seconds to wait before trying again.
+        """
+        now = time.time()
+        with self.lock:
+            for quota in self.quotas:
+                window = int(now // quota[1])
+                leased_window, tokens = self.leases.get(quota, (None, 0))
+                if leased_window != window or tokens < 1:
+                    tokens, wait = self.lease(quota, window, now)
+                    if not tokens:
+                        self.blocked_until = now + wait
+                        return wait
+                    self.leases[quota] = (window, tokens)
+            for quota in self.quotas:
+                window, tokens = self.leases[quota]
+                self.leases[quota] = (window, tokens - 1)
+            return 0
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the quota that last turned down
+        acquire() is expected to allow another message.
+        """
+        return max(0.0, self.blocked_until - time.time())
+
+    def lease(self, quota, window, now):
+        """
+        Takes up to `lease_size` tokens for the given window of `quota` from
+        the database. Returns the number of tokens taken, and if that is 0,
+        the number of seconds to wait.
+        """
+        from mailer.models import SendQuotaWindow
+
+        limit, seconds = quota
+        name = f"{limit}/{seconds}"
+        # How much of the previous window the sliding window still covers
+        overlap = 1 - (now - window * seconds) / seconds
+        for attempt in range(3):
+            counts = dict(
+                SendQuotaWindow.objects.filter(name=name, window__in=[window - 1, window]).values_list(
+                    "window", "count"
+                )
+            )
+            if window not in counts:
+                SendQuotaWindow.objects.get_or_create(name=name, window=window)
+                SendQuotaWindow.objects.filter(name=name, window__lt=window - 1).delete()
+            previous, current = counts.get(window - 1, 0), counts.get(window, 0)
+            allowed = math.floor(limit - previous * overlap)
+            tokens = min(self.lease_size, allowed - current)
+            if tokens <= 0:
+                if current >= limit:
+                    # Until the next window, and enough of this one has slid
+                    # out of the sliding window
+                    wait = (window + 1) * seconds - now + (1 - (limit - 1) / current) * seconds
+                elif not previous:
+                    wait = (window + 1) * seconds - now
+                else:
+                    # Until enough of the previous window has slid out
+                    wait = ((1 - (limit - current - 1) / previous) - (1 - overlap)) * seconds
+                return 0, max(wait, 0.001)
+            if SendQuotaWindow.objects.filter(name=name, window=window, count__lte=allowed - tokens).update(
+                count=F("count") + tokens
+            ):
+                return tokens, 0
+        # Other senders keep getting there first
+        return 0, 0.001
+
+
+_send_quota = None
+_send_quota_config = None
+_send_quota_lock = threading.Lock()
+
+
+def get_send_quota():
+    """
+    Returns the SendQuota for MAILER_SEND_QUOTAS and
+    MAILER_SEND_QUOTA_LEASE_SIZE, shared by the whole process, or None if no
+    quotas are set.
+    """
+    global _send_quota, _send_quota_config
+
+    quotas = getattr(settings, "MAILER_SEND_QUOTAS", None)
+    if not quotas:
+        return None
+    config = (quotas, getattr(settings, "MAILER_SEND_QUOTA_LEASE_SIZE", 10))
+    with _send_quota_lock:
+        if _send_quota is None or config != _send_quota_config:
+            _send_quota = SendQuota(*config)
+            _send_quota_config = config
+        return _send_quota
@@ -0,0 +1,226 @@
+"""
+Routing of messages between several email backends, configured with
+MAILER_EMAIL_BACKENDS.
+
+Each backend is a dict like Django's CACHES or DATABASES entries:
+
+- ``BACKEND``: the dotted path of the email backend class.
+- ``OPTIONS``: keyword arguments for the backend, e.g. ``host``.
+- ``WEIGHT``: its share of the messages it can take (default: 1).
+- ``MAX_CONCURRENCY``: how many messages may be sent through it at once
+  (default: no limit).
+- ``FROM_DOMAINS``, ``PRIORITIES``, ``HEADERS``: routing rules, see
+  BackendRoute.matches().
+
+Messages matching the rules of some backends are sent through those only,
+others through the backends without rules. Backends that fail are given
+less traffic, and none at all for a while once they have failed
+`failure_threshold` times in a row.
+"""
+
+import fnmatch
+import logging
+import random
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from mailer.models import PRIORITY_MAPPING
+from mailer.ratelimit import get_domain
+
+logger = logging.getLogger(__name__)
+
+
+def is_backend_failure(exc):
+    """
+    Returns True if `exc` shows a problem with the backend, rather than with
+    the message being sent.
+    """
+    return not isinstance(exc, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused))
+
+
+class BackendRoute:
+    """
+    One of the MAILER_EMAIL_BACKENDS, with its rules and health.
+    """
+
+    def __init__(
+        self,
+        name,
+        backend,
+        options=None,
+        weight=1,
+        max_concurrency=None,
+        from_domains=None,
+        priorities=None,
+        headers=None,
+    ):
+        self.name = name
+        self.backend = backend
+        self.options = options or {}
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.from_domains = [pattern.lower() for pattern in from_domains] if from_domains else None
+        self.priorities = {PRIORITY_MAPPING.get(priority, priority) for priority in priorities} if priorities else None
+        self.headers = {name.lower(): value for name, value in headers.items()} if headers else None
+        # Messages being sent through this backend
+        self.in_use = 0
+        # Failures since the last success
+        self.failures = 0
+        self.unhealthy_until = 0
+
+    @classmethod
+    def from_config(cls, name, config):
+        if "BACKEND" not in config:
+            raise ImproperlyConfigured(f"MAILER_EMAIL_BACKENDS['{name}'] has no BACKEND")
+        return cls(
+            name,
+            config["BACKEND"],
+            options=config.get("OPTIONS"),
+            weight=config.get("WEIGHT", 1),
+            max_concurrency=config.get("MAX_CONCURRENCY"),
+            from_domains=config.get("FROM_DOMAINS"),
+            priorities=config.get("PRIORITIES"),
+            headers=config.get("HEADERS"),
+        )
+
+    @property
+    def has_rules(self):
+        return self.from_domains is not None or self.priorities is not None or self.headers is not None
+
+    def matches(self, message):
+        """
+        Returns True if the message meets all the rules of this backend: its
+        sender domain matches one of the FROM_DOMAINS patterns, its priority is
+        one of the PRIORITIES (given as numbers or names), and each of the
+        HEADERS it has, with a value matching the given pattern.
+        """
+        email = message.email
+        if self.priorities is not None and message.priority not in self.priorities:
+            return False
+        if self.from_domains is not None:
+            domain = get_domain(email.from_email) if email is not None else ""
+            if not any(fnmatch.fnmatchcase(domain, pattern) for pattern in self.from_domains):
+                return False
+        if self.headers is not None:
+            headers = {name.lower(): str(value) for name, value in email.extra_headers.items()} if email else {}
+            for name, pattern in self.headers.items():
+                if name not in headers or not fnmatch.fnmatchcase(headers[name], pattern):
+                    return False
+        return True
+
+    def healthy(self, now):
+        return now >= self.unhealthy_until
+
+    def available(self):
+        return self.max_concurrency is None or self.in_use < self.max_concurrency
+
+    def current_weight(self):
+        # Halved for every failure since the last success
+        return self.weight / 2**self.failures
+
+
+class BackendRouter:
+    """
+    Picks a backend for each message among `routes`, a list of BackendRoute.
+    Instances are safe to use from several threads.
+    """
+
+    def __init__(self, routes, failure_threshold=3, retry_after=60):
+        if not any(not route.has_rules for route in routes):
+            raise ImproperlyConfigured(
+                "MAILER_EMAIL_BACKENDS needs a backend without routing rules, for the messages no rules match"
+            )
+        self.routes = routes
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.random = random.Random()
+
+    def candidates(self, message, exclude=()):
+        matching = [route for route in self.routes if route.has_rules and route.matches(message)]
+        if not matching:
+            matching = [route for route in self.routes if not route.has_rules]
+        return [route for route in matching if route not in exclude]
+
+    def acquire(self, message, exclude=()):
+        """
+        Picks a backend for the message, other than those in `exclude`, and
+        reserves it until release() is called. Waits for a backend to be
+        available if all are at their MAX_CONCURRENCY. Returns None if there
+        is no backend left to pick.
+
+        Healthy backends are preferred, but if all the backends the message
+        may use are unhealthy, it is sent through them anyway.
+        """
+        with self.condition:
+            candidates = self.candidates(message, exclude)
+            if not candidates:
+                return None
+            while True:
+                now = time.monotonic()
+                routes = [route for route in candidates if route.healthy(now)] or candidates
+                routes = [route for route in routes if route.available()]
+                if routes:
+                    # Backends with a WEIGHT of 0 only get messages no other
+                    # backend can take
+                    weights = [route.current_weight() for route in routes]
+                    route = self.random.choices(routes, weights=weights if any(weights) else None)[0]
+                    route.in_use += 1
+                    return route
+                self.condition.wait()
+
+    def release(self, route):
+        with self.condition:
+            route.in_use -= 1
+            self.condition.notify_all()
+
+    def record(self, route, exc=None):
+        """
+        Updates the health of a backend after a message was sent through it,
+        given the error sending failed with, if any.
+        """
+        with self.condition:
+            if exc is None:
+                route.failures = 0
+                route.unhealthy_until = 0
+            elif is_backend_failure(exc):
+                route.failures += 1
+                if route.failures >= self.failure_threshold:
+                    logger.warning(
+                        f"email backend '{route.name}' failed {route.failures} times in a row, "
+                        f"avoiding it for {self.retry_after} seconds"
+                    )
+                    route.unhealthy_until = time.monotonic() + self.retry_after
+
+
+_router = None
+_router_config = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """
+    Returns the BackendRouter for MAILER_EMAIL_BACKENDS, shared by the whole
+    process so that the health of the backends is remembered between runs,
+    or None if MAILER_EMAIL_BACKENDS isn't set.
+    """
+    global _router, _router_config
+
+    backends = getattr(settings, "MAILER_EMAIL_BACKENDS", None)
+    if not backends:
+        return None
+    config = (
+        backends,
+        getattr(settings, "MAILER_BACKEND_FAILURE_THRESHOLD", 3),
+        getattr(settings, "MAILER_BACKEND_RETRY_AFTER", 60),
+    )
+    with _router_lock:
+        if _router is None or config != _router_config:
+            routes = [BackendRoute.from_config(name, backend) for name, backend in backends.items()]
+            _router = BackendRouter(routes, *config[1:])
+            _router_config = config
+        return _router
@@ -0,0 +1,85 @@
+"""
+Binary storage format for messages, used when MAILER_MESSAGE_DATA_FORMAT is
+set to "binary".
+
+Stored data starts with a short header identifying the format version and the
+compression used, followed by the output of the MAILER_SERIALIZER class,
+possibly compressed.
+"""
+
+import lzma
+import pickle
+import zlib
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+MAGIC = b"DJM"
+FORMAT_VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+CODECS = {
+    CODEC_NONE: (lambda data: data, lambda data: data),
+    CODEC_ZLIB: (zlib.compress, zlib.decompress),
+    CODEC_LZMA: (lzma.compress, lzma.decompress),
+}
+
+CODEC_NAMES = {
+    "zlib": CODEC_ZLIB,
+    "lzma": CODEC_LZMA,
+}
+
+
+class PickleSerializer:
+    """
+    The default serializer, which can store any EmailMessage subclass.
+    """
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=pickle.DEFAULT_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+def get_serializer():
+    return import_string(getattr(settings, "MAILER_SERIALIZER", "mailer.serializers.PickleSerializer"))()
+
+
+def is_binary_format(data):
+    """
+    Returns True if data was written by dumps().
+    """
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def dumps(obj):
+    """
+    Serializes obj, compressing the result if it is at least
+    MAILER_MESSAGE_DATA_COMPRESS_MIN_SIZE bytes long.
+    """
+    data = get_serializer().dumps(obj)
+    codec = CODEC_NONE
+    min_size = getattr(settings, "MAILER_MESSAGE_DATA_COMPRESS_MIN_SIZE", 1024)
+    if min_size is not None and len(data) >= min_size:
+        codec = CODEC_NAMES[getattr(settings, "MAILER_MESSAGE_DATA_COMPRESSION", "zlib")]
+        data = CODECS[codec][0](data)
+    return MAGIC + bytes([FORMAT_VERSION, codec]) + data
+
+
+def loads(data):
+    """
+    Deserializes data written by dumps(). Raises ValueError if it isn't in a
+    known format.
+    """
+    data = bytes(data)
+    header_size = len(MAGIC) + 2
+    if len(data) < header_size or data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not django-mailer binary message data")
+    version, codec = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != FORMAT_VERSION or codec not in CODECS:
+        raise ValueError(f"Unsupported message data format {version}/{codec}")
+    return get_serializer().loads(CODECS[codec][1](data[header_size:]))
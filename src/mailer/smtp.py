@@ -0,0 +1,237 @@
+"""
+An SMTP email backend that resumes TLS sessions when it reconnects, and
+pipelines commands when the server allows it.
+
+Use it by setting MAILER_EMAIL_BACKEND to "mailer.smtp.EmailBackend". It takes
+the same settings and options as Django's SMTP backend. The TLS session of
+the last connection to each server is kept for the whole process, and offered
+to the server when connecting again, which saves a full handshake if the
+server accepts it. Since a session can only be used with the SSLContext it
+was made by, the context is kept along with it, and shared by all backends
+connecting to the same server with the same TLS settings.
+
+If the server advertises PIPELINING (RFC 2920), the MAIL FROM, RCPT TO and DATA
+commands of a message are sent together, and their replies read afterwards,
+which saves a round trip for each of them but one.
+"""
+
+import re
+import smtplib
+import ssl
+import threading
+
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.utils import DNS_NAME
+
+# (host, port, ssl_certfile, ssl_keyfile) -> ssl.SSLContext
+_ssl_contexts = {}
+# (host, port, ssl_certfile, ssl_keyfile) -> ssl.SSLSession
+_tls_sessions = {}
+_tls_sessions_lock = threading.Lock()
+
+
+class ResumingSSLContext:
+    """
+    Wraps an SSLContext, so that the sockets it wraps try to resume `session`.
+    """
+
+    def __init__(self, context, session):
+        self.context = context
+        self.session = session
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault("session", self.session)
+        return self.context.wrap_socket(sock, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+class PipeliningMixin:
+    """
+    Makes sendmail() pipeline its commands when the server supports it.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        # Leave anything that needs encoding to smtplib
+        if (
+            not self.has_extn("pipelining")
+            or isinstance(msg, str)
+            or not all(address.isascii() for address in [from_addr, *to_addrs])
+        ):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        mail_options = list(mail_options)
+        if self.has_extn("size"):
+            mail_options.insert(0, f"size={len(msg)}")
+        commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{format_options(mail_options)}"]
+        commands.extend(f"RCPT TO:{smtplib.quoteaddr(address)}{format_options(rcpt_options)}" for address in to_addrs)
+        commands.append("DATA")
+        self.send("".join(f"{command}\r\n" for command in commands))
+
+        mail_reply = self.getreply()
+        refused = {}
+        for address in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                refused[address] = (code, resp)
+        data_code, data_resp = self.getreply()
+
+        if mail_reply[0] != 250 or len(refused) == len(to_addrs) or data_code != 354:
+            if data_code == 354:
+                # The server wants a message anyway, end it straight away
+                self.send(b".\r\n")
+                self.getreply()
+            if mail_reply[0] == 421 or data_code == 421:
+                self.close()
+            else:
+                self._rset()
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(*mail_reply, from_addr)
+            if len(refused) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        data = re.sub(rb"(?m)^\.", b"..", msg)
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+        self.send(data + b".\r\n")
+        code, resp = self.getreply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+
+def format_options(options):
+    return "".join(f" {option}" for option in options)
+
+
+class PipeliningSMTP(PipeliningMixin, smtplib.SMTP):
+    pass
+
+
+class PipeliningSMTP_SSL(PipeliningMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class EmailBackend(SMTPEmailBackend):
+    def __init__(self, *args, tls_session_resumption=True, pipelining=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tls_session_resumption = tls_session_resumption
+        self.pipelining = pipelining
+        # Whether the server resumed the TLS session of an earlier connection
+        self.tls_session_reused = False
+        self._base_ssl_context = None
+
+    @property
+    def connection_class(self):
+        if not self.pipelining:
+            return super().connection_class
+        return PipeliningSMTP_SSL if self.use_ssl else PipeliningSMTP
+
+    @property
+    def tls_session_key(self):
+        return (self.host, self.port, self.ssl_certfile, self.ssl_keyfile)
+
+    def make_ssl_context(self):
+        context = ssl.create_default_context()
+        if self.ssl_certfile or self.ssl_keyfile:
+            context.load_cert_chain(self.ssl_certfile, self.ssl_keyfile)
+        return context
+
+    def get_ssl_context(self):
+        """
+        Returns the SSLContext to connect with, wrapped to offer the saved TLS
+        session if there is one.
+        """
+        if not self.tls_session_resumption:
+            if self._base_ssl_context is None:
+                self._base_ssl_context = self.make_ssl_context()
+            return self._base_ssl_context
+        with _tls_sessions_lock:
+            context = _ssl_contexts.get(self.tls_session_key)
+            if context is None:
+                context = _ssl_contexts[self.tls_session_key] = self.make_ssl_context()
+            session = _tls_sessions.get(self.tls_session_key)
+        if session is None:
+            return context
+        return ResumingSSLContext(context, session)
+
+    def save_tls_session(self, sock):
+        session = getattr(sock, "session", None)
+        if isinstance(sock, ssl.SSLSocket):
+            self.tls_session_reused = sock.session_reused
+        if session is not None and self.tls_session_resumption:
+            with _tls_sessions_lock:
+                _tls_sessions[self.tls_session_key] = session
+
+    def forget_tls_session(self, session):
+        with _tls_sessions_lock:
+            if _tls_sessions.get(self.tls_session_key) is session:
+                del _tls_sessions[self.tls_session_key]
+
+    def connect(self, context):
+        connection_params = {"local_hostname": DNS_NAME.get_fqdn()}
+        if self.timeout is not None:
+            connection_params["timeout"] = self.timeout
+        if self.use_ssl:
+            connection_params["context"] = context
+        connection = self.connection_class(self.host, self.port, **connection_params)
+        try:
+            if not self.use_ssl and self.use_tls:
+                connection.starttls(context=context)
+            if self.username and self.password:
+                connection.login(self.username, self.password)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def open(self):
+        """
+        Like Django's SMTP backend, with TLS session resumption.
+        """
+        if self.connection:
+            return False
+
+        try:
+            context = self.get_ssl_context() if self.use_ssl or self.use_tls else None
+            try:
+                connection = self.connect(context)
+            except (ValueError, ssl.SSLError):
+                if not isinstance(context, ResumingSSLContext):
+                    raise
+                # The saved session couldn't be resumed, connect again with a
+                # full handshake.
+                self.forget_tls_session(context.session)
+                connection = self.connect(context.context)
+            self.connection = connection
+            self.save_tls_session(connection.sock)
+            return True
+        except OSError:
+            if not self.fail_silently:
+                raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                # Like quit(), but the TLS session is saved before the socket
+                # is closed: TLS 1.3 servers send session tickets after the
+                # handshake, which are only read along with later replies.
+                self.connection.docmd("quit")
+                self.save_tls_session(self.connection.sock)
+                self.connection.close()
+            except (ssl.SSLError, smtplib.SMTPServerDisconnected):
+                self.connection.close()
+            except smtplib.SMTPException:
+                if not self.fail_silently:
+                    raise
+            finally:
+                self.connection = None
@@ -1,4 +1,9 @@
+import os
 import smtplib
+import socketserver
+import ssl
+import threading
+import time
 
 from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
 
@@ -30,3 +35,173 @@ class TestMailerEmailBackend:
 class FailingMailerEmailBackend(LocMemEmailBackend):
     def send_messages(self, email_messages):
         raise smtplib.SMTPSenderRefused(1, "foo", "foo@foo.com")
+
+
+class CountingConnectionEmailBackend(TestMailerEmailBackend):
+    opened = 0
+    closed = 0
+
+    def open(self):
+        type(self).opened += 1
+
+    def close(self):
+        type(self).closed += 1
+
+
+class NamedEmailBackend(LocMemEmailBackend):
+    """
+    Marks the messages it sends with its `name`, in an X-Backend header.
+    """
+
+    def __init__(self, name=None, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+
+    def send_messages(self, email_messages):
+        for m in email_messages:
+            m.extra_headers["X-Backend"] = self.name
+        return super().send_messages(email_messages)
+
+
+class UnreachableEmailBackend(LocMemEmailBackend):
+    attempts = 0
+
+    def open(self):
+        type(self).attempts += 1
+        raise ConnectionRefusedError("Connection refused")
+
+
+# A self-signed certificate for 127.0.0.1, with its key
+TLS_KEYCERT = os.path.join(os.path.dirname(__file__), "keycert.pem")
+
+
+class SMTPStandInHandler(socketserver.BaseRequestHandler):
+    """
+    Replies are held back until the client has to wait for them, and then
+    sent together after the server's `latency`, so that each round trip the
+    client makes takes that long, as over a slow network.
+    """
+
+    def setup(self):
+        self.buffer = b""
+        self.replies = []
+
+    def reply(self, line):
+        self.replies.append(line.encode("ascii") + b"\r\n")
+
+    def flush_replies(self):
+        if self.replies:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.server.round_trips += 1
+            self.request.sendall(b"".join(self.replies))
+            self.replies = []
+
+    def readline(self):
+        while b"\n" not in self.buffer:
+            # Nothing more to do until the client sends more
+            self.flush_replies()
+            data = self.request.recv(65536)
+            if not data:
+                line, self.buffer = self.buffer, b""
+                return line
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line + b"\n"
+
+    def handle(self):
+        try:
+            self.converse()
+        finally:
+            self.flush_replies()
+
+    def converse(self):
+        server = self.server
+        self.reply("220 localhost stand-in ESMTP")
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            command, _, arg = line.decode("ascii").strip().partition(" ")
+            command = command.upper()
+            server.commands.append(command)
+            if command in ("EHLO", "HELO"):
+                self.reply("250-localhost")
+                if server.pipelining:
+                    self.reply("250-PIPELINING")
+                if server.tls_context is not None and not isinstance(self.request, ssl.SSLSocket):
+                    self.reply("250-STARTTLS")
+                self.reply("250-AUTH PLAIN")
+                self.reply("250 8BITMIME")
+            elif command == "STARTTLS":
+                self.reply("220 Ready to start TLS")
+                self.flush_replies()
+                self.request = server.tls_context.wrap_socket(self.request, server_side=True)
+                server.tls_sessions_reused.append(self.request.session_reused)
+            elif command == "AUTH":
+                self.reply("235 Authentication successful")
+            elif command == "MAIL":
+                mail_from, rcpt_to = arg[len("FROM:") :].strip("<>"), []
+                self.reply("250 OK")
+            elif command == "RCPT":
+                recipient = arg[len("TO:") :].strip("<>")
+                if recipient in server.refused_recipients:
+                    self.reply("550 No such user")
+                else:
+                    rcpt_to.append(recipient)
+                    self.reply("250 OK")
+            elif command == "DATA":
+                if not rcpt_to:
+                    self.reply("554 No valid recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    line = self.readline()
+                    if line in (b".\r\n", b""):
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                server.messages.append((mail_from, rcpt_to, b"".join(lines)))
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("250 OK")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    A minimal SMTP server on localhost, which collects the messages it
+    receives as (envelope sender, envelope recipients, data) tuples.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, refused_recipients=(), pipelining=False, latency=0, tls_context=None):
+        super().__init__(("127.0.0.1", 0), SMTPStandInHandler)
+        self.refused_recipients = set(refused_recipients)
+        self.pipelining = pipelining
+        self.latency = latency
+        # Offers STARTTLS if given, recording whether each handshake resumed
+        # a session in tls_sessions_reused
+        self.tls_context = tls_context
+        self.tls_sessions_reused = []
+        self.commands = []
+        self.messages = []
+        self.round_trips = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 INSTALLED_APPS = [
     "django.contrib.auth",
     "django.contrib.contenttypes",
@@ -8,6 +11,10 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": ":memory:",
+        # Some tests send from several threads at once, which the shared
+        # in-memory database doesn't support. The name is unique to each run,
+        # so that runs on the same machine don't overwrite each other's.
+        "TEST": {"NAME": os.path.join(tempfile.gettempdir(), f"django_mailer_tests_{os.getpid()}.sqlite3")},
     }
 }
 
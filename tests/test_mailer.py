@@ -1,6 +1,19 @@
+import collections
+import contextlib
 import datetime
+import json
+import os
 import pickle
+import smtplib
+import socket
+import ssl
+import tempfile
 import time
+import unittest
+import urllib.request
+from email import message_from_bytes
+from functools import partial
+from io import StringIO
 from unittest.mock import Mock, PropertyMock, patch
 
 import django
@@ -8,10 +21,25 @@ import lockfile
 import mailer
 from django.core import mail
 from django.core.exceptions import ImproperlyConfigured
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now as datetime_now
-from mailer import engine
+from mailer import (
+    async_backends,
+    circuitbreaker,
+    engine,
+    logsinks,
+    metrics,
+    partitioning,
+    pool,
+    ratelimit,
+    routing,
+    serializers,
+    smtp,
+)
 from mailer.models import (
     PRIORITY_DEFERRED,
     PRIORITY_HIGH,
@@ -22,12 +50,29 @@ from mailer.models import (
     DontSendEntry,
     Message,
     MessageLog,
+    PrerenderedEmailMessage,
     db_to_email,
+    dont_send_cache,
+    email_to_bytes,
     email_to_db,
     make_message,
 )
 
-from . import TestMailerEmailBackend
+try:
+    from mailer.async_engine import async_send_all
+except ImportError:
+    # asgiref only comes with Django 3.0 and later
+    async_send_all = None
+else:
+    from asgiref.sync import async_to_sync
+
+from . import (
+    TLS_KEYCERT,
+    CountingConnectionEmailBackend,
+    SMTPStandIn,
+    TestMailerEmailBackend,
+    UnreachableEmailBackend,
+)
 
 
 class BackendTest(TestCase):
@@ -143,6 +188,43 @@ class SendingTest(TestCase):
             # Message remain deferred
             self.assertEqual(Message.objects.deferred().count(), 1)
 
+    def test_retry_backoff(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend",
+            MAILER_EMAIL_MAX_RETRIES=2,
+            MAILER_RETRY_BACKOFF_BASE=60,
+            MAILER_RETRY_BACKOFF_JITTER=0,
+        ):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["recipient@example.com"])
+            now = datetime_now()
+            for n, delay in enumerate([60, 120]):
+                with self.subTest(tries=n), patch.object(mailer.models, "datetime_now", return_value=now):
+                    with patch.object(engine, "datetime_now", return_value=now):
+                        engine.send_all()
+                    # Still in the queue, but not due
+                    message = Message.objects.get()
+                    self.assertEqual(message.priority, PRIORITY_MEDIUM)
+                    self.assertEqual(message.retry_count, n + 1)
+                    self.assertEqual(message.next_attempt_at, now + datetime.timedelta(seconds=delay))
+                    with patch.object(engine, "datetime_now", return_value=now):
+                        self.assertFalse(engine.prioritize().exists())
+                        engine.send_all()
+                    self.assertEqual(MessageLog.objects.count(), n + 1)
+                    now = message.next_attempt_at
+
+            # Out of retries, the message is deferred
+            with patch.object(engine, "datetime_now", return_value=now):
+                engine.send_all()
+            self.assertEqual(MessageLog.objects.count(), 3)
+            self.assertEqual(Message.objects.deferred().count(), 1)
+
+    def test_retry_backoff_limits(self):
+        with self.settings(MAILER_RETRY_BACKOFF_BASE=10, MAILER_RETRY_BACKOFF_MAX=100, MAILER_RETRY_BACKOFF_JITTER=0.5):
+            for i in range(20):
+                self.assertLessEqual(mailer.models.retry_backoff(10), datetime.timedelta(seconds=150))
+                self.assertGreaterEqual(mailer.models.retry_backoff(0), datetime.timedelta(seconds=5))
+        self.assertIsNone(mailer.models.retry_backoff(0))
+
     def test_purge_old_entries(self):
         def send_mail(success):
             backend = "django.core.mail.backends.locmem.EmailBackend" if success else "tests.FailingMailerEmailBackend"
@@ -183,6 +265,46 @@ class SendingTest(TestCase):
 
         self.assertEqual(MessageLog.objects.count(), 0)
 
+    def test_purge_old_entries_in_chunks(self):
+        old = datetime_now() - datetime.timedelta(days=2)
+        MessageLog.objects.bulk_create(
+            MessageLog(when_added=old, when_attempted=old, priority=PRIORITY_MEDIUM, result=result, log_message="")
+            for result in [RESULT_SUCCESS] * 5 + [RESULT_FAILURE] + [RESULT_SUCCESS] * 2
+        )
+        MessageLog.objects.create(when_added=old, priority=PRIORITY_MEDIUM, result=RESULT_SUCCESS, log_message="")
+
+        progress = Mock()
+        with patch("time.sleep") as sleep:
+            count = MessageLog.objects.purge_old_entries(1, batch_size=3, sleep=0.5, progress=progress)
+        self.assertEqual(count, 7)
+        self.assertEqual([c.args[0] for c in progress.call_args_list], [3, 6, 7])
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(MessageLog.objects.filter(result=RESULT_FAILURE).count(), 1)
+        self.assertEqual(MessageLog.objects.filter(result=RESULT_SUCCESS).count(), 1)
+
+    def test_purge_old_entries_max_seconds(self):
+        old = datetime_now() - datetime.timedelta(days=2)
+        MessageLog.objects.bulk_create(
+            MessageLog(when_added=old, when_attempted=old, priority=PRIORITY_MEDIUM, result=RESULT_SUCCESS)
+            for i in range(5)
+        )
+        stdout = StringIO()
+        call_command("purge_mail_log", "1", "--batch-size", "2", "--max-seconds", "0", stdout=stdout)
+        self.assertEqual(MessageLog.objects.count(), 3)
+        self.assertEqual(stdout.getvalue().splitlines(), ["2 log entries deleted so far", "2 log entries deleted"])
+
+    def test_purge_old_entries_signals(self):
+        old = datetime_now() - datetime.timedelta(days=2)
+        MessageLog.objects.bulk_create(
+            MessageLog(when_added=old, when_attempted=old, priority=PRIORITY_MEDIUM, result=RESULT_SUCCESS)
+            for i in range(3)
+        )
+        receiver = Mock()
+        post_delete.connect(receiver, sender=MessageLog)
+        self.addCleanup(post_delete.disconnect, receiver, sender=MessageLog)
+        self.assertEqual(MessageLog.objects.purge_old_entries(1, batch_size=2), 3)
+        self.assertEqual(receiver.call_count, 3)
+
     def test_send_loop(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             with patch("mailer.engine.send_all", side_effect=StopIteration) as send:
@@ -228,6 +350,40 @@ class SendingTest(TestCase):
             # Alternative "text/html"
             self.assertEqual(sent.alternatives[0], ("<html><body>Body</body></html>", "text/html"))
 
+    def test_send_html_encoded_once(self):
+        with patch("mailer.models.email_to_db", wraps=mailer.models.email_to_db) as encode, patch(
+            "mailer.models.db_to_email", wraps=mailer.models.db_to_email
+        ) as decode:
+            mailer.send_html_mail("Subject", "Body", "<p>Body</p>", "sender@example.com", ["recipient@example.com"])
+        encode.assert_called_once()
+        decode.assert_not_called()
+
+        email = Message.objects.get().email
+        self.assertIsInstance(email, mail.EmailMultiAlternatives)
+        self.assertEqual(email.alternatives[0], ("<p>Body</p>", "text/html"))
+
+    def test_send_html_mail_many(self):
+        DontSendEntry.objects.create(to_address="nogo@example.com", when_added=datetime_now())
+        with self.settings(MAILER_PRERENDER_MESSAGES=True):
+            count = mailer.send_html_mail_many(
+                "Subject",
+                "Body",
+                "<p>Body</p>",
+                "sender@example.com",
+                (f"recipient{i}@example.com" for i in range(3)),
+                headers={"X-Campaign": "1"},
+            )
+        self.assertEqual(count, 3)
+
+        with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
+            engine.send_all()
+        self.assertEqual([sent.to for sent in mail.outbox], [[f"recipient{i}@example.com"] for i in range(3)])
+        messages = [message_from_bytes(sent.message().as_bytes()) for sent in mail.outbox]
+        self.assertEqual(len({m["Message-ID"] for m in messages}), 3)
+        for m in messages:
+            self.assertEqual(m["X-Campaign"], "1")
+            self.assertIn(b"<p>Body</p>", m.as_bytes())
+
     def test_send_mass_mail(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             mails = (
@@ -254,6 +410,24 @@ class SendingTest(TestCase):
                 self.assertEqual(sent.from_email, f"mass{i}@example.com")
                 self.assertEqual(sent.to, [f"recipient{i}@example.com"])
 
+    def test_enqueue_many(self):
+        DontSendEntry.objects.create(to_address="nogo@example.com", when_added=datetime_now())
+        emails = (
+            mail.EmailMessage(
+                "Subject", "Body", "sender@example.com", [f"recipient{i}@example.com", "nogo@example.com"]
+            )
+            for i in range(5)
+        )
+        # For each of the 3 chunks: the don't send lookup, and one INSERT
+        # wrapped in a savepoint.
+        with self.assertNumQueries(3 * 4):
+            count = mailer.enqueue_many(emails, priority=PRIORITY_HIGH, batch_size=2)
+
+        self.assertEqual(count, 5)
+        messages = list(Message.objects.order_by("id"))
+        self.assertEqual([m.email.to for m in messages], [[f"recipient{i}@example.com"] for i in range(5)])
+        self.assertEqual({m.priority for m in messages}, {PRIORITY_HIGH})
+
     def test_mail_admins(self):
         with self.settings(
             MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
@@ -430,6 +604,1081 @@ class SendingTest(TestCase):
             self.assertEqual(m.message_id, "foo")
 
 
+class ConnectionReuseTest(TestCase):
+    def setUp(self):
+        CountingConnectionEmailBackend.opened = 0
+        CountingConnectionEmailBackend.closed = 0
+
+    def test_single_connection(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend"):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(CountingConnectionEmailBackend.outbox), 3)
+            self.assertEqual(CountingConnectionEmailBackend.opened, 1)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 1)
+
+    def test_max_messages_per_connection(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend", MAILER_CONNECTION_MAX_MESSAGES=2
+        ):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(MessageLog.objects.count(), 3)
+            self.assertEqual(CountingConnectionEmailBackend.opened, 2)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 2)
+
+    def test_reconnect_after_failure(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend"):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            with patch.object(
+                CountingConnectionEmailBackend,
+                "send_messages",
+                side_effect=[None, smtplib.SMTPServerDisconnected("gone"), None],
+            ):
+                engine.send_all()
+            self.assertEqual(Message.objects.deferred().count(), 1)
+            # The failed connection is closed, and a new one opened
+            self.assertEqual(CountingConnectionEmailBackend.opened, 2)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 2)
+
+
+class DomainRateLimitTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(ratelimit, "_rate_limiter", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_buckets(self):
+        limiter = ratelimit.DomainRateLimiter({"*.example.com": (1, 2), "example.org": 0.5})
+        with patch("time.monotonic", return_value=100):
+            self.assertTrue(limiter.acquire(["Someone <a@mail.EXAMPLE.com>"]))
+            self.assertTrue(limiter.acquire(["b@mail.example.com"]))
+            self.assertFalse(limiter.acquire(["c@mail.example.com", "d@example.net"]))
+            # Each domain has its own bucket
+            self.assertTrue(limiter.acquire(["e@other.example.com"]))
+            self.assertTrue(limiter.acquire(["f@example.org", "g@example.net"]))
+            self.assertFalse(limiter.acquire(["h@example.org"]))
+            self.assertTrue(limiter.acquire(["i@example.net"] * 10))
+            self.assertEqual(limiter.wait_time(), 1)
+        with patch("time.monotonic", return_value=101):
+            self.assertTrue(limiter.acquire(["j@mail.example.com"]))
+            self.assertFalse(limiter.acquire(["k@mail.example.com"]))
+            self.assertEqual(limiter.wait_time(), 1)
+
+    def test_send_all_skips_limited_domains(self):
+        for i in range(3):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"user{i}@slow.example.com"])
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"user{i}@fast.example.com"])
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend",
+            MAILER_DOMAIN_RATE_LIMITS={"slow.example.com": 0.001},
+            MAILER_EMAIL_THROTTLE=1,
+        ):
+            with patch("time.sleep") as sleep:
+                counts = engine.send_all()
+            # Only sent messages are throttled
+            self.assertEqual(sleep.call_count, 4)
+            self.assertEqual(counts, {"sent": 4, "deferred": 0, "skipped": 2})
+            self.assertEqual(
+                sorted(m.email.to[0] for m in Message.objects.all()),
+                ["user1@slow.example.com", "user2@slow.example.com"],
+            )
+            self.assertEqual(engine.wait_for_rate_limits(counts), 0)
+            # Held back until the bucket has a token again, one after another
+            delays = sorted((m.next_attempt_at - datetime_now()).total_seconds() for m in Message.objects.all())
+            self.assertAlmostEqual(delays[0], 1000, delta=10)
+            self.assertAlmostEqual(delays[1], 2000, delta=10)
+            self.assertFalse(engine.prioritize().exists())
+            self.assertEqual(engine.empty_queue_sleep_time(), engine.EMPTY_QUEUE_SLEEP)
+            # Later runs don't load them just to skip them again
+            with self.assertNumQueries(1):
+                counts = engine.send_all()
+            self.assertEqual(counts, {"sent": 0, "deferred": 0, "skipped": 0})
+
+    def test_empty_queue_sleep_time(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["user@slow.example.com"])
+        Message.objects.update(next_attempt_at=datetime_now() + datetime.timedelta(seconds=5))
+        self.assertAlmostEqual(engine.empty_queue_sleep_time(), 5, delta=1)
+
+
+class SendQuotaTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(ratelimit, "_send_quota", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_between_senders(self):
+        senders = [ratelimit.SendQuota([(5, 10)], lease_size=2) for i in range(2)]
+        sent = 0
+        with patch("time.time", return_value=1000.0):
+            for i in range(5):
+                for sender in senders:
+                    if not sender.acquire():
+                        sent += 1
+            self.assertEqual(sent, 5)
+            # Full until the next window, and a fifth of it
+            self.assertEqual(senders[0].acquire(), 12)
+            self.assertEqual(senders[0].wait_time(), 12)
+
+        # Halfway through the next window, half of the previous one counts
+        with patch("time.time", return_value=1015.0):
+            self.assertEqual(senders[0].acquire(), 0)
+            self.assertEqual(senders[0].acquire(), 0)
+            # Until another 10% of the previous window is out of it
+            self.assertAlmostEqual(senders[1].acquire(), 1)
+        self.assertEqual(mailer.models.SendQuotaWindow.objects.get(window=101).count, 2)
+
+    def test_send_all_stops_at_quota(self):
+        for i in range(3):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"user{i}@example.com"])
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_SEND_QUOTAS=[(2, 3600)]):
+            counts = engine.send_all()
+            self.assertEqual(counts["sent"], 2)
+            self.assertEqual(Message.objects.count(), 1)
+            self.assertEqual(engine.wait_for_rate_limits(counts), engine.EMPTY_QUEUE_SLEEP)
+
+    def test_quota_taken_before_locking(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["user@slow.example.com"])
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["user@example.com"])
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def acquire():
+            depths.append(len(connection.atomic_blocks))
+            return 0
+
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend",
+            MAILER_SEND_QUOTAS=[(10, 3600)],
+            MAILER_DOMAIN_RATE_LIMITS={"slow.example.com": (0.001, 0)},
+        ), patch.object(ratelimit, "_rate_limiter", None):
+            with patch.object(ratelimit.SendQuota, "acquire", side_effect=acquire):
+                counts = engine.send_all()
+        self.assertEqual(counts, {"sent": 1, "deferred": 0, "skipped": 1})
+        # Not while the message is locked, and not again for the skipped one
+        self.assertEqual(depths, [depth])
+
+    def test_short_waits(self):
+        clock = Mock(return_value=1000.0)
+
+        def sleep(seconds):
+            clock.return_value += seconds
+
+        with self.settings(MAILER_SEND_QUOTAS=[(2, 1)]), patch("time.time", clock):
+            with patch("time.sleep", side_effect=sleep) as sleep_patch:
+                for i in range(3):
+                    self.assertTrue(engine._wait_for_quota())
+            sleep_patch.assert_called_once_with(1.5)
+
+
+class GroupMessagesTest(TestCase):
+    def test_group_messages(self):
+        Item = collections.namedtuple("Item", ["priority", "key"])
+        items = [Item(1, "a"), Item(1, "b"), Item(1, "a"), Item(1, "b"), Item(1, "a"), Item(2, "a"), Item(2, "b")]
+        grouped = engine.group_messages(items, key=lambda item: item.key, window=4)
+        self.assertEqual(
+            grouped,
+            [items[0], items[2], items[1], items[3], items[4], items[5], items[6]],
+        )
+
+    def test_send_all_grouped_by_domain(self):
+        for domain in ["a.example", "b.example", "A.example", "c.example", "b.example"]:
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"user@{domain}"])
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["user@c.example"], priority=PRIORITY_LOW)
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["user@a.example"], priority=PRIORITY_LOW)
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_CLAIM_BATCH_SIZE=10, MAILER_GROUP_BY="domain"
+        ):
+            engine.send_all()
+        self.assertEqual(
+            [email.to[0] for email in TestMailerEmailBackend.outbox],
+            [
+                "user@a.example",
+                "user@A.example",
+                "user@b.example",
+                "user@b.example",
+                "user@c.example",
+                "user@c.example",
+                "user@a.example",
+            ],
+        )
+
+
+class BackendRoutingTest(TestCase):
+    BACKENDS = {
+        "primary": {"BACKEND": "tests.NamedEmailBackend", "OPTIONS": {"name": "primary"}, "WEIGHT": 3},
+        "secondary": {"BACKEND": "tests.NamedEmailBackend", "OPTIONS": {"name": "secondary"}},
+        "newsletters": {
+            "BACKEND": "tests.NamedEmailBackend",
+            "OPTIONS": {"name": "newsletters"},
+            "FROM_DOMAINS": ["news.example.com"],
+            "PRIORITIES": ["low"],
+        },
+        "receipts": {
+            "BACKEND": "tests.NamedEmailBackend",
+            "OPTIONS": {"name": "receipts"},
+            "HEADERS": {"X-Category": "receipt*"},
+        },
+    }
+
+    def setUp(self):
+        patcher = patch.object(routing, "_router", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        UnreachableEmailBackend.attempts = 0
+
+    def make_router(self, backends, **kwargs):
+        router = routing.BackendRouter(
+            [routing.BackendRoute.from_config(name, backend) for name, backend in backends.items()], **kwargs
+        )
+        router.random.seed(0)
+        return router
+
+    def test_rules(self):
+        router = self.make_router(self.BACKENDS)
+
+        def route(from_email, priority=PRIORITY_MEDIUM, headers=None):
+            message = make_message("Subject", "Body", from_email, ["to@example.com"], priority=priority)
+            if headers:
+                message.email.extra_headers.update(headers)
+            routes = router.candidates(message)
+            return sorted(route.name for route in routes)
+
+        self.assertEqual(route("sender@news.example.com", PRIORITY_LOW), ["newsletters"])
+        self.assertEqual(route("sender@news.example.com", PRIORITY_HIGH), ["primary", "secondary"])
+        self.assertEqual(route("sender@example.com", headers={"x-category": "receipts"}), ["receipts"])
+        self.assertEqual(route("sender@example.com", headers={"X-Category": "other"}), ["primary", "secondary"])
+
+    def test_needs_default_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.make_router({"newsletters": self.BACKENDS["newsletters"]})
+
+    def test_weights_and_health(self):
+        router = self.make_router(self.BACKENDS, failure_threshold=2)
+        message = make_message("Subject", "Body", "sender@example.com", ["to@example.com"])
+
+        def pick():
+            route = router.acquire(message)
+            router.release(route)
+            return route
+
+        picked = collections.Counter(pick().name for i in range(400))
+        self.assertAlmostEqual(picked["primary"] / picked["secondary"], 3, delta=0.75)
+
+        primary = router.routes[0]
+        router.record(primary, ConnectionRefusedError())
+        # Halved weight after a failure
+        picked = collections.Counter(pick().name for i in range(400))
+        self.assertAlmostEqual(picked["primary"] / picked["secondary"], 1.5, delta=0.4)
+        # A refused recipient doesn't count against the backend
+        router.record(primary, smtplib.SMTPRecipientsRefused({}))
+        self.assertEqual(primary.failures, 1)
+
+        router.record(primary, ConnectionRefusedError())
+        self.assertEqual({pick().name for i in range(50)}, {"secondary"})
+        with patch("time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIn("primary", {pick().name for i in range(50)})
+        router.record(primary)
+        self.assertEqual(primary.failures, 0)
+
+    def test_max_concurrency(self):
+        backends = {
+            "primary": dict(self.BACKENDS["primary"], MAX_CONCURRENCY=1, WEIGHT=1000),
+            "secondary": self.BACKENDS["secondary"],
+        }
+        router = self.make_router(backends)
+        message = make_message("Subject", "Body", "sender@example.com", ["to@example.com"])
+        first = router.acquire(message)
+        self.assertEqual(first.name, "primary")
+        self.assertEqual(router.acquire(message).name, "secondary")
+
+    def test_send_all(self):
+        mailer.send_mail("Subject", "Body", "sender@news.example.com", ["to@example.com"], priority=PRIORITY_LOW)
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["to@example.com"])
+        with self.settings(MAILER_EMAIL_BACKENDS=self.BACKENDS):
+            engine.send_all()
+        sent_by = {m.from_email: m.extra_headers["X-Backend"] for m in mail.outbox}
+        self.assertEqual(sent_by["sender@news.example.com"], "newsletters")
+        self.assertIn(sent_by["sender@example.com"], ["primary", "secondary"])
+
+    def test_failover(self):
+        for i in range(3):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+        backends = {
+            "unreachable": {"BACKEND": "tests.UnreachableEmailBackend", "WEIGHT": 1000},
+            "secondary": self.BACKENDS["secondary"],
+        }
+        with self.settings(MAILER_EMAIL_BACKENDS=backends, MAILER_BACKEND_FAILURE_THRESHOLD=1):
+            routing.get_router().random.seed(0)
+            counts = engine.send_all()
+        self.assertEqual(counts["sent"], 3)
+        self.assertEqual(len(mail.outbox), 3)
+        # Avoided once it failed
+        self.assertEqual(UnreachableEmailBackend.attempts, 1)
+
+    def test_no_backend_left(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["to@example.com"])
+        with self.settings(MAILER_EMAIL_BACKENDS={"unreachable": {"BACKEND": "tests.UnreachableEmailBackend"}}):
+            counts = engine.send_all()
+        self.assertEqual(counts["deferred"], 1)
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(UnreachableEmailBackend.attempts, 1)
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(circuitbreaker, "_circuit_breaker", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        UnreachableEmailBackend.attempts = 0
+
+    def test_states(self):
+        breaker = circuitbreaker.CircuitBreaker(threshold=2, reset_timeout=60)
+        with patch("time.monotonic", return_value=100):
+            breaker.record(ConnectionRefusedError())
+            self.assertTrue(breaker.allow())
+            # The server answering resets the count
+            breaker.record(smtplib.SMTPRecipientsRefused({}))
+            breaker.record(smtplib.SMTPServerDisconnected())
+            self.assertTrue(breaker.allow())
+            breaker.record(socket.timeout())
+            self.assertFalse(breaker.allow())
+            self.assertTrue(breaker.is_open())
+            self.assertEqual(breaker.wait_time(), 60)
+        with patch("time.monotonic", return_value=160):
+            self.assertFalse(breaker.is_open())
+            # Half open, one probe at a time
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record(ConnectionRefusedError())
+            self.assertFalse(breaker.allow())
+        with patch("time.monotonic", return_value=220):
+            # A probe that wasn't sent lets the next one through
+            self.assertTrue(breaker.allow())
+            breaker.release()
+            self.assertTrue(breaker.allow())
+            breaker.record()
+            self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.wait_time(), 0)
+
+    def test_send_all(self):
+        for i in range(5):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+        with self.settings(MAILER_EMAIL_BACKEND="tests.UnreachableEmailBackend", MAILER_CIRCUIT_BREAKER_THRESHOLD=2):
+            counts = engine.send_all()
+            self.assertEqual(counts, {"sent": 0, "deferred": 2, "skipped": 0})
+            self.assertEqual(UnreachableEmailBackend.attempts, 2)
+            self.assertEqual(MessageLog.objects.count(), 2)
+            # The rest of the queue is left alone
+            self.assertEqual(Message.objects.deferred().count(), 2)
+            self.assertEqual(Message.objects.non_deferred().count(), 3)
+
+            counts = engine.send_all()
+            self.assertEqual(counts, {"sent": 0, "deferred": 0, "skipped": 0})
+            self.assertEqual(UnreachableEmailBackend.attempts, 2)
+            self.assertEqual(engine.wait_for_rate_limits(counts), engine.EMPTY_QUEUE_SLEEP)
+
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", MAILER_CIRCUIT_BREAKER_THRESHOLD=2
+        ):
+            with patch("time.monotonic", return_value=time.monotonic() + 61):
+                counts = engine.send_all()
+            self.assertEqual(counts, {"sent": 3, "deferred": 0, "skipped": 0})
+
+    def test_no_tokens_used_once_open(self):
+        for i in range(3):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.UnreachableEmailBackend",
+            MAILER_CIRCUIT_BREAKER_THRESHOLD=1,
+            MAILER_SEND_QUOTAS=[(10, 3600)],
+            MAILER_DOMAIN_RATE_LIMITS={"example.com": (0.001, 5)},
+        ), patch.object(ratelimit, "_rate_limiter", None), patch.object(
+            ratelimit.SendQuota, "acquire", return_value=0
+        ) as acquire:
+            counts = engine.send_all()
+            self.assertEqual(counts, {"sent": 0, "deferred": 1, "skipped": 0})
+            self.assertEqual(acquire.call_count, 1)
+            self.assertEqual(ratelimit.get_rate_limiter().get_bucket("example.com").tokens, 4)
+
+    def test_discarded_messages_not_recorded(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["to@example.com"])
+        # Can't be loaded, so it is discarded without a send attempt
+        Message.objects.update(message_data="")
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_CIRCUIT_BREAKER_THRESHOLD=1):
+            breaker = circuitbreaker.get_circuit_breaker()
+            breaker.record(ConnectionRefusedError())
+            with patch("time.monotonic", return_value=time.monotonic() + 61):
+                counts = engine.send_all()
+                self.assertEqual(counts, {"sent": 0, "deferred": 0, "skipped": 0})
+                self.assertEqual(Message.objects.count(), 0)
+                # Still half open, and the next message may probe
+                self.assertIsNotNone(breaker.opened_at)
+                self.assertTrue(breaker.allow())
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        patcher = patch.object(pool, "_connection_pool", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pool.close_connection_pool)
+        CountingConnectionEmailBackend.opened = 0
+        CountingConnectionEmailBackend.closed = 0
+
+    def send(self, count=1):
+        for i in range(count):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+        return engine.send_all()
+
+    def test_reused_between_runs(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend", MAILER_CONNECTION_POOL_SIZE=1):
+            self.send(2)
+            self.send(2)
+            self.assertEqual(MessageLog.objects.count(), 4)
+            self.assertEqual(CountingConnectionEmailBackend.opened, 1)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 0)
+            pool.close_connection_pool()
+            self.assertEqual(CountingConnectionEmailBackend.closed, 1)
+
+    def test_max_lifetime_and_idle(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend",
+            MAILER_CONNECTION_POOL_SIZE=1,
+            MAILER_CONNECTION_MAX_IDLE=10,
+            MAILER_CONNECTION_MAX_LIFETIME=15,
+        ):
+            now = time.monotonic()
+            with patch("time.monotonic", return_value=now):
+                self.send()
+            # Idle for too long
+            with patch("time.monotonic", return_value=now + 11):
+                self.send()
+            with patch("time.monotonic", return_value=now + 20):
+                self.send()
+            self.assertEqual(CountingConnectionEmailBackend.opened, 2)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 1)
+            # Open for too long
+            with patch("time.monotonic", return_value=now + 27):
+                self.send()
+            self.assertEqual(CountingConnectionEmailBackend.opened, 3)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 2)
+
+    def test_stale_connection(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.CountingConnectionEmailBackend", MAILER_CONNECTION_POOL_SIZE=1):
+            self.send()
+            with patch.object(
+                CountingConnectionEmailBackend,
+                "send_messages",
+                side_effect=[smtplib.SMTPServerDisconnected("gone"), None],
+            ):
+                counts = self.send()
+            # Sent again over a new connection, rather than deferred
+            self.assertEqual(counts["sent"], 1)
+            self.assertEqual(CountingConnectionEmailBackend.opened, 2)
+            self.assertEqual(CountingConnectionEmailBackend.closed, 1)
+
+    def test_keep_alive(self):
+        connection_pool = pool.ConnectionPool(size=2, keepalive=30)
+        self.addCleanup(connection_pool.close)
+        backends = [mail.get_connection("django.core.mail.backends.smtp.EmailBackend") for i in range(2)]
+        for backend in backends:
+            backend.connection = Mock(spec=smtplib.SMTP)
+            backend.close = Mock()
+        backends[0].connection.noop.return_value = (250, b"OK")
+        backends[1].connection.noop.return_value = (421, b"Timeout")
+        now = time.monotonic()
+        with patch("time.monotonic", return_value=now):
+            for backend in backends:
+                self.assertTrue(connection_pool.checkin("key", backend, now))
+            self.assertFalse(connection_pool.checkin("key", backends[0], now))
+            connection_pool.keep_alive()
+        backends[0].connection.noop.assert_not_called()
+        with patch("time.monotonic", return_value=now + 30):
+            connection_pool.keep_alive()
+            backends[0].connection.noop.assert_called_once_with()
+            backends[1].close.assert_called_once_with()
+            self.assertEqual(connection_pool.checkout("key"), (backends[0], now))
+            self.assertEqual(connection_pool.checkout("key"), (None, None))
+
+    def test_smtp_keepalive(self):
+        with SMTPStandIn() as server, self.settings(
+            MAILER_EMAIL_BACKEND="mailer.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.port,
+            MAILER_CONNECTION_POOL_SIZE=1,
+        ):
+            self.send()
+            with patch("time.monotonic", return_value=time.monotonic() + 30):
+                pool.get_connection_pool().keep_alive()
+            self.send()
+            pool.close_connection_pool()
+        self.assertEqual(len(server.messages), 2)
+        self.assertEqual(server.commands.count("EHLO"), 1)
+        self.assertIn("NOOP", server.commands)
+
+
+class SMTPBackendTest(TestCase):
+    def setUp(self):
+        for cache in [smtp._ssl_contexts, smtp._tls_sessions]:
+            patcher = patch.dict(cache, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Trust the stand-in server's certificate
+        patcher = patch("ssl.create_default_context", partial(ssl.create_default_context, cafile=TLS_KEYCERT))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resuming_context(self):
+        context = Mock()
+        session = object()
+        smtp.ResumingSSLContext(context, session).wrap_socket("sock", server_hostname="localhost")
+        context.wrap_socket.assert_called_once_with("sock", server_hostname="localhost", session=session)
+
+    def test_tls_session_resumption(self):
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(TLS_KEYCERT)
+        with SMTPStandIn(tls_context=server_context) as server:
+
+            def connect(**kwargs):
+                # A new backend for each connection, as get_connection() gives
+                backend = smtp.EmailBackend(host="127.0.0.1", port=server.port, use_tls=True, **kwargs)
+                backend.open()
+                session = backend.connection.sock.session
+                backend.close()
+                return backend, session
+
+            backend, session = connect()
+            self.assertFalse(backend.tls_session_reused)
+            backend, session = connect()
+            self.assertTrue(backend.tls_session_reused)
+            backend, session = connect(tls_session_resumption=False)
+            self.assertFalse(backend.tls_session_reused)
+
+            # A session that can't be resumed falls back to a full handshake
+            smtp._tls_sessions[backend.tls_session_key] = session
+            backend, session = connect()
+            self.assertFalse(backend.tls_session_reused)
+            self.assertIsNot(smtp._tls_sessions[backend.tls_session_key], session)
+            backend, session = connect()
+            self.assertTrue(backend.tls_session_reused)
+        self.assertEqual(server.tls_sessions_reused, [False, True, False, False, True])
+
+    def test_send(self):
+        with SMTPStandIn() as server, self.settings(
+            MAILER_EMAIL_BACKEND="mailer.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.port,
+            EMAIL_HOST_USER="user",
+            EMAIL_HOST_PASSWORD="password",
+        ):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["to@example.com"])
+            engine.send_all()
+        self.assertEqual(server.messages[0][:2], ("sender@example.com", ["to@example.com"]))
+        self.assertEqual(server.commands[-1], "QUIT")
+
+
+class PipeliningTest(TestCase):
+    def send(self, server, emails, **kwargs):
+        backend = smtp.EmailBackend(host="127.0.0.1", port=server.port, **kwargs)
+        round_trips = server.round_trips
+        with backend:
+            for email in emails:
+                backend.send_messages([email])
+        return server.round_trips - round_trips
+
+    def test_round_trips(self):
+        recipients = [f"to{i}@example.com" for i in range(4)]
+        email = mail.EmailMessage("Subject", ".Body", "sender@example.com", recipients)
+        with SMTPStandIn(pipelining=True, latency=0.01) as server:
+            # Connecting, EHLO, MAIL FROM to DATA, the message, and QUIT
+            self.assertEqual(self.send(server, [email]), 5)
+            # With a round trip for MAIL FROM, each RCPT TO and DATA
+            self.assertEqual(self.send(server, [email], pipelining=False), 10)
+        for mail_from, rcpt_to, data in server.messages:
+            self.assertEqual((mail_from, rcpt_to), ("sender@example.com", recipients))
+            self.assertTrue(data.endswith(b"\r\n\r\n.Body\r\n"))
+
+    def test_not_advertised(self):
+        email = mail.EmailMessage("Subject", "Body", "sender@example.com", ["to1@example.com", "to2@example.com"])
+        with SMTPStandIn() as server:
+            self.assertEqual(self.send(server, [email]), 8)
+        self.assertEqual(len(server.messages), 1)
+
+    def test_refused_recipients(self):
+        with SMTPStandIn(refused_recipients=["nobody@example.com"], pipelining=True) as server:
+            backend = smtp.EmailBackend(host="127.0.0.1", port=server.port)
+
+            def email(*recipients):
+                return mail.EmailMessage("Subject", "Body", "sender@example.com", list(recipients))
+
+            with backend:
+                backend.send_messages([email("to@example.com", "nobody@example.com")])
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    backend.send_messages([email("nobody@example.com")])
+                # The connection can still be used
+                backend.send_messages([email("to@example.com")])
+        self.assertEqual([rcpt_to for mail_from, rcpt_to, data in server.messages], [["to@example.com"]] * 2)
+        self.assertIn("RSET", server.commands)
+
+    def test_send_all(self):
+        with SMTPStandIn(pipelining=True) as server, self.settings(
+            MAILER_EMAIL_BACKEND="mailer.smtp.EmailBackend", EMAIL_HOST="127.0.0.1", EMAIL_PORT=server.port
+        ):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com", "cc@example.com"])
+            engine.send_all()
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(server.commands.count("EHLO"), 1)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        for patcher in [patch.object(metrics, "_exporters", []), patch.object(metrics, "_exporters_config", None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(metrics.close_exporters)
+        self.callback = Mock()
+
+    def exporters(self, backend, **options):
+        return self.settings(MAILER_METRICS_EXPORTERS=[{"BACKEND": backend, "OPTIONS": options}])
+
+    def send(self, count=1, backend="tests.TestMailerEmailBackend"):
+        for i in range(count):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+        with self.settings(MAILER_EMAIL_BACKEND=backend):
+            return engine.send_all()
+
+    def recorded(self, kind, name):
+        return [
+            (value, labels)
+            for (recorded_kind, recorded_name, value, labels), kwargs in self.callback.call_args_list
+            if (recorded_kind, recorded_name) == (kind, name)
+        ]
+
+    def test_callback(self):
+        with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback):
+            self.send(2)
+        self.assertEqual(self.recorded(metrics.COUNTER, "messages"), [(1, {"result": "sent"})] * 2)
+        self.assertEqual(self.recorded(metrics.COUNTER, "connections"), [(1, {"source": "new"})])
+        for name, count in [("smtp_transaction_seconds", 2), ("enqueue_to_send_seconds", 2), ("run_seconds", 1)]:
+            observations = self.recorded(metrics.OBSERVATION, name)
+            self.assertEqual(len(observations), count, name)
+            self.assertTrue(all(value >= 0 and labels == {} for value, labels in observations))
+        # One for each message locked
+        self.assertEqual(len(self.recorded(metrics.OBSERVATION, "claim_seconds")), 2)
+        self.assertEqual(
+            self.recorded(metrics.GAUGE, "queue_depth"),
+            [(0, {"priority": priority}) for priority in ["high", "medium", "low", "deferred"]],
+        )
+
+    def test_failures(self):
+        with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback):
+            self.send(2, backend="tests.FailingMailerEmailBackend")
+        self.assertEqual(self.recorded(metrics.COUNTER, "send_failures"), [(1, {"error": "SMTPSenderRefused"})] * 2)
+        self.assertEqual(self.recorded(metrics.COUNTER, "messages"), [(1, {"result": "deferred"})] * 2)
+        self.assertEqual(self.recorded(metrics.OBSERVATION, "enqueue_to_send_seconds"), [])
+        self.assertIn((2, {"priority": "deferred"}), self.recorded(metrics.GAUGE, "queue_depth"))
+
+    def test_pooled_connections(self):
+        self.addCleanup(pool.close_connection_pool)
+        with patch.object(pool, "_connection_pool", None), self.settings(MAILER_CONNECTION_POOL_SIZE=1):
+            with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback):
+                self.send()
+                self.send()
+        self.assertEqual(
+            self.recorded(metrics.COUNTER, "connections"), [(1, {"source": "new"}), (1, {"source": "pool"})]
+        )
+
+    def test_claim_batches(self):
+        with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback):
+            with self.settings(MAILER_CLAIM_BATCH_SIZE=10):
+                self.send(3)
+        # The batch with the messages, and the empty one after it
+        self.assertEqual(len(self.recorded(metrics.OBSERVATION, "claim_seconds")), 2)
+
+    @unittest.skipIf(async_send_all is None, "asgiref is not installed")
+    def test_async(self):
+        with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback), self.settings(
+            MAILER_ASYNC_EMAIL_BACKEND="mailer.async_backends.LocmemBackend", MAILER_ASYNC_CONCURRENCY=2
+        ):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", "sender@example.com", [f"to{i}@example.com"])
+            async_to_sync(async_send_all)()
+        self.assertEqual(self.recorded(metrics.COUNTER, "messages"), [(1, {"result": "sent"})] * 3)
+        self.assertEqual(len(self.recorded(metrics.OBSERVATION, "smtp_transaction_seconds")), 3)
+        self.assertEqual(len(self.recorded(metrics.OBSERVATION, "enqueue_to_send_seconds")), 3)
+        self.assertEqual(len(self.recorded(metrics.GAUGE, "queue_depth")), 4)
+
+    def test_disabled(self):
+        with patch.object(metrics, "observe") as observe:
+            self.send()
+        self.assertEqual(metrics.get_exporters(), [])
+        observe.assert_not_called()
+
+    def test_broken_exporter(self):
+        self.callback.side_effect = ValueError
+        with self.exporters("mailer.metrics.CallbackExporter", callback=self.callback):
+            self.assertEqual(self.send(), {"deferred": 0, "sent": 1, "skipped": 0})
+
+    def test_prometheus(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "mailer.prom")
+            with self.exporters("mailer.metrics.PrometheusExporter", path=path, port=0, addr="127.0.0.1"):
+                self.send(2)
+                (exporter,) = metrics.get_exporters()
+                url = f"http://127.0.0.1:{exporter.server.server_address[1]}/metrics"
+                with urllib.request.urlopen(url) as response:
+                    served = response.read().decode("utf-8")
+            metrics.close_exporters()
+            with open(path) as f:
+                written = f.read()
+        self.assertEqual(served, written)
+        lines = written.splitlines()
+        self.assertIn("# TYPE mailer_messages_total counter", lines)
+        self.assertIn('mailer_messages_total{result="sent"} 2', lines)
+        self.assertIn('mailer_queue_depth{priority="medium"} 0', lines)
+        self.assertIn("# TYPE mailer_smtp_transaction_seconds histogram", lines)
+        self.assertIn('mailer_smtp_transaction_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("mailer_smtp_transaction_seconds_count 2", lines)
+
+    def test_prometheus_histogram(self):
+        exporter = metrics.PrometheusExporter(prefix="", buckets=[1, 0.5])
+        for value in [0.1, 0.7, 3]:
+            exporter.record(metrics.OBSERVATION, "delay", value, {"queue": 'a "b"'})
+        self.assertEqual(
+            exporter.render().splitlines(),
+            [
+                "# TYPE delay histogram",
+                'delay_bucket{queue="a \\"b\\"",le="0.5"} 1',
+                'delay_bucket{queue="a \\"b\\"",le="1"} 2',
+                'delay_bucket{queue="a \\"b\\"",le="+Inf"} 3',
+                'delay_sum{queue="a \\"b\\""} 3.8',
+                'delay_count{queue="a \\"b\\""} 3',
+            ],
+        )
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        with self.exporters("mailer.metrics.StatsdExporter", host="127.0.0.1", port=server.getsockname()[1]):
+            self.send()
+        lines = []
+        server.settimeout(0.1)
+        with contextlib.suppress(TimeoutError, socket.timeout):
+            while True:
+                lines.append(server.recv(1024).decode("utf-8"))
+        self.assertIn("mailer.messages.sent:1|c", lines)
+        self.assertIn("mailer.connections.new:1|c", lines)
+        self.assertIn("mailer.queue_depth.medium:0|g", lines)
+        self.assertTrue(any(line.startswith("mailer.smtp_transaction:") and line.endswith("|ms") for line in lines))
+
+    def test_dogstatsd(self):
+        exporter = metrics.StatsdExporter(dogstatsd=True)
+        self.addCleanup(exporter.close)
+        self.assertEqual(
+            exporter.format(metrics.COUNTER, "messages", 1, {"result": "sent"}), "mailer.messages:1|c|#result:sent"
+        )
+        self.assertEqual(exporter.format(metrics.OBSERVATION, "run_seconds", 0.25, {}), "mailer.run:250|ms")
+
+
+class LogSinkTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "mailer.jsonl")
+
+    def tearDown(self):
+        logsinks.close_log_sink()
+        self.tempdir.cleanup()
+
+    def send(self, count):
+        for i in range(count):
+            mailer.send_mail("Subject", "Body", "sender@example.com", [f"recipient{i}@example.com"])
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend"):
+            engine.send_all()
+
+    def read_lines(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_null_sink(self):
+        with self.settings(MAILER_LOG_SINK="mailer.logsinks.NullLogSink"):
+            self.send(2)
+        self.assertEqual(len(TestMailerEmailBackend.outbox), 2)
+        self.assertEqual(MessageLog.objects.count(), 0)
+
+    def test_database_sink_batches(self):
+        with self.settings(MAILER_LOG_SINK_OPTIONS={"batch_size": 2}):
+            for i in range(3):
+                mailer.send_mail("Subject", "Body", "sender@example.com", [f"recipient{i}@example.com"])
+            with patch.object(engine, "get_log_sink", Mock()):
+                # Not flushed at the end of the run
+                with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend"):
+                    engine.send_all()
+            self.assertEqual(MessageLog.objects.count(), 2)
+            logsinks.get_log_sink().flush()
+            self.assertEqual(MessageLog.objects.count(), 3)
+
+    def test_json_lines_sink(self):
+        with self.settings(
+            MAILER_LOG_SINK="mailer.logsinks.JSONLinesLogSink",
+            MAILER_LOG_SINK_OPTIONS={"path": self.path, "max_bytes": 400, "backup_count": 1},
+        ):
+            self.send(5)
+        self.assertEqual(MessageLog.objects.count(), 0)
+        lines = self.read_lines(self.path + ".1") + self.read_lines(self.path)
+        self.assertLess(len(lines), 5)
+        self.assertLessEqual(os.path.getsize(self.path), 400)
+        for line in lines:
+            self.assertEqual(line["result"], RESULT_SUCCESS)
+            self.assertEqual(line["priority"], PRIORITY_MEDIUM)
+            self.assertTrue(line["message_id"].startswith("<"))
+
+    def test_background_flush(self):
+        with self.settings(
+            MAILER_LOG_SINK="mailer.logsinks.JSONLinesLogSink",
+            MAILER_LOG_SINK_OPTIONS={"path": self.path, "batch_size": 100, "flush_interval": 60},
+        ):
+            with patch.object(engine, "get_log_sink", Mock()):
+                self.send(3)
+            sink = logsinks.get_log_sink()
+            self.assertTrue(sink.flusher.is_alive())
+            self.assertFalse(os.path.exists(self.path))
+            logsinks.close_log_sink()
+            self.assertFalse(sink.flusher)
+        self.assertEqual(len(self.read_lines(self.path)), 3)
+
+
+class FinalizeTest(TestCase):
+    def send_and_capture(self, count, **settings):
+        with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", **settings):
+            for i in range(count):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            with CaptureQueriesContext(connection) as queries:
+                engine.send_all()
+        deletes = [q for q in queries if q["sql"].startswith('DELETE FROM "mailer_message"')]
+        inserts = [q for q in queries if q["sql"].startswith('INSERT INTO "mailer_messagelog"')]
+        return deletes, inserts
+
+    def test_batched(self):
+        deletes, inserts = self.send_and_capture(7, MAILER_CLAIM_BATCH_SIZE=10, MAILER_FINALIZE_BATCH_SIZE=3)
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(MessageLog.objects.filter(result=RESULT_SUCCESS).count(), 7)
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(len(inserts), 3)
+
+    def test_interval(self):
+        with patch("time.monotonic", side_effect=range(0, 1000, 10)):
+            deletes, inserts = self.send_and_capture(
+                3, MAILER_CLAIM_BATCH_SIZE=10, MAILER_FINALIZE_BATCH_SIZE=100, MAILER_FINALIZE_INTERVAL=5
+            )
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(len(deletes), 3)
+
+    def test_written_before_sleeping(self):
+        remaining = []
+        with patch("time.sleep", side_effect=lambda seconds: remaining.append(Message.objects.count())):
+            self.send_and_capture(
+                2,
+                MAILER_CLAIM_BATCH_SIZE=10,
+                MAILER_FINALIZE_BATCH_SIZE=100,
+                MAILER_FINALIZE_INTERVAL=5,
+                MAILER_EMAIL_THROTTLE=10,
+            )
+        # The throttle would keep the first outcome waiting beyond the interval
+        self.assertEqual(remaining, [1, 0])
+
+    def test_not_batched_without_leases(self):
+        # Messages are only locked while being sent, so their outcome can't wait
+        deletes, inserts = self.send_and_capture(3, MAILER_FINALIZE_BATCH_SIZE=3)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(len(deletes), 3)
+
+    def test_failures_are_kept(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend"):
+            for i in range(4):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend",
+            MAILER_CLAIM_BATCH_SIZE=10,
+            MAILER_FINALIZE_BATCH_SIZE=10,
+        ), patch.object(
+            TestMailerEmailBackend,
+            "send_messages",
+            side_effect=[None, smtplib.SMTPRecipientsRefused({}), None, None],
+        ):
+            engine.send_all()
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(MessageLog.objects.filter(result=RESULT_SUCCESS).count(), 3)
+        self.assertEqual(MessageLog.objects.filter(result=RESULT_FAILURE).count(), 1)
+
+
+class ConcurrentSendingTest(TransactionTestCase):
+    def test_send_all(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            MAILER_CONCURRENCY=3,
+            MAILER_CLAIM_BATCH_SIZE=4,
+        ):
+            for i in range(10):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(mail.outbox), 10)
+            self.assertEqual(Message.objects.count(), 0)
+            self.assertEqual(MessageLog.objects.count(), 10)
+
+    def test_max_batch(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            MAILER_CONCURRENCY=3,
+            MAILER_EMAIL_MAX_BATCH=4,
+        ):
+            for i in range(10):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(mail.outbox), 4)
+            self.assertEqual(Message.objects.count(), 6)
+            self.assertEqual(Message.objects.unleased().count(), 6)
+
+    def test_max_batch_takes_no_more_quota(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            MAILER_CONCURRENCY=2,
+            MAILER_EMAIL_MAX_BATCH=2,
+            MAILER_SEND_QUOTAS=[(10, 3600)],
+        ), patch.object(ratelimit.SendQuota, "acquire", return_value=0) as acquire:
+            for i in range(5):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(mail.outbox), 2)
+            self.assertEqual(acquire.call_count, 2)
+
+    def test_max_deferred(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend",
+            MAILER_CONCURRENCY=3,
+            MAILER_EMAIL_MAX_DEFERRED=2,
+        ):
+            for i in range(10):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(Message.objects.deferred().count(), 2)
+            self.assertEqual(MessageLog.objects.count(), 2)
+
+    def test_error_handler_exception(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            MAILER_CONCURRENCY=2,
+        ):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+            with patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=ValueError):
+                self.assertRaises(ValueError, engine.send_all)
+            self.assertEqual(Message.objects.count(), 1)
+
+    def test_idle_workers_write_outcomes(self):
+        remaining = []
+        time_sleep = time.sleep
+
+        def sleep(seconds):
+            # Longer than the workers take to send the message, and wait for
+            # its outcome to be due
+            time_sleep(0.5)
+            remaining.append(Message.objects.count())
+
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            MAILER_CONCURRENCY=2,
+            MAILER_CLAIM_BATCH_SIZE=10,
+            MAILER_FINALIZE_BATCH_SIZE=100,
+            MAILER_FINALIZE_INTERVAL=0.01,
+            MAILER_EMAIL_THROTTLE=1,
+        ):
+            for i in range(2):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            with patch("time.sleep", side_effect=sleep):
+                engine.send_all()
+        self.assertEqual(remaining[0], 1)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@unittest.skipIf(async_send_all is None, "asgiref is not installed")
+class AsyncSendingTest(TestCase):
+    def test_send_all(self):
+        with self.settings(MAILER_ASYNC_EMAIL_BACKEND="mailer.async_backends.LocmemBackend"):
+            for i in range(5):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            async_to_sync(async_send_all)()
+            self.assertEqual(len(mail.outbox), 5)
+            self.assertEqual(Message.objects.count(), 0)
+            self.assertEqual(MessageLog.objects.filter(result=RESULT_SUCCESS).count(), 5)
+
+    def test_max_batch(self):
+        with self.settings(
+            MAILER_ASYNC_EMAIL_BACKEND="mailer.async_backends.LocmemBackend",
+            MAILER_ASYNC_CONCURRENCY=3,
+            MAILER_EMAIL_MAX_BATCH=4,
+        ):
+            for i in range(10):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            async_to_sync(async_send_all)()
+            self.assertEqual(len(mail.outbox), 4)
+            self.assertEqual(Message.objects.unleased().count(), 6)
+
+    def test_smtp_backend(self):
+        with SMTPStandIn(refused_recipients=["nobody@example.com"]) as server, self.settings(
+            MAILER_ASYNC_EMAIL_BACKEND="mailer.async_backends.SMTPBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.port,
+            EMAIL_HOST_USER="user",
+            EMAIL_HOST_PASSWORD="password",
+        ):
+            mailer.send_mail("Subject 1", ".Body", "sender@example.com", ["r1@example.com", "r2@example.com"])
+            mailer.send_mail("Subject 2", "Body", "sender@example.com", ["nobody@example.com"])
+            async_to_sync(async_send_all)()
+
+            self.assertEqual(len(server.messages), 1)
+            mail_from, rcpt_to, data = server.messages[0]
+            self.assertEqual(mail_from, "sender@example.com")
+            self.assertEqual(rcpt_to, ["r1@example.com", "r2@example.com"])
+            self.assertIn(b"Subject: Subject 1", data)
+            self.assertIn(b"\r\n.Body", data)
+            self.assertIn("AUTH", server.commands)
+
+            # The refused message is deferred as usual
+            self.assertEqual(Message.objects.deferred().count(), 1)
+            self.assertEqual(MessageLog.objects.filter(result=RESULT_FAILURE).count(), 1)
+            self.assertEqual(MessageLog.objects.filter(result=RESULT_SUCCESS).count(), 1)
+
+    @unittest.skipUnless(async_backends.HAS_START_TLS, "StreamWriter.start_tls() needs Python 3.11")
+    def test_smtp_backend_starttls(self):
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(TLS_KEYCERT)
+        with SMTPStandIn(tls_context=server_context) as server, self.settings(
+            MAILER_ASYNC_EMAIL_BACKEND="mailer.async_backends.SMTPBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.port,
+            EMAIL_USE_TLS=True,
+        ), patch("ssl.create_default_context", partial(ssl.create_default_context, cafile=TLS_KEYCERT)):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+            async_to_sync(async_send_all)()
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual(server.tls_sessions_reused, [False])
+
+    def test_starttls_unsupported(self):
+        with patch.object(async_backends, "HAS_START_TLS", False):
+            with self.assertRaises(ImproperlyConfigured):
+                async_backends.SMTPBackend(host="127.0.0.1", port=25, use_tls=True)
+            async_backends.SMTPBackend(host="127.0.0.1", port=465, use_ssl=True)
+
+
 class LockNormalTest(TestCase):
     def setUp(self):
         class CustomError(Exception):
@@ -576,6 +1825,172 @@ class PrioritizeTest(TestCase):
             self.assertEqual(Message.objects.deferred().count(), 1)
 
 
+class QueueIndexTest(TestCase):
+    def explain(self, queryset):
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                # The table is too small for an index to be worth it otherwise.
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        return queryset.explain()
+
+    def test_indexes_created(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Message._meta.db_table)
+        self.assertIn("mailer_msg_queue_order", constraints)
+        # Partial indexes aren't supported by MySQL and MariaDB
+        self.assertEqual("mailer_msg_non_deferred" in constraints, connection.features.supports_partial_indexes)
+
+    # Query plans are only checked where the partial index exists
+    @skipUnlessDBFeature("supports_partial_indexes")
+    def test_prioritize_uses_index(self):
+        self.assertIn("mailer_msg_non_deferred", self.explain(engine.prioritize()))
+
+    @skipUnlessDBFeature("supports_partial_indexes")
+    def test_non_deferred_exists_uses_index(self):
+        self.assertIn("mailer_msg_non_deferred", self.explain(Message.objects.non_deferred().values("id")[:1]))
+
+
+class IterQueueTest(TestCase):
+    def test_iter_queue(self):
+        priorities = [PRIORITY_LOW, PRIORITY_HIGH, PRIORITY_MEDIUM, PRIORITY_HIGH, PRIORITY_DEFERRED, PRIORITY_LOW]
+        for i, priority in enumerate(priorities):
+            mailer.send_mail("Subject", "Body", f"queue{i}@example.com", ["r@example.com"], priority=priority)
+        # Several messages added at the same time
+        Message.objects.update(when_added=datetime_now())
+        expected = list(engine.prioritize().values_list("id", flat=True))
+
+        with self.settings(MAILER_QUEUE_CHUNK_SIZE=2), CaptureQueriesContext(connection) as queries:
+            entries = list(engine.iter_queue())
+
+        self.assertEqual([entry.id for entry in entries], expected)
+        self.assertEqual([entry.priority for entry in entries], sorted(priorities)[:5])
+        self.assertEqual(len(queries), 3)
+        for query in queries:
+            self.assertNotIn("message_data", query["sql"])
+
+    def test_send_all(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", MAILER_QUEUE_CHUNK_SIZE=2
+        ):
+            for i in range(5):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual([m.from_email for m in mail.outbox], [f"sender{i}@example.com" for i in range(5)])
+            self.assertEqual(Message.objects.count(), 0)
+
+    def test_given_queryset_not_evaluated(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+        with self.assertNumQueries(0):
+            engine.prioritize(Message.objects.all())
+
+    def test_given_queryset_with_deferred(self):
+        for i, priority in enumerate([PRIORITY_HIGH, PRIORITY_DEFERRED, PRIORITY_MEDIUM, PRIORITY_LOW]):
+            mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"], priority=priority)
+        for claim_batch_size in [None, 2]:
+            with self.subTest(claim_batch_size=claim_batch_size), self.settings(
+                MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend",
+                MAILER_QUEUE_CHUNK_SIZE=1,
+                MAILER_CLAIM_BATCH_SIZE=claim_batch_size,
+            ):
+                MessageLog.objects.all().delete()
+                counts = engine.send_all(Message.objects.all())
+                # Each one is tried once, though they are all deferred now
+                self.assertEqual(counts["deferred"], 4)
+                self.assertEqual(MessageLog.objects.count(), 4)
+                self.assertEqual(MessageLog.objects.values("message_id").distinct().count(), 4)
+                self.assertEqual(Message.objects.deferred().count(), 4)
+
+
+class ClaimMessagesTest(TestCase):
+    def setUp(self):
+        del TestMailerEmailBackend.outbox[:]
+
+    def test_claim_messages(self):
+        mailer.send_mail("Subject", "Body", "claim1@example.com", ["r@example.com"], priority=PRIORITY_LOW)
+        mailer.send_mail("Subject", "Body", "claim2@example.com", ["r@example.com"], priority=PRIORITY_HIGH)
+        mailer.send_mail("Subject", "Body", "claim3@example.com", ["r@example.com"], priority=PRIORITY_MEDIUM)
+        mailer.send_mail("Subject", "Body", "claim4@example.com", ["r@example.com"], priority=PRIORITY_DEFERRED)
+
+        first = engine.claim_messages("worker-1", 2)
+        self.assertEqual([m.email.from_email for m in first], ["claim2@example.com", "claim3@example.com"])
+        self.assertEqual(Message.objects.filter(lease_owner="worker-1").count(), 2)
+
+        # Messages leased by someone else are skipped
+        second = engine.claim_messages("worker-2", 2)
+        self.assertEqual([m.email.from_email for m in second], ["claim1@example.com"])
+        self.assertEqual(engine.claim_messages("worker-3", 2), [])
+
+        # Leases of a sender that went away expire
+        Message.objects.filter(lease_owner="worker-1").update(
+            lease_expires=datetime_now() - datetime.timedelta(seconds=1)
+        )
+        third = engine.claim_messages("worker-3", 5)
+        self.assertEqual([m.email.from_email for m in third], ["claim2@example.com", "claim3@example.com"])
+
+        self.assertEqual(Message.objects.release_leases("worker-3"), 2)
+        self.assertEqual(Message.objects.unleased().count(), 3)
+
+    def test_send_all(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_CLAIM_BATCH_SIZE=2):
+            for i in range(5):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(TestMailerEmailBackend.outbox), 5)
+            self.assertEqual(Message.objects.count(), 0)
+            self.assertEqual(MessageLog.objects.count(), 5)
+
+    def test_lease_renewed_before_sending(self):
+        mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+        (message,) = engine.claim_messages("worker-1", 1)
+        expires = message.lease_expires
+        with patch.object(engine, "datetime_now", return_value=expires - datetime.timedelta(seconds=1)):
+            with engine.leased_context(message, "worker-1") as leased:
+                self.assertIs(leased, message)
+        self.assertGreater(Message.objects.get().lease_expires, expires)
+
+    def test_expired_lease_is_not_sent(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_CLAIM_BATCH_SIZE=2):
+            for i in range(2):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+
+            def claim_messages(owner, batch_size, queryset=None):
+                batch = real_claim_messages(owner, batch_size, queryset)
+                # The lease on the second message ran out, and another
+                # sender claimed it.
+                if len(batch) == 2:
+                    Message.objects.filter(id=batch[1].id).update(
+                        lease_owner="worker-2", lease_expires=datetime_now() + datetime.timedelta(seconds=60)
+                    )
+                return batch
+
+            real_claim_messages = engine.claim_messages
+            with patch.object(engine, "claim_messages", claim_messages):
+                engine.send_all()
+            self.assertEqual([email.from_email for email in TestMailerEmailBackend.outbox], ["sender0@example.com"])
+            self.assertEqual(Message.objects.get().lease_owner, "worker-2")
+
+    def test_deferred_message_is_released(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend", MAILER_CLAIM_BATCH_SIZE=2):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+            engine.send_all()
+            message = Message.objects.get()
+            self.assertEqual(message.priority, PRIORITY_DEFERRED)
+            self.assertIsNone(message.lease_owner)
+            self.assertIsNone(message.lease_expires)
+
+    def test_limits_release_leases(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_CLAIM_BATCH_SIZE=5, MAILER_EMAIL_MAX_BATCH=2
+        ):
+            for i in range(4):
+                mailer.send_mail("Subject", "Body", f"sender{i}@example.com", ["r@example.com"])
+            engine.send_all()
+            self.assertEqual(len(TestMailerEmailBackend.outbox), 2)
+            self.assertEqual(Message.objects.count(), 2)
+            # The unsent part of the batch is available to other senders again
+            self.assertEqual(Message.objects.unleased().count(), 2)
+
+
 class MessagesTest(TestCase):
     def test_message(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
@@ -611,6 +2026,38 @@ class MessagesTest(TestCase):
             # Delivery should discard broken messages
             self.assertEqual(MessageLog.objects.count(), 0)
 
+    def test_email_decoded_once(self):
+        with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
+            mailer.send_mail("Subject Msg", "Body", "msg1@example.com", ["rec1@example.com"])
+            msg = Message.objects.get()
+            with patch("mailer.models.db_to_email", wraps=db_to_email) as decode:
+                self.assertEqual(msg.subject, "Subject Msg")
+                self.assertEqual(msg.to_addresses, ["rec1@example.com"])
+                self.assertIs(msg.email, msg.email)
+                self.assertEqual(decode.call_count, 1)
+
+                # Setting the email replaces the cached one
+                email = mail.EmailMessage("New subject", "Body", "msg1@example.com", ["rec2@example.com"])
+                msg.email = email
+                self.assertIs(msg.email, email)
+                self.assertEqual(decode.call_count, 1)
+
+                # as does setting the data
+                msg.message_data = email_to_db(mail.EmailMessage("Other subject"))
+                self.assertEqual(msg.subject, "Other subject")
+                self.assertEqual(decode.call_count, 2)
+
+                # The cache isn't pickled with the message
+                self.assertNotIn("_email_cache", pickle.loads(pickle.dumps(msg)).__dict__)
+
+                msg.email = email
+                msg.save()
+                decode.reset_mock()
+                engine.send_all()
+                # Once by send_all, and no more for logging
+                self.assertEqual(decode.call_count, 1)
+            self.assertEqual(MessageLog.objects.get().message_id, mail.outbox[0].extra_headers["Message-ID"])
+
     def test_message_log(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             mailer.send_mail("Subject Log", "Body", "log1@example.com", ["1gol@example.com"])
@@ -727,6 +2174,209 @@ class DbToEmailTest(TestCase):
         self.assertEqual(converted_email.to, email.to)
 
 
+class BinaryMessageDataTest(TestCase):
+    def test_round_trip(self):
+        email = mail.EmailMessage("Subject", "Body " * 1000, "sender@example.com", ["r@example.com"])
+        for compression in ["zlib", "lzma"]:
+            with self.subTest(compression=compression), self.settings(MAILER_MESSAGE_DATA_COMPRESSION=compression):
+                data = email_to_bytes(email)
+                self.assertEqual(data[:5], serializers.MAGIC + bytes([1, serializers.CODEC_NAMES[compression]]))
+                self.assertLess(len(data), len(email.body))
+                self.assertEqual(db_to_email(data).body, email.body)
+                self.assertEqual(db_to_email(memoryview(data)).body, email.body)
+
+        # Small messages are not compressed
+        small = mail.EmailMessage("Subject", "Body")
+        self.assertEqual(email_to_bytes(small)[4], serializers.CODEC_NONE)
+        with self.settings(MAILER_MESSAGE_DATA_COMPRESS_MIN_SIZE=None):
+            self.assertEqual(email_to_bytes(email)[4], serializers.CODEC_NONE)
+
+        # Damaged data
+        self.assertIsNone(db_to_email(email_to_bytes(email)[:-10]))
+        self.assertIsNone(db_to_email(serializers.MAGIC + bytes([99, 0])))
+
+    def test_send_all(self):
+        with self.settings(
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", MAILER_MESSAGE_DATA_FORMAT="binary"
+        ):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+            message = Message.objects.get()
+            self.assertEqual(message.message_data, "")
+            self.assertTrue(serializers.is_binary_format(message.message_blob))
+            self.assertEqual(message.subject, "Subject")
+
+            engine.send_all()
+            self.assertEqual(len(mail.outbox), 1)
+            log = MessageLog.objects.get()
+            self.assertEqual(log.subject, "Subject")
+            self.assertEqual(log.message_id, mail.outbox[0].extra_headers["Message-ID"])
+
+    def test_migrate_message_data(self):
+        mailer.send_mail("Subject 1", "Body", "sender@example.com", ["r@example.com"])
+        mailer.send_mail("Subject 2", "Body", "sender@example.com", ["r@example.com"])
+        mailer.send_mail("Subject 3", "Body", "sender@example.com", ["r@example.com"])
+        MessageLog.objects.log(Message.objects.order_by("id").first(), RESULT_SUCCESS)
+
+        call_command("migrate_message_data", "--batch-size", "2")
+
+        self.assertEqual(Message.objects.filter(message_blob__isnull=True).count(), 0)
+        self.assertEqual(MessageLog.objects.filter(message_blob__isnull=True).count(), 0)
+        self.assertEqual(sorted(m.subject for m in Message.objects.all()), ["Subject 1", "Subject 2", "Subject 3"])
+        self.assertEqual(MessageLog.objects.get().subject, "Subject 1")
+
+
+class PrerenderTest(TestCase):
+    def test_send_prerendered(self):
+        with SMTPStandIn() as server, self.settings(
+            MAILER_PRERENDER_MESSAGES=True,
+            MAILER_EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.port,
+        ):
+            mailer.send_mail("Subject", "Body", "sender@example.com", ["to@example.com"])
+            message = Message.objects.get()
+            email = message.email
+            self.assertIsInstance(email, PrerenderedEmailMessage)
+            self.assertEqual(email.subject, "Subject")
+            self.assertEqual(email.recipients(), ["to@example.com"])
+            self.assertIn(b"\r\n\r\nBody", email.rendered_message)
+            message_id = email.extra_headers["Message-ID"]
+
+            with patch.object(mail.EmailMessage, "_create_message", side_effect=AssertionError("re-rendered")):
+                engine.send_all()
+
+            self.assertEqual(len(server.messages), 1)
+            mail_from, rcpt_to, data = server.messages[0]
+            self.assertEqual(mail_from, "sender@example.com")
+            self.assertEqual(rcpt_to, ["to@example.com"])
+            self.assertEqual(data, email.rendered_message + b"\r\n")
+            self.assertEqual(MessageLog.objects.get().message_id, message_id)
+
+    def test_db_backend(self):
+        with self.settings(EMAIL_BACKEND="mailer.backend.DbBackend", MAILER_PRERENDER_MESSAGES=True):
+            mail.EmailMessage(
+                "Subject", "Body", "sender@example.com", ["to@example.com"], bcc=["bcc@example.com"]
+            ).send()
+        with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
+            engine.send_all()
+        sent = mail.outbox[0]
+        self.assertIsInstance(sent, PrerenderedEmailMessage)
+        self.assertEqual(sent.recipients(), ["to@example.com", "bcc@example.com"])
+        self.assertNotIn(b"bcc@example.com", sent.message().as_bytes())
+        self.assertIn(b"\nBody", sent.message().as_bytes())
+
+    def test_send_html_mail(self):
+        with self.settings(MAILER_PRERENDER_MESSAGES=True):
+            mailer.send_html_mail("Subject", "Body", "<p>Body</p>", "sender@example.com", ["to@example.com"])
+        email = Message.objects.get().email
+        self.assertIsInstance(email, PrerenderedEmailMessage)
+        self.assertIn(b"Content-Type: text/html", email.rendered_message)
+
+
+class DontSendEntryTest(TestCase):
+    def setUp(self):
+        dont_send_cache.clear()
+        now = datetime_now()
+        DontSendEntry.objects.create(to_address="NoGo@example.com", when_added=now)
+        DontSendEntry.objects.create(to_address="other@example.com", when_added=now)
+
+    def test_has_address(self):
+        self.assertTrue(DontSendEntry.objects.has_address("nogo@EXAMPLE.com"))
+        self.assertFalse(DontSendEntry.objects.has_address("go@example.com"))
+        self.assertFalse(DontSendEntry.objects.has_address(None))
+
+    def test_make_message_single_query(self):
+        with self.assertNumQueries(1):
+            msg = make_message(
+                "Subject",
+                "Body",
+                "sender@example.com",
+                ["go@example.com", "nogo@example.com", "Other@Example.com"],
+                bcc=["bcc@example.com", "NOGO@example.com"],
+            )
+        self.assertEqual(msg.email.to, ["go@example.com"])
+        self.assertEqual(msg.email.bcc, ["bcc@example.com"])
+
+    def test_cache(self):
+        with self.settings(MAILER_DONT_SEND_CACHE_TIMEOUT=0):
+            self.assertEqual(DontSendEntry.objects.blocked_addresses(["nogo@example.com"]), {"nogo@example.com"})
+            # Unchanged table: only the version stamp is checked.
+            with self.assertNumQueries(1):
+                self.assertFalse(DontSendEntry.objects.has_address("new@example.com"))
+
+            entry = DontSendEntry.objects.create(to_address="new@example.com", when_added=datetime_now())
+            self.assertTrue(DontSendEntry.objects.has_address("new@example.com"))
+
+            # Edited in place, e.g. in the admin
+            entry.to_address = "edited@example.com"
+            entry.save()
+            self.assertFalse(DontSendEntry.objects.has_address("new@example.com"))
+            self.assertTrue(DontSendEntry.objects.has_address("edited@example.com"))
+
+            DontSendEntry.objects.get(to_address="NoGo@example.com").delete()
+            self.assertFalse(DontSendEntry.objects.has_address("nogo@example.com"))
+
+        with self.settings(MAILER_DONT_SEND_CACHE_TIMEOUT=3600):
+            with self.assertNumQueries(0):
+                self.assertTrue(DontSendEntry.objects.has_address("EDITED@example.com"))
+
+
+class PartitioningTest(TestCase):
+    def test_periods(self):
+        when = datetime.datetime(2026, 12, 31, 23, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-1)))
+        start = partitioning.period_start(when, "month")
+        self.assertEqual(start, datetime.datetime(2027, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(partitioning.next_period(start, "month"), datetime.datetime(2027, 2, 1, tzinfo=start.tzinfo))
+        self.assertEqual(partitioning.partition_name("log", start, "month"), "log_p202701")
+
+        start = partitioning.period_start(when, "day")
+        self.assertEqual(partitioning.next_period(start, "day"), datetime.datetime(2027, 1, 2, tzinfo=start.tzinfo))
+        self.assertEqual(partitioning.partition_name("log", start, "day"), "log_p20270101")
+
+    def test_parse_bounds(self):
+        match = partitioning.BOUND_RE.search("FOR VALUES FROM (MINVALUE) TO ('2026-11-01 00:00:00+00')")
+        self.assertIsNone(partitioning.parse_bound(match.group(1)))
+        self.assertEqual(
+            partitioning.parse_bound(match.group(2)), datetime.datetime(2026, 11, 1, tzinfo=datetime.timezone.utc)
+        )
+
+    @unittest.skipIf(connection.vendor == "postgresql", "PostgreSQL supports partitioning")
+    def test_unsupported_database(self):
+        with self.assertRaises(CommandError):
+            call_command("partition_mail_log", "--setup")
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Partitioning requires PostgreSQL")
+    def test_partitioned_purge(self):
+        now = datetime_now()
+        old = now - datetime.timedelta(days=3)
+        MessageLog.objects.create(when_added=old, when_attempted=old, priority=PRIORITY_MEDIUM, result=RESULT_SUCCESS)
+
+        call_command("partition_mail_log", "--setup", "--period", "day", "--ahead", "1")
+        table = MessageLog._meta.db_table
+        names = [name for name, lower, upper in partitioning.get_partitions(connection, table)]
+        self.assertEqual(names[0], f"{table}_legacy")
+        # The legacy partition covers the rest of today
+        tomorrow = partitioning.next_period(partitioning.period_start(now, "day"), "day")
+        self.assertEqual(names[1], partitioning.partition_name(table, tomorrow, "day"))
+        self.assertEqual(len(names), 3)
+
+        yesterday = now - datetime.timedelta(days=1)
+        for result in [RESULT_SUCCESS, RESULT_FAILURE]:
+            MessageLog.objects.create(
+                when_added=yesterday, when_attempted=yesterday, priority=PRIORITY_MEDIUM, result=result
+            )
+        MessageLog.objects.create(when_added=now, priority=PRIORITY_MEDIUM, result=RESULT_SUCCESS)
+
+        # Not aligned with any partition: the rows are deleted one by one.
+        self.assertEqual(MessageLog.objects.purge_old_entries(2, [RESULT_SUCCESS, RESULT_FAILURE]), 1)
+        self.assertEqual(len(partitioning.get_partitions(connection, table)), 3)
+
+        with patch.object(mailer.models, "datetime_now", return_value=now + datetime.timedelta(days=2)):
+            self.assertEqual(MessageLog.objects.purge_old_entries(1, [RESULT_SUCCESS, RESULT_FAILURE]), 3)
+        self.assertEqual(MessageLog.objects.count(), 0)
+        self.assertEqual(len(partitioning.get_partitions(connection, table)), 2)
+
+
 def call_command_with_cron_arg(command, cron_value):
     # for old django versions, `call_command` doesn't parse arguments
     if django.VERSION < (1, 8):